@@ -0,0 +1,168 @@
+"""Нагрузочная проверка резервирования баланса (reserve/commit/release).
+
+Много параллельных запросов одних и тех же пользователей резервируют баланс,
+затем случайно подтверждают, возвращают или бросают резерв (брошенные
+возвращаются по истечении срока). В конце проверяется, что баланс не ушел
+в минус, не было перерасхода и каждая единица учтена ровно один раз.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.balance_stress
+    python -m benchmarks.balance_stress --backend postgres --dsn postgresql://localhost/bot_stress
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+
+async def attempt(storage, args, user_id, outcomes):
+    """Одна попытка запроса: резерв и случайный исход.
+
+    expired - резерв истек до подтверждения или возврата и его уже вернул сборщик.
+    """
+    hold_id, balance = await storage.reserve_request(user_id, args.ttl)
+    if hold_id is None:
+        outcomes['rejected', user_id] += 1
+        return
+    if balance < 0:
+        outcomes['negative', user_id] += 1
+    outcomes['reserved', user_id] += 1
+
+    # Имитация запроса к OpenAI
+    await asyncio.sleep(random.uniform(0, args.call_ms / 1000))
+
+    roll = random.random()
+    if roll < args.abandon_rate:
+        outcomes['abandoned', user_id] += 1
+    elif roll < args.abandon_rate + args.fail_rate:
+        if await storage.release_request(hold_id):
+            outcomes['released', user_id] += 1
+        else:
+            outcomes['expired', user_id] += 1
+    else:
+        if not await storage.commit_request(hold_id, user_id, "stress", "ok", 1):
+            outcomes['expired', user_id] += 1
+        outcomes['committed', user_id] += 1
+
+
+async def reclaimer(storage, outcomes, stop):
+    """Параллельный возврат просроченных резервов, как в боте"""
+    while not stop.is_set():
+        outcomes['reclaimed', 0] += await storage.reclaim_expired_holds()
+        await asyncio.sleep(0.05)
+
+
+async def run(args):
+    if args.backend == 'postgres':
+        from storage import PostgresStorage
+        storage = PostgresStorage(args.dsn, pool_size=args.pool_size)
+    else:
+        from database import DatabaseManager
+        from storage import SQLiteStorage
+        storage = SQLiteStorage(DatabaseManager(
+            os.path.join(tempfile.mkdtemp(prefix="bot-stress-"), "stress.db"),
+            pool_size=args.pool_size
+        ))
+    await storage.connect()
+
+    user_ids = list(range(1_000_001, 1_000_001 + args.users))
+    initial = {}
+    for user_id in user_ids:
+        user = await storage.get_or_create_user(user_id, f"stress{user_id}")
+        await storage.update_user_balance(user_id, args.balance - user['balance'])
+        user = await storage.get_user(user_id)
+        initial[user_id] = (user['balance'], user['total_requests'])
+
+    outcomes = Counter()
+    stop = asyncio.Event()
+    reclaim_task = asyncio.create_task(reclaimer(storage, outcomes, stop))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with semaphore:
+            await attempt(storage, args, user_id, outcomes)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(random.choice(user_ids)) for _ in range(args.attempts)))
+    elapsed = time.perf_counter() - started
+
+    # Дожидаемся истечения брошенных резервов и возвращаем их
+    await asyncio.sleep(args.ttl)
+    stop.set()
+    await reclaim_task
+    outcomes['reclaimed', 0] += await storage.reclaim_expired_holds()
+
+    errors = []
+    total = Counter()
+    for user_id in user_ids:
+        user = await storage.get_user(user_id)
+        start_balance, start_requests = initial[user_id]
+        committed = outcomes['committed', user_id]
+        reserved = outcomes['reserved', user_id]
+        expired = outcomes['expired', user_id]
+        for key in ('reserved', 'committed', 'expired', 'released', 'abandoned', 'rejected', 'negative'):
+            total[key] += outcomes[key, user_id]
+
+        if outcomes['negative', user_id]:
+            errors.append(f"{user_id}: баланс уходил в минус")
+        # Каждый возвращенный резерв (в том числе истекший) можно зарезервировать заново
+        if reserved > start_balance + outcomes['released', user_id] + outcomes['abandoned', user_id] + expired:
+            errors.append(f"{user_id}: зарезервировано {reserved} при балансе {start_balance}")
+        # Подтверждение истекшего резерва списывает запрос заново, только если баланс положителен
+        if not start_balance - committed <= user['balance'] <= start_balance - committed + expired:
+            errors.append(f"{user_id}: баланс {user['balance']}, ожидалось {start_balance - committed}")
+        if user['total_requests'] != start_requests + committed:
+            errors.append(f"{user_id}: запросов {user['total_requests']}, ожидалось {start_requests + committed}")
+
+    if outcomes['reclaimed', 0] != total['abandoned'] + total['expired']:
+        errors.append(f"возвращено {outcomes['reclaimed', 0]} резервов, брошено {total['abandoned']}, "
+                      f"истекло до подтверждения {total['expired']}")
+
+    await storage.close()
+
+    print(f"Бэкенд: {args.backend}, попыток: {args.attempts}, "
+          f"параллельно: {args.concurrency}, время: {elapsed:.2f} с "
+          f"({args.attempts / elapsed:.0f} попыток/с)")
+    print(f"Зарезервировано {total['reserved']}, подтверждено {total['committed']}, "
+          f"возвращено {total['released']}, брошено {total['abandoned']} "
+          f"(возвращено по сроку {outcomes['reclaimed', 0]}, из них истекли до подтверждения "
+          f"{total['expired']}), отказов {total['rejected']}")
+    if errors:
+        print("\nНарушения:")
+        for error in errors:
+            print(f"  {error}")
+    else:
+        print("Нарушений нет")
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--dsn', help="строка подключения PostgreSQL")
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--balance', type=int, default=100, help="начальный баланс каждого пользователя")
+    parser.add_argument('--attempts', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--call-ms', type=float, default=20.0, help="длительность имитации запроса")
+    parser.add_argument('--fail-rate', type=float, default=0.2)
+    parser.add_argument('--abandon-rate', type=float, default=0.05)
+    parser.add_argument('--ttl', type=float, default=1.0, help="срок жизни резерва, сек")
+    args = parser.parse_args()
+
+    if args.backend == 'postgres' and not args.dsn:
+        parser.error("для postgres нужен --dsn")
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault('ADMIN_ID', '0')
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Бенчмарк: промокоды и выборки по пользователю до и после миграций с индексами.
+
+Для каждого размера база заполняется без индексов (user_version = 0), затем
+замеряются запросы, применяются миграции и замеры повторяются.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.db_indexes --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from database import DatabaseManager
+from migrations import MIGRATIONS, apply_migrations, get_schema_version
+
+PROMO_CODES = 100
+SAMPLES = 200
+
+
+def strip_migrations(db):
+    """Возврат базы к схеме без индексов из миграций"""
+    with db.get_connection() as conn:
+        indexes = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+        ).fetchall()
+        for index in indexes:
+            conn.execute(f"DROP INDEX {index['name']}")
+        conn.execute("PRAGMA user_version = 0")
+
+
+def populate(db, rows):
+    """Заполнение таблиц: rows пользователей, использований промокодов и запросов"""
+    with db.get_connection() as conn:
+        conn.executemany(
+            "INSERT INTO users (tg_id, username, balance, created_at) VALUES (?, ?, 10, datetime('now', ?))",
+            ((tg_id, f"user{tg_id}", f"-{tg_id} seconds") for tg_id in range(rows))
+        )
+        conn.executemany(
+            "INSERT INTO promo_codes (code, requests) VALUES (?, 5)",
+            ((f"CODE{n}",) for n in range(PROMO_CODES))
+        )
+        conn.executemany(
+            "INSERT INTO promo_usage (promo_id, tg_id) VALUES (?, ?)",
+            ((tg_id % PROMO_CODES + 1, tg_id) for tg_id in range(rows))
+        )
+        conn.executemany(
+            "INSERT INTO requests (tg_id, prompt, response, tokens_used) VALUES (?, 'prompt', 'response', 10)",
+            ((random.randrange(rows),) for _ in range(rows))
+        )
+
+
+def timed(func, samples=SAMPLES):
+    """Среднее время вызова в миллисекундах"""
+    started = time.perf_counter()
+    for i in range(samples):
+        func(i)
+    return (time.perf_counter() - started) / samples * 1000
+
+
+def measure(db, rows, next_user):
+    """Замер промокодов, выборок по пользователю и списка новых пользователей"""
+    def redeem(i):
+        db.use_promo_code(f"CODE{i % PROMO_CODES}", next_user())
+
+    def user_requests(i):
+        with db.get_connection() as conn:
+            conn.execute(
+                "SELECT prompt, response FROM requests WHERE tg_id = ? ORDER BY created_at DESC LIMIT 10",
+                (random.randrange(rows),)
+            ).fetchall()
+
+    def newest_users(i):
+        with db.get_connection() as conn:
+            conn.execute(
+                "SELECT tg_id, username FROM users ORDER BY created_at DESC LIMIT 10"
+            ).fetchall()
+
+    return {
+        'промокод': timed(redeem),
+        'запросы пользователя': timed(user_requests),
+        'новые пользователи': timed(newest_users, samples=20),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print(f"{'строк':>9}  {'операция':<22} {'до, мс':>10} {'после, мс':>10}")
+    for rows in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = DatabaseManager(os.path.join(tmp, "bench.db"), user_cache_size=0)
+            strip_migrations(db)
+            populate(db, rows)
+
+            counter = iter(range(rows, rows * 10))
+            before = measure(db, rows, lambda: next(counter))
+            with db.get_connection() as conn:
+                apply_migrations(conn)
+                assert get_schema_version(conn) == MIGRATIONS[-1][0]
+            after = measure(db, rows, lambda: next(counter))
+            db.close()
+
+        for name in before:
+            print(f"{rows:>9}  {name:<22} {before[name]:>10.3f} {after[name]:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Микробенчмарк: новое соединение на каждый вызов против пула соединений.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.db_pool --calls 20000 --threads 8
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from database import DatabaseManager
+
+USERS = 1000
+
+
+def fresh_get_balance(db_name, tg_id):
+    """Чтение баланса как до появления пула: отдельное соединение на вызов"""
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    try:
+        user = conn.execute("SELECT balance FROM users WHERE tg_id = ?", (tg_id,)).fetchone()
+        return user['balance'] if user else 0
+    finally:
+        conn.close()
+
+
+def fresh_add_request(db_name, tg_id):
+    """Запись запроса как до появления пула: отдельное соединение на вызов"""
+    conn = sqlite3.connect(db_name)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO requests (tg_id, prompt, response, tokens_used) VALUES (?, ?, ?, ?)",
+                (tg_id, "prompt", "response", 10)
+            )
+            conn.execute(
+                "UPDATE users SET balance = balance - 1, total_requests = total_requests + 1 WHERE tg_id = ?",
+                (tg_id,)
+            )
+    finally:
+        conn.close()
+
+
+def prepare(db_name, journal_mode):
+    """Создание базы с пользователями"""
+    db = DatabaseManager(db_name)
+    for tg_id in range(USERS):
+        db.get_or_create_user(tg_id)
+    db.close()
+    conn = sqlite3.connect(db_name)
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.close()
+
+
+def run(label, calls, threads, read, write):
+    """Параллельный прогон смешанной нагрузки (9 чтений на 1 запись)"""
+    errors = []
+    per_thread = calls // threads
+
+    def worker(offset):
+        for i in range(per_thread):
+            tg_id = (offset + i) % USERS
+            try:
+                if i % 10 == 9:
+                    write(tg_id)
+                else:
+                    read(tg_id)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(n * per_thread,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = per_thread * threads
+    print(f"{label:<24} {total / elapsed:>10.0f} вызовов/с  "
+          f"{elapsed / total * 1e6:>8.1f} мкс/вызов  ошибок: {len(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, "legacy.db")
+        pooled_db = os.path.join(tmp, "pooled.db")
+        prepare(legacy_db, "DELETE")
+        prepare(pooled_db, "WAL")
+
+        for threads in (1, args.threads):
+            print(f"\nПотоков: {threads}")
+            run(
+                "соединение на вызов", args.calls, threads,
+                lambda tg_id: fresh_get_balance(legacy_db, tg_id),
+                lambda tg_id: fresh_add_request(legacy_db, tg_id)
+            )
+
+            # Кэш пользователей отключен, чтобы измерять только работу с соединениями
+            db = DatabaseManager(pooled_db, pool_size=threads, user_cache_size=0)
+            run(
+                "пул соединений", args.calls, threads,
+                db.get_user_balance,
+                lambda tg_id: db.add_request(tg_id, "prompt", "response", 10)
+            )
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Сквозной офлайн-бенчмарк бота с локальными заменителями Telegram и OpenAI.
+
+Поднимает фейковые Bot API и OpenAI с заданной задержкой, подает в бота
+синтетический поток обновлений (текстовые запросы, /start, /balance,
+промокоды, successful_payment) с заданной частотой и считает пропускную
+способность и p50/p95/p99 времени обработки по каждому обработчику.
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.e2e --rate 50 --duration 30 --output results.json
+    python -m benchmarks.e2e --rate 50 --duration 30 --compare results.json
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from benchmarks.fake_servers import FakeOpenAIServer, FakeTelegramServer
+
+BENCH_PROMO_CODES = 10
+BENCH_BALANCE = 1_000_000
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+# Задачи, запущенные обработчиком обновления (запрос к AI): входят в время его обработки
+spawned_tasks = contextvars.ContextVar('spawned_tasks')
+
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+
+def make_message_update(user_id, text=None, **extra):
+    """Синтетическое обновление с сообщением пользователя"""
+    message = {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        **extra
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(update_ids), 'message': message}
+
+
+def make_payment_update(user_id, amount):
+    """Синтетическое обновление об успешной оплате Stars"""
+    return make_message_update(user_id, successful_payment={
+        'currency': 'XTR',
+        'total_amount': amount,
+        'invoice_payload': f"requests_{amount}_{user_id}",
+        'telegram_payment_charge_id': f"bench-{next(update_ids)}",
+        'provider_payment_charge_id': ''
+    })
+
+
+class ErrorCounter(logging.Handler):
+    """Подсчет ошибок, которые telebot перехватывает и только логирует"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Recorder:
+    """Сбор длительностей обработки по обработчикам"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def feed(self, bot_module, label, update):
+        from telebot import types
+
+        spawned = []
+        spawned_tasks.set(spawned)
+        started = time.perf_counter()
+        try:
+            await bot_module.bot.process_new_updates([types.Update.de_json(update)])
+            await asyncio.gather(*spawned)
+        except Exception:
+            self.errors[label] += 1
+        self.durations[label].append(time.perf_counter() - started)
+
+
+def track_spawned(lifecycle):
+    """Запоминание задач, запущенных обработчиком, в контексте обновления"""
+    spawn = lifecycle.spawn
+
+    def tracked(coro):
+        task = spawn(coro)
+        spawned = spawned_tasks.get(None)
+        if spawned is not None:
+            spawned.append(task)
+        return task
+
+    lifecycle.spawn = tracked
+
+
+async def scenario(bot_module, recorder, kind, user_id):
+    """Одна пользовательская операция; промокод — два последовательных обновления"""
+    if kind == 'text':
+        await recorder.feed(bot_module, 'text', make_message_update(user_id, f"Вопрос {random.random()}"))
+    elif kind == 'start':
+        await recorder.feed(bot_module, 'start', make_message_update(user_id, "/start"))
+    elif kind == 'balance':
+        await recorder.feed(bot_module, 'balance', make_message_update(user_id, "/balance"))
+    elif kind == 'promo':
+        await recorder.feed(bot_module, 'promo_command', make_message_update(user_id, "/promo"))
+        code = f"BENCH{random.randrange(BENCH_PROMO_CODES)}"
+        await recorder.feed(bot_module, 'promo_code', make_message_update(user_id, code))
+    elif kind == 'payment':
+        await recorder.feed(bot_module, 'payment', make_payment_update(user_id, 10))
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(recorder, elapsed):
+    """Сводка по обработчикам: число, ошибки, пропускная способность, перцентили в мс"""
+    results = {}
+    for label, durations in sorted(recorder.durations.items()):
+        results[label] = {
+            'count': len(durations),
+            'errors': recorder.errors[label],
+            'throughput': len(durations) / elapsed,
+            'mean_ms': statistics.mean(durations) * 1000,
+            'p50_ms': percentile(durations, 50) * 1000,
+            'p95_ms': percentile(durations, 95) * 1000,
+            'p99_ms': percentile(durations, 99) * 1000,
+        }
+    total = sum(len(d) for d in recorder.durations.values())
+    results['_total'] = {'count': total, 'throughput': total / elapsed}
+    return results
+
+
+def print_results(results, baseline=None, threshold=10.0):
+    """Таблица результатов; при наличии baseline — изменение относительно него"""
+    header = f"{'обработчик':<14} {'кол-во':>7} {'ошибки':>7} {'в сек':>8} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9}"
+    print(header)
+    print("-" * len(header))
+    regressions = []
+    for label, row in results.items():
+        if label.startswith('_'):
+            continue
+        line = (f"{label:<14} {row['count']:>7} {row['errors']:>7} {row['throughput']:>8.1f} "
+                f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+        base = (baseline or {}).get(label)
+        if base:
+            deltas = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms'):
+                change = (row[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+                deltas.append(f"{change:+.0f}%")
+                if change > threshold:
+                    regressions.append(f"{label} {key}: {base[key]:.1f} -> {row[key]:.1f} мс")
+            line += "   " + " / ".join(deltas)
+        print(line)
+    print(f"\nВсего обработано: {results['_total']['count']} "
+          f"({results['_total']['throughput']:.1f} обновлений/с)")
+    if regressions:
+        print(f"\nРегрессии больше {threshold:.0f}%:")
+        for regression in regressions:
+            print(f"  {regression}")
+    return regressions
+
+
+async def run(args):
+    telegram = FakeTelegramServer(
+        args.telegram_latency, args.telegram_jitter,
+        flood_rate=args.telegram_flood_rate, retry_after=args.telegram_retry_after
+    )
+    openai_server = FakeOpenAIServer(
+        args.openai_latency, args.openai_jitter,
+        response_words=args.response_words, stream_chunk_ms=args.stream_chunk_ms
+    )
+    telegram_url = await telegram.start()
+    openai_url = await openai_server.start()
+
+    # Окружение задается до импорта бота: конфигурация читается при импорте
+    os.environ.update({
+        'BOT_TOKEN': '123456:BENCH',
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': f"{openai_url}/v1",
+        'ADMIN_ID': '1',
+        'STREAM_RESPONSES': 'true' if args.stream else 'false',
+        'USER_RATE_LIMIT_PER_MINUTE': '100000',
+        'USER_RATE_LIMIT_BURST': '100000',
+        'OPENAI_RPM': '1000000',
+        'OPENAI_TPM': '1000000000',
+    })
+    from telebot import asyncio_helper
+    asyncio_helper.API_URL = f"{telegram_url}/bot{{0}}/{{1}}"
+    import bot as bot_module
+    bot_module.setup()
+    track_spawned(bot_module.lifecycle)
+
+    storage = bot_module.storage
+    await storage.connect()
+    for user_id in range(1, args.users + 1):
+        await storage.get_or_create_user(user_id, f"user{user_id}")
+        await storage.update_user_balance(user_id, BENCH_BALANCE)
+    for n in range(BENCH_PROMO_CODES):
+        await storage.create_promo_code(f"BENCH{n}", requests=1)
+
+    mix = {}
+    for item in args.mix.split(','):
+        kind, weight = item.split('=')
+        mix[kind] = float(weight)
+    kinds, weights = list(mix), list(mix.values())
+
+    error_counter = ErrorCounter()
+    logging.getLogger().addHandler(error_counter)
+    logging.getLogger('TeleBot').addHandler(error_counter)
+
+    recorder = Recorder()
+    tasks = []
+    started = time.perf_counter()
+    interval = 1 / args.rate
+    for n in range(int(args.rate * args.duration)):
+        # Открытая модель нагрузки: обновления приходят по расписанию, не дожидаясь ответов
+        delay = started + n * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = random.choices(kinds, weights)[0]
+        tasks.append(asyncio.create_task(
+            scenario(bot_module, recorder, kind, random.randint(1, args.users))
+        ))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await storage.close()
+    await bot_module.outbound.close()
+    await bot_module.bot.close_session()
+    await bot_module.llm.close()
+    await telegram.stop()
+    await openai_server.stop()
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'telegram_calls': dict(telegram.calls),
+        'openai_calls': dict(openai_server.calls),
+        'logged_errors': error_counter.count,
+        'results': summarize(recorder, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=20.0, help="обновлений в секунду")
+    parser.add_argument('--duration', type=float, default=10.0, help="длительность подачи нагрузки, сек")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--mix', default="text=0.6,start=0.1,balance=0.15,promo=0.1,payment=0.05")
+    parser.add_argument('--openai-latency', type=float, default=800.0, help="мс")
+    parser.add_argument('--openai-jitter', type=float, default=300.0, help="мс")
+    parser.add_argument('--response-words', type=int, default=50)
+    parser.add_argument('--stream-chunk-ms', type=float, default=20.0)
+    parser.add_argument('--telegram-latency', type=float, default=50.0, help="мс")
+    parser.add_argument('--telegram-jitter', type=float, default=20.0, help="мс")
+    parser.add_argument('--telegram-flood-rate', type=float, default=0.0, help="доля ответов 429 от Telegram")
+    parser.add_argument('--telegram-retry-after', type=int, default=1, help="retry_after в ответах 429, сек")
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--output', help="файл для сохранения результатов в JSON")
+    parser.add_argument('--compare', help="JSON предыдущего прогона для сравнения")
+    parser.add_argument('--regression-threshold', type=float, default=10.0, help="допустимый рост перцентилей, %%")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+    # База бота создается во временном каталоге, модули бота берутся из корня репозитория
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.chdir(workdir)
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    regressions = print_results(report['results'], baseline, args.regression_threshold)
+    if report['logged_errors']:
+        print(f"Ошибок в логах обработчиков: {report['logged_errors']}")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {output}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""Локальные заменители Telegram Bot API и OpenAI для офлайн-бенчмарков."""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeServer:
+    """Базовый HTTP-сервер с настраиваемой задержкой ответа"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.port: Optional[int] = None
+
+    async def delay(self) -> None:
+        """Имитация сетевой задержки и времени обработки"""
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def create_app(self) -> web.Application:
+        raise NotImplementedError
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запуск сервера; возвращает базовый URL"""
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeTelegramServer(FakeServer):
+    """Заменитель Bot API: отвечает на методы отправки и правки сообщений"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 flood_rate: float = 0.0, retry_after: int = 1):
+        super().__init__(latency_ms, jitter_ms)
+        self._message_ids = itertools.count(1)
+        # Доля отправок и правок, отклоненных с 429 Too Many Requests
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        return app
+
+    def _message(self, params) -> dict:
+        chat_id = int(params.get('chat_id', 0))
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', '')
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await request.post()
+        self.calls[method] += 1
+        await self.delay()
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('answerPreCheckoutQuery', 'answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            result = True
+        elif self.flood_rate and random.random() < self.flood_rate:
+            self.calls['flood'] += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}
+            }, status=429)
+        else:
+            result = self._message(params)
+        return web.json_response({'ok': True, 'result': result})
+
+
+class FakeOpenAIServer(FakeServer):
+    """Заменитель Chat Completions API с обычными и потоковыми ответами"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 response_words: int = 50, stream_chunk_ms: float = 20.0,
+                 error_rate: float = 0.0, server_error_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_ms: float = 0.0):
+        super().__init__(latency_ms, jitter_ms)
+        self.response_words = response_words
+        self.stream_chunk_ms = stream_chunk_ms
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        # Доля «зависающих» запросов: хвост распределения задержек
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+    def _usage(self, body) -> dict:
+        prompt_tokens = sum(len(m.get('content', '')) // 3 + 1 for m in body.get('messages', []))
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self.response_words,
+            'total_tokens': prompt_tokens + self.response_words
+        }
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls[body.get('model', 'unknown')] += 1
+        await self.delay()
+        if self.slow_rate and random.random() < self.slow_rate:
+            self.calls['slow'] += 1
+            await asyncio.sleep(self.slow_ms / 1000)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.calls['errors'] += 1
+            return web.json_response(
+                {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                status=429
+            )
+        if self.server_error_rate and random.random() < self.server_error_rate:
+            self.calls['server_errors'] += 1
+            return web.json_response(
+                {'error': {'message': 'The server had an error', 'type': 'server_error', 'code': None}},
+                status=500
+            )
+
+        words = [f"слово{n}" for n in range(self.response_words)]
+        base = {'id': 'chatcmpl-bench', 'created': int(time.time()), 'model': body.get('model')}
+
+        if not body.get('stream'):
+            return web.json_response({
+                **base,
+                'object': 'chat.completion',
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': " ".join(words)},
+                    'finish_reason': 'stop'
+                }],
+                'usage': self._usage(body)
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+
+        async def send(chunk):
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+        try:
+            await response.prepare(request)
+            for word in words:
+                await send({**base, 'object': 'chat.completion.chunk', 'choices': [
+                    {'index': 0, 'delta': {'content': word + " "}, 'finish_reason': None}
+                ]})
+                if self.stream_chunk_ms:
+                    await asyncio.sleep(self.stream_chunk_ms / 1000)
+            if (body.get('stream_options') or {}).get('include_usage'):
+                await send({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': self._usage(body)})
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент закрыл поток: проигравший дублирующий запрос или истекший срок
+            pass
+        return response
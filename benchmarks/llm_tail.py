@@ -0,0 +1,163 @@
+"""Хвостовые задержки запросов к OpenAI: прямой вызов против LLMClient.
+
+Поднимает фейковый OpenAI с заданной долей «зависающих» запросов, 429 и 500
+и выполняет одну и ту же нагрузку в трех режимах:
+
+    direct  - как раньше в боте: клиент OpenAI с его повторами, без срока;
+    retries - LLMClient со сроком попытки и повторами с джиттером;
+    hedged  - то же плюс дублирующий запрос после p95 времени ответа.
+
+Для каждого режима печатает долю успешных ответов, p50/p95/p99/максимум
+и число запросов, дошедших до сервера (цена дублирования).
+
+Запуск из корня репозитория:
+
+    python -m benchmarks.llm_tail
+    python -m benchmarks.llm_tail --slow-rate 0.1 --slow-ms 5000 --stream
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+
+from benchmarks.e2e import percentile
+from benchmarks.fake_servers import FakeOpenAIServer
+
+MESSAGES = [
+    {"role": "system", "content": "Ты полезный AI-ассистент."},
+    {"role": "user", "content": "Расскажи что-нибудь интересное"},
+]
+
+
+async def direct_call(client, stream):
+    """Запрос так, как бот делал его до LLMClient"""
+    if not stream:
+        await client.chat.completions.create(
+            model="gpt-3.5-turbo", messages=MESSAGES, max_tokens=1000, temperature=0.7
+        )
+        return
+    response = await client.chat.completions.create(
+        model="gpt-3.5-turbo", messages=MESSAGES, max_tokens=1000, temperature=0.7,
+        stream=True, stream_options={"include_usage": True}
+    )
+    async for _ in response:
+        pass
+
+
+async def llm_call(llm, stream):
+    if not stream:
+        await llm.complete(MESSAGES)
+        return
+    response = await llm.stream(MESSAGES)
+    try:
+        async for _ in response:
+            pass
+    finally:
+        await response.close()
+
+
+async def run_mode(mode, args):
+    from openai import AsyncOpenAI
+    from llm import LLMClient, ModelRoute, RoutingPolicy
+
+    random.seed(args.seed)
+    server = FakeOpenAIServer(
+        latency_ms=args.latency, jitter_ms=args.jitter,
+        response_words=args.response_words, stream_chunk_ms=args.stream_chunk_ms,
+        error_rate=args.error_rate, server_error_rate=args.server_error_rate,
+        slow_rate=args.slow_rate, slow_ms=args.slow_ms
+    )
+    url = await server.start()
+
+    if mode == 'direct':
+        client = AsyncOpenAI(api_key="bench", base_url=f"{url}/v1")
+        call = lambda: direct_call(client, args.stream)
+    else:
+        client = AsyncOpenAI(api_key="bench", base_url=f"{url}/v1", max_retries=0)
+        llm = LLMClient(
+            client,
+            RoutingPolicy([ModelRoute("gpt-3.5-turbo", 16385, 1000)]),
+            deadline=args.deadline,
+            attempt_timeout=args.attempt_timeout,
+            max_attempts=args.max_attempts,
+            hedge=mode == 'hedged'
+        )
+        call = lambda: llm_call(llm, args.stream)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    durations = []
+    failures = 0
+
+    async def one():
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await call()
+            except Exception:
+                failures += 1
+                return
+            durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    await client.close()
+    await server.stop()
+    upstream = sum(count for key, count in server.calls.items() if key not in ('slow', 'errors', 'server_errors'))
+    return {
+        'mode': mode,
+        'ok': len(durations),
+        'failed': failures,
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'p99': percentile(durations, 99),
+        'max': max(durations, default=0.0),
+        'upstream': upstream,
+        'elapsed': elapsed,
+    }
+
+
+async def run(args):
+    return [await run_mode(mode, args) for mode in args.modes.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default="direct,retries,hedged")
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--concurrency', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=300.0, help="обычная задержка ответа, мс")
+    parser.add_argument('--jitter', type=float, default=100.0, help="мс")
+    parser.add_argument('--slow-rate', type=float, default=0.05, help="доля зависающих запросов")
+    parser.add_argument('--slow-ms', type=float, default=4000.0, help="дополнительная задержка зависающих, мс")
+    parser.add_argument('--error-rate', type=float, default=0.03, help="доля ответов 429")
+    parser.add_argument('--server-error-rate', type=float, default=0.02, help="доля ответов 500")
+    parser.add_argument('--response-words', type=int, default=50)
+    parser.add_argument('--stream-chunk-ms', type=float, default=5.0)
+    parser.add_argument('--stream', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--deadline', type=float, default=20.0, help="общий срок LLMClient, сек")
+    parser.add_argument('--attempt-timeout', type=float, default=2.0, help="срок попытки LLMClient, сек")
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Повторы LLMClient пишут предупреждения на каждую ошибку - в замере это шум
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = asyncio.run(run(args))
+
+    print(f"{'режим':<10}{'успешно':>10}{'ошибок':>8}{'p50, с':>9}{'p95, с':>9}"
+          f"{'p99, с':>9}{'макс, с':>9}{'запросов':>10}")
+    for result in results:
+        print(f"{result['mode']:<10}{result['ok']:>10}{result['failed']:>8}"
+              f"{result['p50']:>9.2f}{result['p95']:>9.2f}{result['p99']:>9.2f}"
+              f"{result['max']:>9.2f}{result['upstream']:>10}")
+
+
+if __name__ == "__main__":
+    main()
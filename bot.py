@@ -1,9 +1,38 @@
+import asyncio
 import logging
-import telebot
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
 from telebot import types
-from openai import OpenAI
-from database import DatabaseManager
-from config import Config, BOT_TOKEN, OPENAI_API_KEY, ADMIN_ID
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.asyncio_filters import StateFilter
+from telebot.asyncio_handler_backends import State, StatesGroup
+from openai import AsyncOpenAI
+from outbound import OutboundDispatcher, split_text
+from broadcast import Broadcaster, is_blocked_error
+from conversation import ConversationMemory
+from database import ConnectionPool, DatabaseManager
+from export import EXPORT_TABLES, EXPORT_WRITERS, export_file_name, export_table, parse_date_range
+from lifecycle import Lifecycle
+from llm import LLMClient, LLMTimeoutError, RoutingPolicy, parse_routes
+from metrics import (
+    BALANCE_HOLDS_EXPIRED, DB_CONNECTION_WAIT, HANDLER_ERRORS, OPENAI_TOKENS, PROMO_ATTEMPTS, STAGE_LATENCY,
+    MetricsServer, instrument_handler, stage, track_scheduler
+)
+from profiler import PROFILE_MODES, run_profile
+from promo import (
+    PromoCodeIndex, PromoGuard, create_campaign, is_valid_campaign_name, normalize_code, write_codes_file
+)
+from ratelimit import FairScheduler, SchedulerTimeout, UserRateLimiter
+from response_cache import ResponseCache
+from retention import RetentionManager, format_report
+from state_store import LRUStateStorage, SQLiteStateStorage
+from storage import PostgresStorage, SQLiteStorage
+from webhook import WebhookServer
+from config import Config
 
 # Настройка логирования
 logging.basicConfig(
@@ -11,26 +40,223 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
-# Инициализация бота и клиента OpenAI
-bot = telebot.TeleBot(BOT_TOKEN)
-client = OpenAI(api_key=OPENAI_API_KEY)
-db = DatabaseManager()
+# Бот создается при импорте, чтобы зарегистрировать обработчики; хранилище, клиент
+# OpenAI, очереди и остальные компоненты создает setup() уже после Config.validate():
+# импорт модуля не открывает базу и не запускает потоков
+bot = AsyncTeleBot(Config.BOT_TOKEN)
+bot.add_custom_filter(StateFilter(bot))
+
+storage = None
+local_pool = None
+promo_guard = None
+llm = None
+response_cache = None
+ai_scheduler = None
+conversation_memory = None
+outbound = None
+broadcaster = None
+retention = None
+
+# Ограничение частоты запросов одного пользователя
+user_limiter = UserRateLimiter(
+    per_minute=Config.USER_RATE_LIMIT_PER_MINUTE,
+    burst=Config.USER_RATE_LIMIT_BURST
+)
+
+# Параметры запросов к OpenAI (модель и лимит ответа выбирает llm по длине промпта)
+SYSTEM_PROMPT = "Ты полезный AI-ассистент. Отвечай понятно и подробно."
+TEMPERATURE = 0.7
+
+# Максимальная длина текста сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Промпт для сворачивания старой части диалога в резюме
+SUMMARY_PROMPT = (
+    "Сожми диалог пользователя с AI-ассистентом в краткое резюме на языке диалога. "
+    "Сохрани факты, договоренности и контекст, нужные для продолжения разговора."
+)
+
+
+async def summarize_conversation(user_id, summary, turns):
+    """Сворачивание старых реплик диалога в краткое резюме"""
+    dialog = "\n\n".join(
+        f"Пользователь: {prompt}\nАссистент: {response}" for prompt, response in turns
+    )
+    if summary:
+        dialog = f"Предыдущее резюме: {summary}\n\n{dialog}"
+
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": dialog}
+    ]
+    route = llm.route(messages, max_tokens=Config.CONVERSATION_SUMMARY_MAX_TOKENS)
+    async with ai_scheduler.slot(user_id, route.prompt_tokens + route.max_tokens) as slot:
+        completion = await llm.complete(messages, temperature=0.3, route=route)
+        slot.tokens_used = completion.tokens_used
+    OPENAI_TOKENS.labels('summary').inc(completion.tokens_used)
+    return completion.text
+
+# Индекс активных промокодов: перебор кодов не доходит до базы
+promo_index = PromoCodeIndex()
+
+retention_lock = asyncio.Lock()
+
+# Готовность и плавная остановка: обработчики обновлений учитываются, чтобы их дождаться
+lifecycle = Lifecycle(drain_timeout=Config.SHUTDOWN_DRAIN_TIMEOUT)
+lifecycle.track_updates(bot)
+
+
+def setup():
+    """Создание хранилища, клиента OpenAI, очередей и фоновых компонентов"""
+    global storage, local_pool, promo_guard, llm, response_cache, ai_scheduler
+    global conversation_memory, outbound, broadcaster, retention
+
+    if Config.STORAGE_BACKEND == 'postgres':
+        storage = PostgresStorage(
+            Config.DATABASE_URL,
+            pool_size=Config.DB_POOL_SIZE,
+            default_free_requests=Config.DEFAULT_FREE_REQUESTS
+        )
+        # Кэш ответов и состояния диалогов остаются в локальном файле SQLite
+        local_pool = ConnectionPool(Config.DATABASE_NAME, size=Config.DB_POOL_SIZE)
+    else:
+        storage = SQLiteStorage(DatabaseManager(
+            db_name=Config.DATABASE_NAME,
+            pool_size=Config.DB_POOL_SIZE,
+            request_log_batch_size=Config.REQUEST_LOG_BATCH_SIZE,
+            request_log_flush_interval=Config.REQUEST_LOG_FLUSH_INTERVAL,
+            user_cache_size=Config.USER_CACHE_SIZE,
+            compression=Config.RESPONSE_COMPRESSION
+        ))
+        local_pool = storage.db.pool
+    storage.on_wait = DB_CONNECTION_WAIT.observe
+
+    # Лимит попыток активации и проверка кода по индексу
+    promo_guard = PromoGuard(
+        promo_index,
+        storage,
+        attempts_per_minute=Config.PROMO_ATTEMPTS_PER_MINUTE,
+        attempts_burst=Config.PROMO_ATTEMPTS_BURST,
+        miss_refresh_interval=Config.PROMO_INDEX_MISS_REFRESH_INTERVAL
+    )
+
+    # Состояния диалогов: в SQLite они переживают перезапуск и общие для нескольких процессов
+    if Config.STATE_STORAGE == 'sqlite':
+        bot.current_states = SQLiteStateStorage(local_pool, ttl=Config.STATE_TTL)
+    else:
+        bot.current_states = LRUStateStorage(ttl=Config.STATE_TTL, max_entries=Config.STATE_MAX_ENTRIES)
+
+    # Клиент OpenAI создается при первом запросе; повторы выполняет LLMClient, а не клиент
+    llm = LLMClient(
+        lambda: AsyncOpenAI(api_key=Config.OPENAI_API_KEY, max_retries=0),
+        RoutingPolicy(parse_routes(Config.LLM_ROUTES), fallbacks=Config.LLM_FALLBACK_MODELS),
+        deadline=Config.LLM_DEADLINE,
+        attempt_timeout=Config.LLM_ATTEMPT_TIMEOUT,
+        max_attempts=Config.LLM_MAX_ATTEMPTS,
+        backoff_base=Config.LLM_BACKOFF_BASE,
+        backoff_max=Config.LLM_BACKOFF_MAX,
+        hedge=Config.LLM_HEDGE_ENABLED,
+        hedge_quantile=Config.LLM_HEDGE_QUANTILE,
+        stream_idle_timeout=Config.LLM_STREAM_IDLE_TIMEOUT
+    )
+
+    # Кэш ответов на повторяющиеся запросы
+    response_cache = ResponseCache(
+        local_pool,
+        ttl=Config.RESPONSE_CACHE_TTL,
+        max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+        memory_size=Config.RESPONSE_CACHE_MEMORY_SIZE
+    ) if Config.RESPONSE_CACHE_ENABLED else None
+
+    # Справедливая очередь запросов к OpenAI с общими лимитами
+    ai_scheduler = FairScheduler(
+        max_concurrency=Config.MAX_CONCURRENT_AI_REQUESTS,
+        rpm=Config.OPENAI_RPM,
+        tpm=Config.OPENAI_TPM
+    )
+    track_scheduler(ai_scheduler)
+
+    # Память диалогов с ограниченным по токенам контекстом
+    conversation_memory = ConversationMemory(
+        storage,
+        summarize=summarize_conversation,
+        token_budget=Config.CONVERSATION_TOKEN_BUDGET
+    ) if Config.CONVERSATION_MEMORY_ENABLED else None
+
+    # Исходящие сообщения: очередь на чат, общий темп и повторы после 429
+    outbound = OutboundDispatcher(
+        bot,
+        global_rate=Config.OUTBOUND_GLOBAL_RATE,
+        chat_rate=Config.OUTBOUND_CHAT_RATE,
+        chat_burst=Config.OUTBOUND_CHAT_BURST,
+        concurrency=Config.OUTBOUND_CONCURRENCY,
+        request_timeout=Config.OUTBOUND_REQUEST_TIMEOUT
+    )
+
+    # Рассылки администратора с соблюдением лимитов Telegram
+    broadcaster = Broadcaster(
+        bot,
+        storage,
+        outbound,
+        rate=Config.BROADCAST_RATE,
+        concurrency=Config.BROADCAST_CONCURRENCY,
+        page_size=Config.BROADCAST_PAGE_SIZE,
+        progress_interval=Config.BROADCAST_PROGRESS_INTERVAL,
+        stale_after=Config.BROADCAST_STALE_AFTER
+    )
+
+    # Сжатие и архивирование журнала запросов (для PostgreSQL место освобождает autovacuum)
+    retention = RetentionManager(
+        storage.db,
+        archive_dir=Config.ARCHIVE_DIR,
+        retain_days=Config.RETENTION_DAYS,
+        compression=Config.RESPONSE_COMPRESSION,
+        convert_auto_vacuum=Config.RETENTION_CONVERT_AUTO_VACUUM
+    ) if Config.RETENTION_ENABLED and isinstance(storage, SQLiteStorage) else None
+
+# Одна выгрузка за раз: она читает всю таблицу и держит соединение
+export_lock = asyncio.Lock()
+# Один профиль за раз: cProfile не включить дважды, а выборки мешали бы друг другу
+profile_lock = asyncio.Lock()
+# Ограничение Bot API на размер отправляемого файла
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+
+# Состояния многошаговых команд
+class PromoStates(StatesGroup):
+    code = State()
+
+
+class GiveStates(StatesGroup):
+    user_id = State()
+    amount = State()
+
+
+class CreatePromoStates(StatesGroup):
+    code = State()
+    requests = State()
+    max_uses = State()
+
+
+class BroadcastStates(StatesGroup):
+    text = State()
 
-# Временные хранилища для многошаговых команд
-waiting_for_user_id = {}
-waiting_for_promo_data = {}
 
 @bot.message_handler(commands=['start'])
-def start_command(message):
+@instrument_handler('start')
+async def start_command(message):
     """Обработчик команды /start"""
     user = message.from_user
-    db_user = db.get_or_create_user(
+    db_user = await storage.get_or_create_user(
         tg_id=user.id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name
     )
-    
+    if db_user.get('is_blocked'):
+        # Пользователь снова написал боту: рассылки ему опять доставляются
+        await storage.set_user_blocked(user.id, False)
+
     welcome_text = f"""
 🤖 Добро пожаловать, {user.first_name}!
 
@@ -42,15 +268,17 @@ def start_command(message):
 /balance - Проверить баланс
 /buy - Купить запросы
 /promo - Активировать промокод
+/reset - Начать диалог заново
 /help - Помощь
 
 Для начала просто напишите ваш вопрос!
     """
-    
-    bot.send_message(message.chat.id, welcome_text)
+
+    await outbound.send_message(message.chat.id, welcome_text)
 
 @bot.message_handler(commands=['help'])
-def help_command(message):
+@instrument_handler('help')
+async def help_command(message):
     """Обработчик команды /help"""
     help_text = """
 📖 Справка по боту:
@@ -64,22 +292,29 @@ def help_command(message):
 /balance - Проверить баланс
 /buy - Купить дополнительные запросы
 /promo - Активировать промокод
+/reset - Начать диалог заново
 /help - Эта справка
 
 Для администраторов:
 /stat - Статистика
 /createpromo - Создать промокод
+/createpromos - Массовая генерация промокодов
 /give - Начислить запросы
+/broadcast - Рассылка всем пользователям
+/retention - Обслуживание журнала запросов
+/export - Выгрузка таблицы в файл
+/profile - Профилирование работающего бота
     """
-    bot.send_message(message.chat.id, help_text)
+    await outbound.send_message(message.chat.id, help_text)
 
 @bot.message_handler(commands=['balance'])
-def balance_command(message):
+@instrument_handler('balance')
+async def balance_command(message):
     """Проверка баланса"""
     user_id = message.from_user.id
-    balance = db.get_user_balance(user_id)
-    stats = db.get_user_stats(user_id)
-    
+    stats = await storage.get_user_stats(user_id)
+    balance = stats['balance']
+
     balance_text = f"""
 💫 Ваш баланс: {balance} запросов
 
@@ -90,41 +325,43 @@ def balance_command(message):
 💡 Пополнить баланс: /buy
 🎁 Активировать промокод: /promo
     """
-    bot.send_message(message.chat.id, balance_text)
+    await outbound.send_message(message.chat.id, balance_text)
 
 @bot.message_handler(commands=['buy'])
-def buy_command(message):
+@instrument_handler('buy')
+async def buy_command(message):
     """Покупка запросов"""
     markup = types.InlineKeyboardMarkup(row_width=2)
-    
+
     prices = [
         ("10 запросов", 10),
         ("25 запросов", 25),
         ("50 запросов", 50),
         ("100 запросов", 100)
     ]
-    
+
     for label, amount in prices:
         callback_data = f"buy_{amount}"
         markup.add(types.InlineKeyboardButton(label, callback_data=callback_data))
-    
-    bot.send_message(
+
+    await outbound.send_message(
         message.chat.id,
         "💰 Выберите пакет запросов для покупки:",
         reply_markup=markup
     )
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('buy_'))
-def handle_buy_callback(call):
+@instrument_handler('buy_callback')
+async def handle_buy_callback(call):
     """Обработка выбора пакета запросов"""
     amount = int(call.data.split('_')[1])
-    create_invoice(call.message.chat.id, call.from_user.id, amount)
+    await create_invoice(call.message.chat.id, call.from_user.id, amount)
 
-def create_invoice(chat_id, user_id, amount):
+async def create_invoice(chat_id, user_id, amount):
     """Создание инвойса для оплаты"""
     prices = [types.LabeledPrice(label=f"{amount} запросов", amount=amount)]
-    
-    bot.send_invoice(
+
+    await bot.send_invoice(
         chat_id=chat_id,
         title=f"Покупка {amount} запросов",
         description=f"Пополнение баланса на {amount} запросов к AI-ассистенту",
@@ -135,268 +372,852 @@ def create_invoice(chat_id, user_id, amount):
     )
 
 @bot.pre_checkout_query_handler(func=lambda query: True)
-def process_pre_checkout(pre_checkout_query):
+@instrument_handler('pre_checkout')
+async def process_pre_checkout(pre_checkout_query):
     """Обработка предварительной проверки платежа"""
-    bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
 
 @bot.message_handler(content_types=['successful_payment'])
-def process_successful_payment(message):
+@instrument_handler('payment')
+async def process_successful_payment(message):
     """Обработка успешного платежа"""
     payment_info = message.successful_payment
-    
+
     # Парсим payload для получения данных
     payload_parts = payment_info.invoice_payload.split('_')
     amount = int(payload_parts[1])
     user_id = int(payload_parts[2])
-    
+
     # Добавляем запись о платеже
-    db.add_payment(
+    await storage.add_payment(
         tg_id=user_id,
         amount=amount,
         stars_paid=amount,
         payment_id=payment_info.telegram_payment_charge_id
     )
-    
-    bot.send_message(
+
+    await outbound.send_message(
         message.chat.id,
         f"✅ Оплата прошла успешно! Ваш баланс пополнен на {amount} запросов."
     )
 
 @bot.message_handler(commands=['promo'])
-def promo_command(message):
+@instrument_handler('promo')
+async def promo_command(message):
     """Активация промокода"""
-    bot.send_message(message.chat.id, "🎁 Введите промокод:")
-    bot.register_next_step_handler(message, process_promo_code)
+    await outbound.send_message(message.chat.id, "🎁 Введите промокод:")
+    await bot.set_state(message.from_user.id, PromoStates.code, message.chat.id)
 
-def process_promo_code(message):
+@bot.message_handler(state=PromoStates.code)
+@instrument_handler('promo_code')
+async def process_promo_code(message):
     """Обработка введенного промокода"""
-    promo_code = message.text.strip().upper()
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    promo_code = normalize_code(message.text)
     user_id = message.from_user.id
-    
-    success, requests_added = db.use_promo_code(promo_code, user_id)
-    
+
+    verdict = await promo_guard.check(user_id, promo_code)
+    if verdict == 'throttled':
+        PROMO_ATTEMPTS.labels('throttled').inc()
+        await outbound.send_message(
+            message.chat.id,
+            "⏳ Слишком много попыток ввода промокода. Попробуйте через минуту."
+        )
+        return
+
+    if verdict == 'unknown':
+        # Кода точно нет среди активных: база не нужна
+        success, requests_added = False, 0
+        PROMO_ATTEMPTS.labels('filtered').inc()
+    else:
+        success, requests_added = await storage.use_promo_code(promo_code, user_id)
+        PROMO_ATTEMPTS.labels('redeemed' if success else 'rejected').inc()
+
     if success:
-        bot.send_message(
+        await outbound.send_message(
             message.chat.id,
             f"✅ Промокод активирован! Вам начислено {requests_added} запросов."
         )
     else:
-        bot.send_message(
+        await outbound.send_message(
             message.chat.id,
             "❌ Неверный промокод, либо он уже был использован."
         )
 
+@bot.message_handler(commands=['reset'])
+@instrument_handler('reset')
+async def reset_command(message):
+    """Сброс контекста диалога"""
+    if conversation_memory:
+        await conversation_memory.reset(message.from_user.id)
+    await outbound.send_message(message.chat.id, "🧹 Контекст диалога очищен. Начнем заново!")
+
 # Админские команды
 @bot.message_handler(commands=['stat'])
-def stat_command(message):
+@instrument_handler('stat')
+async def stat_command(message):
     """Статистика (только для админа)"""
-    if message.from_user.id != ADMIN_ID:
-        bot.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
         return
-    
-    users = db.get_all_users_stats()
-    total_users = len(users)
-    total_requests = sum(user['total_requests'] for user in users)
-    active_users = len([user for user in users if user['total_requests'] > 0])
-    
+
+    stats = await storage.get_bot_stats()
+    recent_users = await storage.get_recent_users(10)
+    daily_stats = await storage.get_daily_stats(7)
+
     stat_text = f"""
 📊 Статистика бота:
 
-👥 Пользователи: {total_users}
-📈 Активные: {active_users}
-💬 Всего запросов: {total_requests}
+👥 Пользователи: {stats['total_users']}
+📈 Активные: {stats['active_users']}
+💬 Всего запросов: {stats['total_requests']}
+🔤 Токенов: {stats['total_tokens']}
+⭐ Оплачено Stars: {stats['total_stars']} ({stats['total_payments']} платежей)
 
-📋 Последние пользователи:
+📅 По дням:
 """
-    
-    for user in users[:10]:  # Показываем последних 10 пользователей
+
+    for day in daily_stats:
+        stat_text += (
+            f"\n{day['day']}: 👥 +{day['new_users']} | 💬 {day['requests']} | "
+            f"🔤 {day['tokens']} | ⭐ {day['stars']}"
+        )
+
+    stat_text += "\n\n📋 Последние пользователи:\n"
+    for user in recent_users:
         username = user['username'] or f"{user['first_name']} {user['last_name'] or ''}"
         stat_text += f"\n👤 {username} | 💰 {user['balance']} | 📞 {user['total_requests']}"
-    
-    bot.send_message(message.chat.id, stat_text)
+
+    if response_cache:
+        cache_stats = response_cache.stats()
+        stat_text += (
+            f"\n\n🗄 Кэш ответов: {cache_stats['hit_ratio']:.0%} попаданий "
+            f"({cache_stats['hits'] + cache_stats['coalesced']} из "
+            f"{cache_stats['hits'] + cache_stats['coalesced'] + cache_stats['misses']})"
+        )
+
+    await outbound.send_message(message.chat.id, stat_text)
 
 @bot.message_handler(commands=['give'])
-def give_requests_command(message):
+@instrument_handler('give')
+async def give_requests_command(message):
     """Начисление запросов пользователю (админ)"""
-    if message.from_user.id != ADMIN_ID:
-        bot.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
         return
-    
-    bot.send_message(message.chat.id, "👤 Введите Telegram ID пользователя:")
-    bot.register_next_step_handler(message, process_give_user_id)
 
-def process_give_user_id(message):
+    await outbound.send_message(message.chat.id, "👤 Введите Telegram ID пользователя:")
+    await bot.set_state(message.from_user.id, GiveStates.user_id, message.chat.id)
+
+@bot.message_handler(state=GiveStates.user_id)
+@instrument_handler('give')
+async def process_give_user_id(message):
     """Обработка ID пользователя для начисления"""
     try:
         user_id = int(message.text.strip())
-        waiting_for_user_id[message.from_user.id] = user_id
-        
-        bot.send_message(message.chat.id, "💰 Введите количество запросов:")
-        bot.register_next_step_handler(message, process_give_amount)
+        await bot.set_state(message.from_user.id, GiveStates.amount, message.chat.id)
+        async with bot.retrieve_data(message.from_user.id, message.chat.id) as data:
+            data['user_id'] = user_id
+
+        await outbound.send_message(message.chat.id, "💰 Введите количество запросов:")
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат ID")
+        await bot.delete_state(message.from_user.id, message.chat.id)
+        await outbound.send_message(message.chat.id, "❌ Неверный формат ID")
 
-def process_give_amount(message):
+@bot.message_handler(state=GiveStates.amount)
+@instrument_handler('give')
+async def process_give_amount(message):
     """Обработка количества запросов для начисления"""
+    admin_id = message.from_user.id
+    async with bot.retrieve_data(admin_id, message.chat.id) as data:
+        user_id = data.get('user_id')
+    # Очищаем временные данные
+    await bot.delete_state(admin_id, message.chat.id)
+
     try:
         amount = int(message.text.strip())
-        admin_id = message.from_user.id
-        user_id = waiting_for_user_id.get(admin_id)
-        
+
         if user_id:
-            success = db.update_user_balance(user_id, amount)
+            success = await storage.update_user_balance(user_id, amount)
             if success:
-                bot.send_message(
+                await outbound.send_message(
                     message.chat.id,
                     f"✅ Пользователю {user_id} начислено {amount} запросов."
                 )
                 # Уведомляем пользователя
                 try:
-                    bot.send_message(
+                    await outbound.send_message(
                         user_id,
                         f"🎁 Вам начислено {amount} запросов администратором!"
                     )
-                except:
-                    pass  # Пользователь может не начать диалог с ботом
+                except ApiTelegramException as e:
+                    # Пользователь может не начать диалог с ботом или заблокировать его
+                    if is_blocked_error(e):
+                        await storage.set_user_blocked(user_id)
             else:
-                bot.send_message(message.chat.id, "❌ Ошибка начисления запросов.")
-            
-            # Очищаем временные данные
-            waiting_for_user_id.pop(admin_id, None)
+                await outbound.send_message(message.chat.id, "❌ Ошибка начисления запросов.")
         else:
-            bot.send_message(message.chat.id, "❌ Ошибка: данные не найдены.")
-            
+            await outbound.send_message(message.chat.id, "❌ Ошибка: данные не найдены.")
+
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат количества")
+        await outbound.send_message(message.chat.id, "❌ Неверный формат количества")
 
 @bot.message_handler(commands=['createpromo'])
-def create_promo_command(message):
+@instrument_handler('createpromo')
+async def create_promo_command(message):
     """Создание промокода (админ)"""
-    if message.from_user.id != ADMIN_ID:
-        bot.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
         return
-    
-    waiting_for_promo_data[message.from_user.id] = {}
-    bot.send_message(message.chat.id, "🏷️ Введите код промокода:")
-    bot.register_next_step_handler(message, process_promo_code_input)
 
-def process_promo_code_input(message):
+    await bot.set_state(message.from_user.id, CreatePromoStates.code, message.chat.id)
+    await outbound.send_message(message.chat.id, "🏷️ Введите код промокода:")
+
+@bot.message_handler(state=CreatePromoStates.code)
+@instrument_handler('createpromo')
+async def process_promo_code_input(message):
     """Обработка ввода кода промокода"""
-    code = message.text.strip().upper()
+    code = normalize_code(message.text)
     admin_id = message.from_user.id
-    
-    if admin_id in waiting_for_promo_data:
-        waiting_for_promo_data[admin_id]['code'] = code
-        bot.send_message(message.chat.id, "💰 Введите количество запросов для промокода:")
-        bot.register_next_step_handler(message, process_promo_requests)
 
-def process_promo_requests(message):
+    await bot.set_state(admin_id, CreatePromoStates.requests, message.chat.id)
+    async with bot.retrieve_data(admin_id, message.chat.id) as data:
+        data['code'] = code
+    await outbound.send_message(message.chat.id, "💰 Введите количество запросов для промокода:")
+
+@bot.message_handler(state=CreatePromoStates.requests)
+@instrument_handler('createpromo')
+async def process_promo_requests(message):
     """Обработка количества запросов для промокода"""
+    admin_id = message.from_user.id
     try:
         requests = int(message.text.strip())
-        admin_id = message.from_user.id
-        
-        if admin_id in waiting_for_promo_data:
-            waiting_for_promo_data[admin_id]['requests'] = requests
-            bot.send_message(
-                message.chat.id,
-                "🔢 Введите максимальное количество использований (0 - без лимита):"
-            )
-            bot.register_next_step_handler(message, process_promo_max_uses)
+
+        await bot.set_state(admin_id, CreatePromoStates.max_uses, message.chat.id)
+        async with bot.retrieve_data(admin_id, message.chat.id) as data:
+            data['requests'] = requests
+        await outbound.send_message(
+            message.chat.id,
+            "🔢 Введите максимальное количество использований (0 - без лимита):"
+        )
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат количества")
+        await bot.delete_state(admin_id, message.chat.id)
+        await outbound.send_message(message.chat.id, "❌ Неверный формат количества")
 
-def process_promo_max_uses(message):
+@bot.message_handler(state=CreatePromoStates.max_uses)
+@instrument_handler('createpromo')
+async def process_promo_max_uses(message):
     """Обработка максимального количества использований промокода"""
+    admin_id = message.from_user.id
+    async with bot.retrieve_data(admin_id, message.chat.id) as data:
+        promo_data = dict(data)
+    # Очищаем временные данные
+    await bot.delete_state(admin_id, message.chat.id)
+
     try:
         max_uses = int(message.text.strip())
-        admin_id = message.from_user.id
-        
-        if admin_id in waiting_for_promo_data:
-            promo_data = waiting_for_promo_data[admin_id]
-            
-            result = db.create_promo_code(
-                code=promo_data['code'],
-                requests=promo_data['requests'],
-                max_uses=max_uses if max_uses > 0 else None
+
+        result = await storage.create_promo_code(
+            code=promo_data['code'],
+            requests=promo_data['requests'],
+            max_uses=max_uses if max_uses > 0 else None
+        )
+
+        if result:
+            promo_index.add([promo_data['code']])
+            uses_text = "без лимита" if max_uses <= 0 else f"{max_uses} использований"
+            await outbound.send_message(
+                message.chat.id,
+                f"✅ Промокод создан!\n"
+                f"Код: {promo_data['code']}\n"
+                f"Запросов: {promo_data['requests']}\n"
+                f"Лимит: {uses_text}"
+            )
+        else:
+            await outbound.send_message(message.chat.id, "❌ Ошибка создания промокода.")
+
+    except ValueError:
+        await outbound.send_message(message.chat.id, "❌ Неверный формат количества")
+
+@bot.message_handler(commands=['createpromos'])
+@instrument_handler('createpromos')
+async def create_promos_command(message):
+    """Массовая генерация промокодов файлом: /createpromos <кол-во> <запросов> [лимит] [кампания] (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    args = message.text.split()[1:]
+    try:
+        count, requests = int(args[0]), int(args[1])
+        # По умолчанию каждый код кампании одноразовый
+        max_uses = int(args[2]) if len(args) > 2 else 1
+    except (IndexError, ValueError):
+        count = requests = max_uses = 0
+    campaign = args[3] if len(args) > 3 else datetime.now().strftime('promo-%Y%m%d-%H%M%S')
+
+    if (not 0 < count <= Config.PROMO_BATCH_MAX or requests <= 0 or max_uses < 0
+            or not is_valid_campaign_name(campaign)):
+        await outbound.send_message(
+            message.chat.id,
+            "❌ Использование: /createpromos <количество> <запросов> [лимит на код] [кампания]\n"
+            f"Количество - до {Config.PROMO_BATCH_MAX}, лимит 0 - без лимита (по умолчанию 1)\n"
+            "Кампания - до 64 латинских букв, цифр, _ и -\n"
+            "Пример: /createpromos 5000 10 1 spring"
+        )
+        return
+
+    if await storage.get_campaign_codes(campaign):
+        await outbound.send_message(message.chat.id, f"❌ Кампания {campaign} уже существует")
+        return
+
+    await outbound.send_message(message.chat.id, f"🏷️ Генерация {count} промокодов...")
+    try:
+        codes = await create_campaign(
+            storage, count, requests, max_uses or None, campaign, length=Config.PROMO_CODE_LENGTH
+        )
+    except Exception as e:
+        logging.error(f"Ошибка генерации промокодов кампании {campaign}: {e}")
+        await outbound.send_message(message.chat.id, "❌ Ошибка генерации промокодов.")
+        return
+    promo_index.add(codes)
+
+    with tempfile.TemporaryDirectory(prefix="bot-promo-") as directory:
+        file_name = f"{campaign}.csv"
+        path = os.path.join(directory, file_name)
+        await asyncio.to_thread(write_codes_file, path, codes, requests, max_uses or None)
+        with open(path, 'rb') as document:
+            await bot.send_document(
+                message.chat.id,
+                document,
+                visible_file_name=file_name,
+                caption=f"✅ Кампания {campaign}: {len(codes)} кодов по {requests} запросов"
             )
-            
-            if result:
-                uses_text = "без лимита" if max_uses <= 0 else f"{max_uses} использований"
-                bot.send_message(
+
+@bot.message_handler(commands=['broadcast'])
+@instrument_handler('broadcast')
+async def broadcast_command(message):
+    """Рассылка сообщения всем пользователям (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    await bot.set_state(message.from_user.id, BroadcastStates.text, message.chat.id)
+    await outbound.send_message(message.chat.id, "📣 Введите текст рассылки:")
+
+@bot.message_handler(state=BroadcastStates.text)
+@instrument_handler('broadcast')
+async def process_broadcast_text(message):
+    """Запуск рассылки с введенным текстом"""
+    await bot.delete_state(message.from_user.id, message.chat.id)
+    text = (message.text or '').strip()
+    if not text:
+        await outbound.send_message(message.chat.id, "❌ Текст рассылки пуст")
+        return
+
+    broadcast_id = await broadcaster.start(text, message.from_user.id)
+    await outbound.send_message(
+        message.chat.id,
+        f"📣 Рассылка #{broadcast_id} запущена. Остановить: /broadcast_stop {broadcast_id}"
+    )
+
+@bot.message_handler(commands=['broadcast_stop'])
+@instrument_handler('broadcast')
+async def broadcast_stop_command(message):
+    """Остановка рассылки (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    try:
+        broadcast_id = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        await outbound.send_message(message.chat.id, "❌ Укажите номер рассылки: /broadcast_stop 1")
+        return
+
+    if await broadcaster.cancel(broadcast_id):
+        await outbound.send_message(message.chat.id, f"⏹ Рассылка #{broadcast_id} остановлена")
+    else:
+        await outbound.send_message(message.chat.id, f"❌ Рассылка #{broadcast_id} не выполняется")
+
+@bot.message_handler(commands=['retention'])
+@instrument_handler('retention')
+async def retention_command(message):
+    """Внеочередное обслуживание журнала запросов с отчетом (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    if not retention:
+        await outbound.send_message(message.chat.id, "❌ Обслуживание журнала отключено")
+        return
+
+    await outbound.send_message(message.chat.id, "🧹 Обслуживание журнала запущено...")
+    try:
+        report = await run_retention()
+    except Exception as e:
+        logging.error(f"Ошибка обслуживания журнала запросов: {e}")
+        await outbound.send_message(message.chat.id, "❌ Ошибка обслуживания журнала")
+        return
+    await outbound.send_message(message.chat.id, format_report(report))
+
+@bot.message_handler(commands=['export'])
+@instrument_handler('export')
+async def export_command(message):
+    """Выгрузка таблицы файлом: /export <таблица> [формат] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    args = message.text.split()[1:]
+    table_name = args[0] if args else None
+    export_format = args[1] if len(args) > 1 else 'csv'
+    if table_name not in EXPORT_TABLES or export_format not in EXPORT_WRITERS:
+        await outbound.send_message(
+            message.chat.id,
+            "❌ Использование: /export <таблица> [формат] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД]\n"
+            f"Таблицы: {', '.join(EXPORT_TABLES)}\n"
+            f"Форматы: {', '.join(EXPORT_WRITERS)}\n"
+            "Пример: /export requests parquet 2024-01-01 2024-01-31"
+        )
+        return
+
+    since_arg = args[2] if len(args) > 2 else None
+    until_arg = args[3] if len(args) > 3 else None
+    try:
+        since, until = parse_date_range(since_arg, until_arg)
+    except ValueError:
+        await outbound.send_message(
+            message.chat.id, "❌ Неверный период: даты в формате ГГГГ-ММ-ДД, начало не позже конца"
+        )
+        return
+
+    if export_lock.locked():
+        await outbound.send_message(message.chat.id, "⏳ Другая выгрузка еще выполняется")
+        return
+
+    async with export_lock:
+        await outbound.send_message(message.chat.id, f"📦 Выгрузка {table_name} началась...")
+        with tempfile.TemporaryDirectory(prefix="bot-export-") as directory:
+            file_name = export_file_name(table_name, export_format, since_arg, until_arg)
+            path = os.path.join(directory, file_name)
+            try:
+                exported = await export_table(
+                    storage, table_name, export_format, path, since, until,
+                    archive_dir=Config.ARCHIVE_DIR
+                )
+            except Exception as e:
+                logging.error(f"Ошибка выгрузки {table_name}: {e}")
+                await outbound.send_message(message.chat.id, f"❌ Ошибка выгрузки: {e}")
+                return
+
+            size = os.path.getsize(path)
+            if size > MAX_DOCUMENT_SIZE:
+                await outbound.send_message(
                     message.chat.id,
-                    f"✅ Промокод создан!\n"
-                    f"Код: {promo_data['code']}\n"
-                    f"Запросов: {promo_data['requests']}\n"
-                    f"Лимит: {uses_text}"
+                    f"❌ Файл слишком большой для Telegram ({size // (1024 * 1024)} МБ). "
+                    "Сузьте период или используйте python export.py на сервере."
+                )
+                return
+
+            with open(path, 'rb') as document:
+                await bot.send_document(
+                    message.chat.id,
+                    document,
+                    visible_file_name=file_name,
+                    caption=f"📦 {table_name}: {exported} строк"
+                )
+
+@bot.message_handler(commands=['profile'])
+@instrument_handler('profile')
+async def profile_command(message):
+    """Профилирование работающего бота: /profile <секунд> [sample|cprofile] (админ)"""
+    if message.from_user.id != Config.ADMIN_ID:
+        await outbound.send_message(message.chat.id, "⛔ У вас нет прав для этой команды.")
+        return
+
+    args = message.text.split()[1:]
+    try:
+        seconds = float(args[0])
+    except (IndexError, ValueError):
+        seconds = 0
+    mode = args[1] if len(args) > 1 else 'sample'
+    if not 0 < seconds <= Config.PROFILE_MAX_SECONDS or mode not in PROFILE_MODES:
+        await outbound.send_message(
+            message.chat.id,
+            "❌ Использование: /profile <секунд> [sample|cprofile]\n"
+            f"Длительность - до {Config.PROFILE_MAX_SECONDS} с\n"
+            "sample - выборка стеков всех потоков, файл для flamegraph;\n"
+            "cprofile - точный профиль потока цикла событий, файл pstats\n"
+            "Пример: /profile 30"
+        )
+        return
+
+    if profile_lock.locked():
+        await outbound.send_message(message.chat.id, "⏳ Профилирование уже выполняется")
+        return
+
+    async with profile_lock:
+        await outbound.send_message(message.chat.id, f"🔬 Профилирование ({mode}) на {seconds:g} с...")
+        with tempfile.TemporaryDirectory(prefix="bot-profile-") as directory:
+            try:
+                path, report = await run_profile(
+                    mode, seconds, directory, interval=Config.PROFILE_SAMPLE_INTERVAL_MS / 1000
+                )
+            except Exception as e:
+                logging.error(f"Ошибка профилирования: {e}")
+                await outbound.send_message(message.chat.id, f"❌ Ошибка профилирования: {e}")
+                return
+
+            await outbound.send_message(message.chat.id, report[:MAX_MESSAGE_LENGTH])
+            with open(path, 'rb') as document:
+                await bot.send_document(
+                    message.chat.id,
+                    document,
+                    visible_file_name=datetime.now().strftime(f'%Y%m%d-%H%M%S-{os.path.basename(path)}')
                 )
-            else:
-                bot.send_message(message.chat.id, "❌ Ошибка создания промокода.")
-            
-            # Очищаем временные данные
-            waiting_for_promo_data.pop(admin_id, None)
-            
-    except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат количества")
 
 # Обработка текстовых сообщений (запросов к AI)
+async def request_completion(messages, route):
+    """Получение ответа OpenAI одним запросом"""
+    completion = await llm.complete(messages, temperature=TEMPERATURE, route=route)
+    return completion.text, completion.tokens_used
+
+async def stream_completion(chat_id, message_id, messages, route):
+    """Потоковое получение ответа OpenAI с периодическим обновлением сообщения"""
+    stream = await llm.stream(messages, temperature=TEMPERATURE, route=route)
+    try:
+        parts = await show_stream(chat_id, message_id, stream)
+    finally:
+        await stream.close()
+    return "".join(parts), stream.tokens_used
+
+async def show_stream(chat_id, message_id, stream):
+    """Показ фрагментов ответа правками сообщения не чаще STREAM_EDIT_INTERVAL"""
+    parts = []
+    shown_text = ""
+    next_edit_at = 0.0  # Первые токены показываем сразу
+
+    async for content in stream:
+        parts.append(content)
+        now = time.monotonic()
+        if now < next_edit_at:
+            continue
+
+        text = "".join(parts)[:MAX_MESSAGE_LENGTH - 2].strip()
+        if text == shown_text:
+            continue
+
+        next_edit_at = now + Config.STREAM_EDIT_INTERVAL
+        # Не ждем отправки: если Telegram притормозит, неотправленную правку
+        # заменит следующая, а чтение ответа OpenAI не остановится
+        outbound.edit_message_text_nowait(f"{text} ▌", chat_id=chat_id, message_id=message_id)
+        shown_text = text
+
+    return parts
+
+async def deliver_answer(chat_id, message_id, text):
+    """Ответ правкой сообщения «Обрабатываю»; длинный ответ или неудавшаяся правка - новыми сообщениями"""
+    parts = split_text(text, MAX_MESSAGE_LENGTH)
+    try:
+        await outbound.edit_message_text(text=parts[0], chat_id=chat_id, message_id=message_id)
+        parts = parts[1:]
+    except Exception as e:
+        # Пользователь удалил сообщение «Обрабатываю» или Telegram недоступен
+        # дольше всех повторов: ответ целиком уходит новыми сообщениями
+        logging.warning(f"Не удалось показать ответ правкой, отправляем заново: {e}")
+
+    try:
+        for part in parts:
+            await outbound.send_message(chat_id, part)
+    except Exception as e:
+        logging.error(f"Оплаченный ответ не доставлен в чат {chat_id}: {e}")
+
 @bot.message_handler(content_types=['text'])
-def handle_text_message(message):
-    """Обработка текстовых сообщений (запросов к AI)"""
+async def handle_text_message(message):
+    """Обработка текстовых сообщений: проверки и резерв, затем запрос к AI отдельной задачей"""
     user_id = message.from_user.id
     user_text = message.text.strip()
-    
-    # Проверяем баланс
-    balance = db.get_user_balance(user_id)
-    if balance <= 0:
-        bot.send_message(
+
+    # Слишком частые запросы отклоняем сразу, не расходуя баланс
+    if not user_limiter.allow(user_id):
+        await outbound.send_message(
+            message.chat.id,
+            "🐢 Слишком много запросов подряд. Подождите немного и повторите."
+        )
+        return
+
+    # Резервируем запрос: проверка и списание баланса одной атомарной операцией
+    with stage('balance_reserve'):
+        hold_id, balance = await storage.reserve_request(user_id, Config.BALANCE_HOLD_TTL)
+    if hold_id is None:
+        await outbound.send_message(
             message.chat.id,
             "❌ Недостаточно запросов. Пополните баланс: /buy\n"
             "🎁 Или используйте промокод: /promo"
         )
         return
-    
-    # Отправляем сообщение о обработке
-    processing_msg = bot.send_message(message.chat.id, "⏳ Обрабатываю запрос...")
-    
+
+    # Обработчик обновления на этом завершается: очередь вебхука не ждет ответа AI,
+    # а остановка бота дожидается задачи вместе с обработчиками
+    lifecycle.spawn(answer_ai_request(message, user_text, hold_id, balance))
+
+@instrument_handler('text')
+async def answer_ai_request(message, user_text: str, hold_id: int, balance: int):
+    """Запрос к AI по зарезервированному запросу, подтверждение списания и доставка ответа"""
+    user_id = message.from_user.id
+    processing_msg = None
+    committing = False
+
+    async def compute():
+        # Отправляем запрос к OpenAI в порядке справедливой очереди
+        estimated_tokens = route.prompt_tokens + route.max_tokens
+        queued_at = time.perf_counter()
+        # Ожидание ограничено, чтобы резерв баланса не истек раньше ответа
+        async with ai_scheduler.slot(user_id, estimated_tokens, timeout=Config.AI_QUEUE_TIMEOUT) as slot:
+            STAGE_LATENCY.labels('openai_queue').observe(time.perf_counter() - queued_at)
+            # При потоковой выдаче сюда входят и промежуточные правки сообщения
+            with stage('openai_call'):
+                if Config.STREAM_RESPONSES:
+                    result = await stream_completion(
+                        message.chat.id, processing_msg.message_id, messages, route
+                    )
+                else:
+                    result = await request_completion(messages, route)
+            slot.tokens_used = result[1]
+            OPENAI_TOKENS.labels('answer').inc(result[1])
+            return result
+
     try:
-        # Отправляем запрос к OpenAI
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Ты полезный AI-ассистент. Отвечай понятно и подробно."},
-                {"role": "user", "content": user_text}
-            ],
-            max_tokens=1000,
-            temperature=0.7
+        # Отправляем сообщение о обработке
+        processing_text = (
+            "⏳ Запрос в очереди, ответ скоро будет..."
+            if ai_scheduler.is_saturated() else "⏳ Обрабатываю запрос..."
         )
-        
-        ai_response = response.choices[0].message.content
-        tokens_used = response.usage.total_tokens
-        
-        # Сохраняем запрос в базу и уменьшаем баланс
-        db.add_request(user_id, user_text, ai_response, tokens_used)
-        
-        # Отправляем ответ пользователю
-        bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=processing_msg.message_id,
-            text=f"{ai_response}\n\n💫 Осталось запросов: {balance - 1}"
-        )
-        
+        with stage('placeholder_send'):
+            processing_msg = await outbound.send_message(message.chat.id, processing_text)
+
+        # Контекст диалога: резюме и последние реплики в пределах бюджета токенов
+        with stage('context_load'):
+            history = await conversation_memory.get_context(user_id) if conversation_memory else []
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            *history,
+            {"role": "user", "content": user_text}
+        ]
+        route = llm.route(messages)
+
+        if response_cache and not history:
+            # Ответ из кэша не расходует токены OpenAI, но списывает запрос с баланса
+            ai_response, tokens_used, _ = await response_cache.get_or_compute(
+                user_text, route.model, SYSTEM_PROMPT, TEMPERATURE, compute
+            )
+        else:
+            ai_response, tokens_used = await compute()
+
+        # Подтверждаем списание и сохраняем запрос
+        committing = True
+        with stage('commit_request'):
+            held = await storage.commit_request(hold_id, user_id, user_text, ai_response, tokens_used)
+        if not held:
+            # Резерв уже вернули: запрос списан заново, только если хватило баланса
+            BALANCE_HOLDS_EXPIRED.inc()
+            logging.warning(f"Резерв {hold_id} пользователя {user_id} истек до подтверждения ответа")
+
+    except asyncio.CancelledError:
+        # Остановка бота не дождалась ответа: запрос не списываем. Если подтверждение
+        # уже началось, оно завершится в потоке базы и возвращать резерв нельзя
+        if not committing:
+            await storage.release_request(hold_id)
+            if processing_msg:
+                await outbound.edit_message_text(
+                    chat_id=message.chat.id,
+                    message_id=processing_msg.message_id,
+                    text="🔄 Бот перезапускается. Запрос не списан, повторите его через минуту."
+                )
+        raise
+
     except Exception as e:
+        HANDLER_ERRORS.labels('text').inc()
         logging.error(f"Ошибка OpenAI: {e}")
-        bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=processing_msg.message_id,
-            text="❌ Произошла ошибка при обработке запроса. Попробуйте позже."
+        # Запрос не выполнен: возвращаем резерв на баланс
+        await storage.release_request(hold_id)
+        if processing_msg:
+            error_text = (
+                "⏳ AI не ответил вовремя. Запрос не списан, попробуйте еще раз."
+                if isinstance(e, (LLMTimeoutError, SchedulerTimeout))
+                else "❌ Произошла ошибка при обработке запроса. Попробуйте позже."
+            )
+            try:
+                await outbound.edit_message_text(
+                    chat_id=message.chat.id,
+                    message_id=processing_msg.message_id,
+                    text=error_text
+                )
+            except Exception as e:
+                logging.error(f"Не удалось сообщить об ошибке: {e}")
+        return
+
+    # Запрос оплачен: ошибки после подтверждения не должны приводить к возврату резерва
+    if conversation_memory:
+        try:
+            await conversation_memory.add_turn(user_id, user_text, ai_response)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения реплики диалога: {e}")
+
+    with stage('final_edit'):
+        await deliver_answer(
+            message.chat.id, processing_msg.message_id,
+            f"{ai_response}\n\n💫 Осталось запросов: {balance}"
         )
 
+async def reclaim_holds_periodically():
+    """Возврат на баланс резервов, брошенных упавшими или зависшими обработчиками"""
+    while True:
+        try:
+            reclaimed = await storage.reclaim_expired_holds()
+            if reclaimed:
+                logging.warning(f"Возвращено просроченных резервов баланса: {reclaimed}")
+        except Exception as e:
+            logging.error(f"Ошибка возврата резервов баланса: {e}")
+        await asyncio.sleep(Config.HOLD_RECLAIM_INTERVAL)
+
+async def refresh_promo_index_periodically():
+    """Перестроение индекса промокодов: новые коды других процессов, исчерпанные коды"""
+    while True:
+        try:
+            await promo_index.refresh(storage)
+        except Exception as e:
+            logging.error(f"Ошибка перестроения индекса промокодов: {e}")
+        await asyncio.sleep(Config.PROMO_INDEX_REFRESH_INTERVAL)
+
+async def run_retention():
+    """Один проход обслуживания журнала; параллельные проходы не запускаются"""
+    async with retention_lock:
+        return await asyncio.to_thread(retention.run)
+
+async def retention_periodically():
+    """Периодическое сжатие, архивирование и VACUUM журнала запросов"""
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logging.error(f"Ошибка обслуживания журнала запросов: {e}")
+        await asyncio.sleep(Config.RETENTION_INTERVAL)
+
+async def run_polling():
+    """Получение обновлений long polling до начала остановки"""
+    # Telegram не отдает обновления через getUpdates, пока установлен вебхук
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=Config.POLLING_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(3)
+                continue
+            if updates:
+                offset = updates[-1].update_id + 1
+                asyncio.create_task(bot.process_new_updates(updates))
+    finally:
+        if offset is not None:
+            # Подтверждаем полученные обновления, чтобы следующий процесс не обработал их повторно
+            try:
+                await bot.get_updates(offset=offset, limit=1, timeout=0)
+            except Exception as e:
+                logging.error(f"Ошибка подтверждения обновлений: {e}")
+
+async def start_webhook():
+    """Прием обновлений через вебхук"""
+    server = WebhookServer(
+        bot,
+        path=Config.WEBHOOK_PATH,
+        secret_token=Config.WEBHOOK_SECRET,
+        workers=Config.WEBHOOK_WORKERS,
+        queue_size=Config.WEBHOOK_QUEUE_SIZE
+    )
+    await server.start(Config.WEBHOOK_HOST, Config.WEBHOOK_PORT)
+    await bot.set_webhook(
+        url=Config.WEBHOOK_URL,
+        secret_token=Config.WEBHOOK_SECRET,
+        max_connections=Config.WEBHOOK_MAX_CONNECTIONS
+    )
+    return server
+
+async def main():
+    """Запуск бота в выбранном режиме и плавная остановка по SIGTERM"""
+    # Конфигурация проверяется до создания компонентов: ошибка не оставит открытой базы
+    Config.validate()
+    logging.info("Бот запускается...")
+    setup()
+    lifecycle.install_signal_handlers()
+    # Метрики поднимаются первыми: /readyz отвечает 503, пока бот запускается
+    metrics_server = MetricsServer(readiness=lambda: lifecycle.ready) if Config.METRICS_ENABLED else None
+    if metrics_server:
+        await metrics_server.start(Config.METRICS_HOST, Config.METRICS_PORT)
+
+    background = []
+    webhook_server = None
+    polling_task = None
+    try:
+        await storage.connect()
+        background.append(asyncio.create_task(reclaim_holds_periodically()))
+        background.append(asyncio.create_task(broadcaster.supervise()))
+        if retention:
+            background.append(asyncio.create_task(retention_periodically()))
+        if Config.PROMO_INDEX_ENABLED:
+            background.append(asyncio.create_task(refresh_promo_index_periodically()))
+
+        if Config.RUN_MODE == 'webhook':
+            webhook_server = await start_webhook()
+        else:
+            polling_task = asyncio.create_task(run_polling())
+        lifecycle.set_ready()
+        await lifecycle.wait_stop()
+    finally:
+        # Остановка по сигналу уже отмечена; здесь - выход из-за ошибки запуска
+        lifecycle.request_stop("ошибка")
+        deadline = asyncio.get_running_loop().time() + lifecycle.drain_timeout
+
+        # Прекращаем прием обновлений; вебхук сначала разбирает свою очередь
+        if polling_task:
+            polling_task.cancel()
+            await asyncio.gather(polling_task, return_exceptions=True)
+        if webhook_server:
+            await webhook_server.stop(timeout=lifecycle.drain_timeout)
+
+        # Дожидаемся начатых обработчиков; оставшиеся отменяются с возвратом резерва
+        remaining = max(0.0, deadline - asyncio.get_running_loop().time())
+        finished, abandoned = await lifecycle.drain(remaining)
+
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        await broadcaster.stop()
+        if response_cache:
+            # Записываем накопленные попадания в кэш ответов, пока пул открыт
+            try:
+                await asyncio.to_thread(response_cache.flush)
+            except Exception as e:
+                logging.error(f"Ошибка записи статистики кэша ответов: {e}")
+        # Сбрасываем отложенные записи журнала запросов
+        await storage.close()
+        if not isinstance(storage, SQLiteStorage):
+            local_pool.close()
+        await llm.close()
+        # Досылаем ответы и правки, оставшиеся в очереди
+        await outbound.close()
+        await bot.close_session()
+        if metrics_server:
+            await metrics_server.stop()
+        logging.info(f"Бот остановлен: завершено пакетов обновлений {finished}, отменено {abandoned}")
+
 if __name__ == "__main__":
-    # Проверяем конфигурацию
     try:
-        Config.validate()
-        logging.info("Бот запускается...")
-        bot.infinity_polling()
+        asyncio.run(main())
     except Exception as e:
         logging.error(f"Ошибка запуска бота: {e}")
+        # Ненулевой код: оркестратор увидит сбой и перезапустит процесс
+        sys.exit(1)
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+from outbound import OutboundDispatcher, is_retryable, retry_after
+from ratelimit import TokenBucket
+from storage import Storage
+
+# Сколько раз повторять отправку одному получателю при сетевых ошибках и 429
+MAX_SEND_ATTEMPTS = 5
+
+# Ответы Telegram, после которых писать пользователю бессмысленно
+BLOCKED_DESCRIPTIONS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+    "bot can't initiate conversation",
+)
+
+
+def is_blocked_error(error: ApiTelegramException) -> bool:
+    """Пользователь заблокировал бота или удалил аккаунт"""
+    description = (error.description or '').lower()
+    return error.error_code == 403 or any(text in description for text in BLOCKED_DESCRIPTIONS)
+
+
+class BroadcastJob:
+    """Выполняемая рассылка: позиция и счетчики"""
+
+    def __init__(self, record: Dict):
+        self.id = record['id']
+        self.text = record['text']
+        self.created_by = record['created_by']
+        self.total = record['total']
+        self.last_tg_id = record['last_tg_id']
+        self.sent = record['sent']
+        self.blocked = record['blocked']
+        self.failed = record['failed']
+        self.started_at = time.monotonic()
+        self.sent_at_start = self.sent
+        self.progress_message_id: Optional[int] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    @property
+    def rate(self) -> float:
+        """Скорость отправки в этом запуске, сообщений в секунду"""
+        elapsed = time.monotonic() - self.started_at
+        return (self.sent - self.sent_at_start) / elapsed if elapsed > 0 else 0.0
+
+
+class Broadcaster:
+    """Рассылка сообщений всем пользователям в пределах лимитов Telegram.
+
+    Получатели читаются из базы страницами по tg_id; после каждой страницы
+    позиция сохраняется, так что после перезапуска рассылка продолжается
+    с места остановки (сообщения незавершенной страницы могут уйти повторно).
+    Рассылку, позиция которой не обновлялась stale_after секунд, подхватывает
+    первый запустившийся процесс бота.
+
+    Сообщения рассылки занимают места в общем темпе outbound с наименьшим
+    приоритетом, так что вместе с ответами бот не превышает лимит Telegram.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, storage: Storage, outbound: OutboundDispatcher,
+                 rate: float = 25,
+                 concurrency: int = 10, page_size: int = 500, progress_interval: float = 30,
+                 stale_after: int = 300):
+        self.bot = bot
+        self.storage = storage
+        self.outbound = outbound
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self.stale_after = stale_after
+        # Верхняя граница темпа рассылок: равномерно, без всплесков
+        self._bucket = TokenBucket(rate, 1)
+        self._paused_until = 0.0
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self, text: str, created_by: int) -> int:
+        """Создание и запуск новой рассылки"""
+        total = await self.storage.count_broadcast_recipients()
+        broadcast_id = await self.storage.create_broadcast(text, created_by, total)
+        self._launch(await self.storage.get_broadcast(broadcast_id))
+        return broadcast_id
+
+    async def resume(self) -> int:
+        """Продолжение брошенных рассылок (после перезапуска или падения процесса)"""
+        resumed = 0
+        for record in await self.storage.get_running_broadcasts():
+            if record['id'] in self._tasks:
+                continue
+            # Захват атомарный: рассылку продолжит только один процесс
+            record = await self.storage.claim_broadcast(record['id'], self.stale_after)
+            if record:
+                logging.info(f"Продолжение рассылки #{record['id']} после tg_id {record['last_tg_id']}")
+                self._launch(record)
+                resumed += 1
+        return resumed
+
+    async def supervise(self) -> None:
+        """Периодический подхват брошенных рассылок"""
+        while True:
+            try:
+                await self.resume()
+            except Exception as e:
+                logging.error(f"Ошибка продолжения рассылок: {e}")
+            await asyncio.sleep(self.stale_after / 2)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Остановка рассылки (в том числе выполняемой другим процессом)"""
+        cancelled = await self.storage.cancel_broadcast(broadcast_id)
+        task = self._tasks.get(broadcast_id)
+        if task:
+            task.cancel()
+        return cancelled
+
+    async def stop(self) -> None:
+        """Остановка рассылок этого процесса при завершении; позиция уже сохранена"""
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def _launch(self, record: Dict) -> None:
+        job = BroadcastJob(record)
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    async def _pace(self) -> None:
+        """Ожидание своей очереди в темпе рассылок и в общем темпе бота"""
+        while True:
+            delay = max(self._paused_until - time.monotonic(), self._bucket.wait_time())
+            if delay <= 0:
+                self._bucket.try_consume()
+                break
+            await asyncio.sleep(delay)
+        await self.outbound.acquire_bulk()
+
+    async def _send(self, job: BroadcastJob, tg_id: int) -> None:
+        """Отправка одному получателю с учетом retry_after.
+
+        Повторяются только ошибки, при которых сообщение точно не принято;
+        после таймаута или обрыва получатель считается неудачным, чтобы не
+        отправить ему рассылку дважды.
+        """
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            await self._pace()
+            try:
+                await self.bot.send_message(tg_id, job.text)
+                job.sent += 1
+                return
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Притормаживаем все рассылки, а не только этот запрос
+                    pause = retry_after(e) or 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                    self.outbound.pause(pause)
+                    logging.warning(f"Рассылка #{job.id}: 429, пауза {pause} с")
+                    continue
+                if is_blocked_error(e):
+                    job.blocked += 1
+                    await self.storage.set_user_blocked(tg_id)
+                    return
+                error = e
+            except Exception as e:
+                error = e
+
+            if not is_retryable('send_message', error):
+                logging.warning(f"Рассылка #{job.id}: не удалось отправить {tg_id}: {error}")
+                job.failed += 1
+                return
+            logging.warning(f"Рассылка #{job.id}: ошибка отправки {tg_id}, повтор: {error}")
+            await asyncio.sleep(2 ** attempt)
+
+        job.failed += 1
+
+    async def _run(self, job: BroadcastJob) -> None:
+        """Обход получателей страницами с сохранением позиции"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending: Set[asyncio.Task] = set()
+        reported_at = time.monotonic()
+
+        async def send(tg_id: int) -> None:
+            try:
+                await self._send(job, tg_id)
+            finally:
+                semaphore.release()
+
+        try:
+            while True:
+                page = await self.storage.get_broadcast_recipients(job.last_tg_id, self.page_size)
+                if not page:
+                    break
+
+                for tg_id in page:
+                    await semaphore.acquire()
+                    task = asyncio.create_task(send(tg_id))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                await asyncio.gather(*pending)
+
+                job.last_tg_id = page[-1]
+                running = await self.storage.save_broadcast_progress(
+                    job.id, job.last_tg_id, job.sent, job.blocked, job.failed
+                )
+                if not running:
+                    logging.info(f"Рассылка #{job.id} остановлена")
+                    await self._report(job, "⏹ Рассылка остановлена")
+                    return
+
+                if time.monotonic() - reported_at >= self.progress_interval:
+                    reported_at = time.monotonic()
+                    await self._report(job, "📣 Рассылка идет")
+
+            await self.storage.save_broadcast_progress(
+                job.id, job.last_tg_id, job.sent, job.blocked, job.failed, status='done'
+            )
+            logging.info(f"Рассылка #{job.id} завершена: отправлено {job.sent}")
+            await self._report(job, "✅ Рассылка завершена")
+        except asyncio.CancelledError:
+            for task in pending:
+                task.cancel()
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка рассылки #{job.id}: {e}")
+
+    async def _report(self, job: BroadcastJob, title: str) -> None:
+        """Сообщение о ходе рассылки администратору"""
+        progress = job.processed / job.total if job.total else 1.0
+        text = (
+            f"{title} #{job.id}\n\n"
+            f"📤 Отправлено: {job.sent}\n"
+            f"🚫 Заблокировали бота: {job.blocked}\n"
+            f"⚠️ Ошибок: {job.failed}\n"
+            f"📊 Обработано: {job.processed} из {job.total} ({progress:.0%}), "
+            f"{job.rate:.1f} сообщ./с"
+        )
+        try:
+            if job.progress_message_id:
+                await self.outbound.edit_message_text(
+                    text, chat_id=job.created_by, message_id=job.progress_message_id
+                )
+            else:
+                message = await self.outbound.send_message(job.created_by, text)
+                job.progress_message_id = message.message_id
+        except Exception as e:
+            logging.warning(f"Не удалось отправить прогресс рассылки #{job.id}: {e}")
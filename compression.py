@@ -0,0 +1,66 @@
+import zlib
+from typing import Optional, Union
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен, без него используется zlib
+    zstandard = None
+
+# Сигнатуры сжатых данных: кадр zstd и заголовки zlib с разными уровнями сжатия
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZLIB_HEADERS = (b'\x78\x01', b'\x78\x5e', b'\x78\x9c', b'\x78\xda')
+
+# Короткие тексты не сжимаются: выигрыш меньше накладных расходов
+MIN_COMPRESS_SIZE = 256
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+StoredText = Union[str, bytes]
+
+
+class TextCompressor:
+    """Прозрачное сжатие текстов для хранения в BLOB.
+
+    Сжатые значения хранятся как bytes, несжатые - как str, поэтому старые
+    строки читаются без миграции. Формат определяется по сигнатуре, так что
+    смена алгоритма не требует пересжатия уже записанных данных.
+    """
+
+    def __init__(self, algorithm: str = 'zlib', min_size: int = MIN_COMPRESS_SIZE):
+        if algorithm == 'zstd' and zstandard is None:
+            raise RuntimeError("Для сжатия zstd установите пакет zstandard")
+        if algorithm not in ('zlib', 'zstd', 'none'):
+            raise ValueError(f"Неизвестный алгоритм сжатия: {algorithm}")
+        self.algorithm = algorithm
+        self.min_size = min_size
+        self._zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if algorithm == 'zstd' else None
+
+    def compress(self, text: Optional[str]) -> Optional[StoredText]:
+        """Сжатый текст или исходная строка, если сжатие не дает выигрыша"""
+        if text is None or self.algorithm == 'none':
+            return text
+        raw = text.encode('utf-8')
+        if len(raw) < self.min_size:
+            return text
+
+        if self._zstd is not None:
+            packed = self._zstd.compress(raw)
+        else:
+            packed = zlib.compress(raw, ZLIB_LEVEL)
+        return packed if len(packed) < len(raw) else text
+
+
+def decompress_text(value: Optional[StoredText]) -> Optional[str]:
+    """Исходный текст из значения, записанного TextCompressor"""
+    if value is None or isinstance(value, str):
+        return value
+
+    value = bytes(value)
+    if value.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Текст сжат zstd: установите пакет zstandard")
+        return zstandard.ZstdDecompressor().decompress(value).decode('utf-8')
+    if value[:2] in ZLIB_HEADERS:
+        return zlib.decompress(value).decode('utf-8')
+    # BLOB без сигнатуры - несжатый текст
+    return value.decode('utf-8')
@@ -3,9 +3,196 @@ from dotenv import load_dotenv
 
 load_dotenv()  # Загружает переменные из .env
 
+# Нечисловые значения не роняют импорт: берется значение по умолчанию,
+# а ошибку перечисляет Config.validate()
+parse_errors = []
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name, '').strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        parse_errors.append(f"{name} должен быть целым числом, получено {value!r}")
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name, '').strip()
+    if not value:
+        return float(default)
+    try:
+        return float(value)
+    except ValueError:
+        parse_errors.append(f"{name} должен быть числом, получено {value!r}")
+        return float(default)
+
+
 class Config:
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY') 
-    ADMIN_ID = int(os.getenv('ADMIN_ID'))
-    DATABASE_NAME = "bot_database.db"
+    # Пустое или нечисловое значение не роняет импорт: его отклонит validate()
+    ADMIN_ID = int(os.getenv('ADMIN_ID', '').strip()) if os.getenv('ADMIN_ID', '').strip().isdigit() else 0
+    DATABASE_NAME = os.getenv('DATABASE_NAME', "bot_database.db")
     DEFAULT_FREE_REQUESTS = 3
+    # Максимальное число одновременных запросов к OpenAI
+    MAX_CONCURRENT_AI_REQUESTS = env_int('MAX_CONCURRENT_AI_REQUESTS', 20)
+    # Потоковая выдача ответов и минимальный интервал между правками сообщения (сек)
+    STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+    STREAM_EDIT_INTERVAL = env_float('STREAM_EDIT_INTERVAL', 1.5)
+    # Размер пула соединений SQLite
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 8)
+    # Пакетная запись журнала запросов: размер пакета и интервал сброса (сек)
+    REQUEST_LOG_BATCH_SIZE = env_int('REQUEST_LOG_BATCH_SIZE', 100)
+    REQUEST_LOG_FLUSH_INTERVAL = env_float('REQUEST_LOG_FLUSH_INTERVAL', 2.0)
+    # Размер LRU-кэша записей пользователей
+    USER_CACHE_SIZE = env_int('USER_CACHE_SIZE', 10000)
+    # Кэш ответов на повторяющиеся запросы: время жизни (сек) и размеры.
+    # Ключ не учитывает контекст диалога, поэтому при включенной памяти диалога
+    # (CONVERSATION_MEMORY_ENABLED) кэш используется только для запросов без
+    # истории - первого сообщения пользователя или первого после /reset
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    RESPONSE_CACHE_TTL = env_int('RESPONSE_CACHE_TTL', 86400)
+    RESPONSE_CACHE_MAX_ENTRIES = env_int('RESPONSE_CACHE_MAX_ENTRIES', 10000)
+    RESPONSE_CACHE_MEMORY_SIZE = env_int('RESPONSE_CACHE_MEMORY_SIZE', 1000)
+    # Режим получения обновлений: polling или webhook
+    RUN_MODE = os.getenv('RUN_MODE', 'polling')
+    # Вебхук: публичный URL, локальный адрес сервера, секрет, число одновременных
+    # обработчиков, предел принятых и еще не обработанных обновлений и число
+    # соединений, которые Telegram открывает к вебхуку (1-100)
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = env_int('WEBHOOK_PORT', 8080)
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+    WEBHOOK_WORKERS = env_int('WEBHOOK_WORKERS', 64)
+    WEBHOOK_QUEUE_SIZE = env_int('WEBHOOK_QUEUE_SIZE', 1000)
+    WEBHOOK_MAX_CONNECTIONS = env_int('WEBHOOK_MAX_CONNECTIONS', 40)
+    # Лимиты OpenAI для нашего тарифа: запросов и токенов в минуту
+    OPENAI_RPM = env_int('OPENAI_RPM', 3500)
+    OPENAI_TPM = env_int('OPENAI_TPM', 90000)
+    # Лимит запросов одного пользователя: в минуту и допустимый всплеск
+    USER_RATE_LIMIT_PER_MINUTE = env_float('USER_RATE_LIMIT_PER_MINUTE', 10)
+    USER_RATE_LIMIT_BURST = env_int('USER_RATE_LIMIT_BURST', 5)
+    # Память диалога: бюджет контекста и размер резюме в токенах
+    CONVERSATION_MEMORY_ENABLED = os.getenv('CONVERSATION_MEMORY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    CONVERSATION_TOKEN_BUDGET = env_int('CONVERSATION_TOKEN_BUDGET', 2000)
+    CONVERSATION_SUMMARY_MAX_TOKENS = env_int('CONVERSATION_SUMMARY_MAX_TOKENS', 300)
+    # Метрики Prometheus на локальном HTTP-порту
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = env_int('METRICS_PORT', 9100)
+    # Хранилище состояний многошаговых диалогов: memory или sqlite, срок жизни (сек) и размер
+    STATE_STORAGE = os.getenv('STATE_STORAGE', 'memory')
+    STATE_TTL = env_int('STATE_TTL', 3600)
+    STATE_MAX_ENTRIES = env_int('STATE_MAX_ENTRIES', 10000)
+    # Хранилище данных: sqlite (файл DATABASE_NAME) или postgres (DATABASE_URL)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+    DATABASE_URL = os.getenv('DATABASE_URL')
+    # Резерв баланса на время запроса к OpenAI: срок жизни и период возврата истекших (сек)
+    BALANCE_HOLD_TTL = env_int('BALANCE_HOLD_TTL', 300)
+    # Сколько запрос может ждать очереди к OpenAI (сек): вместе с LLM_DEADLINE
+    # должно быть меньше BALANCE_HOLD_TTL, иначе резерв вернется до ответа
+    AI_QUEUE_TIMEOUT = env_float('AI_QUEUE_TIMEOUT', 120)
+    HOLD_RECLAIM_INTERVAL = env_int('HOLD_RECLAIM_INTERVAL', 60)
+    # Рассылки: предельный темп (сообщений в сек; рассылка получает только остаток
+    # общего темпа OUTBOUND_GLOBAL_RATE), параллельность, размер страницы получателей,
+    # период отчета о ходе (сек) и через сколько секунд без прогресса рассылку подхватит другой процесс
+    BROADCAST_RATE = env_float('BROADCAST_RATE', 25)
+    BROADCAST_CONCURRENCY = env_int('BROADCAST_CONCURRENCY', 10)
+    BROADCAST_PAGE_SIZE = env_int('BROADCAST_PAGE_SIZE', 500)
+    BROADCAST_PROGRESS_INTERVAL = env_float('BROADCAST_PROGRESS_INTERVAL', 30)
+    BROADCAST_STALE_AFTER = env_int('BROADCAST_STALE_AFTER', 300)
+    # Сжатие ответов в журнале запросов: zlib, zstd (нужен пакет zstandard) или none
+    RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'zlib')
+    # Хранение журнала: через сколько дней запросы уходят в помесячные архивы,
+    # каталог архивов и период обслуживания (сек)
+    RETENTION_ENABLED = os.getenv('RETENTION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RETENTION_DAYS = env_int('RETENTION_DAYS', 90)
+    RETENTION_INTERVAL = env_int('RETENTION_INTERVAL', 21600)
+    ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+    # Однократный полный VACUUM для базы, созданной без auto_vacuum = INCREMENTAL
+    RETENTION_CONVERT_AUTO_VACUUM = os.getenv('RETENTION_CONVERT_AUTO_VACUUM', 'false').lower() in ('1', 'true', 'yes')
+    # Выбор модели по длине промпта: "модель:контекст:max_tokens" через запятую,
+    # и резервные модели на случай медленного ответа основной
+    LLM_ROUTES = os.getenv('LLM_ROUTES', 'gpt-3.5-turbo:16385:1000')
+    LLM_FALLBACK_MODELS = [model.strip() for model in os.getenv('LLM_FALLBACK_MODELS', '').split(',') if model.strip()]
+    # Сроки запроса к OpenAI (сек): всего и на одну попытку; повторы после 429/5xx
+    LLM_DEADLINE = env_float('LLM_DEADLINE', 60)
+    LLM_ATTEMPT_TIMEOUT = env_float('LLM_ATTEMPT_TIMEOUT', 30)
+    LLM_MAX_ATTEMPTS = env_int('LLM_MAX_ATTEMPTS', 3)
+    LLM_BACKOFF_BASE = env_float('LLM_BACKOFF_BASE', 0.5)
+    LLM_BACKOFF_MAX = env_float('LLM_BACKOFF_MAX', 8)
+    # Дублирующий запрос, если ответа нет дольше квантиля времени ответа (расходует токены)
+    LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    LLM_HEDGE_QUANTILE = env_float('LLM_HEDGE_QUANTILE', 0.95)
+    # Потоковый ответ, замолчавший дольше этого срока (сек), считается зависшим
+    LLM_STREAM_IDLE_TIMEOUT = env_float('LLM_STREAM_IDLE_TIMEOUT', 30)
+    # Промокоды: лимит попыток активации на пользователя (в минуту и всплеск),
+    # индекс активных кодов в памяти, период его перестроения и как часто (не чаще,
+    # сек) перестраивать его после промаха: код мог создать другой процесс
+    PROMO_ATTEMPTS_PER_MINUTE = env_float('PROMO_ATTEMPTS_PER_MINUTE', 3)
+    PROMO_ATTEMPTS_BURST = env_int('PROMO_ATTEMPTS_BURST', 5)
+    PROMO_INDEX_ENABLED = os.getenv('PROMO_INDEX_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    PROMO_INDEX_REFRESH_INTERVAL = env_int('PROMO_INDEX_REFRESH_INTERVAL', 300)
+    PROMO_INDEX_MISS_REFRESH_INTERVAL = env_float('PROMO_INDEX_MISS_REFRESH_INTERVAL', 10)
+    # Массовая генерация: максимум кодов в одной кампании и длина кода
+    PROMO_BATCH_MAX = env_int('PROMO_BATCH_MAX', 100000)
+    PROMO_CODE_LENGTH = env_int('PROMO_CODE_LENGTH', 10)
+    # Остановка по SIGTERM: сколько ждать начатых обработчиков (сек), прежде чем
+    # отменить их с возвратом резерва; должно быть меньше срока, который дает оркестратор
+    SHUTDOWN_DRAIN_TIMEOUT = env_float('SHUTDOWN_DRAIN_TIMEOUT', 25)
+    # Long polling: сколько Telegram держит запрос getUpdates без новых обновлений (сек)
+    POLLING_TIMEOUT = env_int('POLLING_TIMEOUT', 20)
+    # Исходящие сообщения: общий темп (сообщ./с), темп и запас на один чат,
+    # одновременные запросы к Bot API и срок одного запроса (сек)
+    OUTBOUND_GLOBAL_RATE = env_float('OUTBOUND_GLOBAL_RATE', 30)
+    OUTBOUND_CHAT_RATE = env_float('OUTBOUND_CHAT_RATE', 1)
+    OUTBOUND_CHAT_BURST = env_float('OUTBOUND_CHAT_BURST', 3)
+    OUTBOUND_CONCURRENCY = env_int('OUTBOUND_CONCURRENCY', 20)
+    OUTBOUND_REQUEST_TIMEOUT = env_float('OUTBOUND_REQUEST_TIMEOUT', 15)
+    # Профилирование по команде /profile: предельная длительность (сек)
+    # и период выборки стеков (мс)
+    PROFILE_MAX_SECONDS = env_int('PROFILE_MAX_SECONDS', 300)
+    PROFILE_SAMPLE_INTERVAL_MS = env_float('PROFILE_SAMPLE_INTERVAL_MS', 5)
+
+    @classmethod
+    def validate(cls) -> None:
+        """Проверка настроек до запуска; ValueError со списком всех ошибок"""
+        errors = list(parse_errors)
+        if not cls.BOT_TOKEN:
+            errors.append("не задан BOT_TOKEN")
+        if not cls.OPENAI_API_KEY:
+            errors.append("не задан OPENAI_API_KEY")
+        if not cls.ADMIN_ID:
+            errors.append("ADMIN_ID должен быть числовым ID администратора в Telegram")
+
+        choices = {
+            'RUN_MODE': ('polling', 'webhook'),
+            'STORAGE_BACKEND': ('sqlite', 'postgres'),
+            'STATE_STORAGE': ('memory', 'sqlite'),
+            'RESPONSE_COMPRESSION': ('zlib', 'zstd', 'none'),
+        }
+        for name, allowed in choices.items():
+            if getattr(cls, name) not in allowed:
+                errors.append(f"{name} должен быть одним из: {', '.join(allowed)}")
+
+        if cls.RUN_MODE == 'webhook' and not cls.WEBHOOK_URL:
+            errors.append("для RUN_MODE=webhook нужен WEBHOOK_URL")
+        if not 1 <= cls.WEBHOOK_MAX_CONNECTIONS <= 100:
+            errors.append("WEBHOOK_MAX_CONNECTIONS должен быть от 1 до 100")
+        # Темп токен-бакетов планировщика OpenAI: ноль дал бы деление на ноль
+        for name in ('OPENAI_RPM', 'OPENAI_TPM'):
+            if getattr(cls, name) < 1:
+                errors.append(f"{name} должен быть больше 0")
+        if cls.STORAGE_BACKEND == 'postgres' and not cls.DATABASE_URL:
+            errors.append("для STORAGE_BACKEND=postgres нужен DATABASE_URL")
+        if cls.AI_QUEUE_TIMEOUT + cls.LLM_DEADLINE >= cls.BALANCE_HOLD_TTL:
+            errors.append("AI_QUEUE_TIMEOUT + LLM_DEADLINE должно быть меньше BALANCE_HOLD_TTL")
+        if cls.SHUTDOWN_DRAIN_TIMEOUT < 0:
+            errors.append("SHUTDOWN_DRAIN_TIMEOUT не может быть отрицательным")
+
+        if errors:
+            raise ValueError("Ошибки конфигурации: " + "; ".join(errors))
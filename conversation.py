@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from database import utc_timestamp
+from ratelimit import estimate_tokens
+from storage import Storage
+
+# Сколько последних запросов читать из базы при первом обращении к диалогу
+MAX_LOADED_TURNS = 50
+# Переполненный контекст сокращается на эту долю бюджета: резюме обновляется
+# раз в несколько реплик, а не после каждой
+SUMMARY_HYSTERESIS = 0.25
+
+# summarize(tg_id, прежнее резюме, [(вопрос, ответ), ...]) -> новое резюме
+Summarizer = Callable[[int, Optional[str], List[Tuple[str, str]]], Awaitable[str]]
+
+
+class Turn(NamedTuple):
+    prompt: str
+    response: str
+    tokens: int
+    created_at: str
+
+
+class Conversation:
+    """Контекст диалога одного пользователя: резюме и последние реплики"""
+
+    def __init__(self, summary: Optional[str] = None, summary_until: Optional[str] = None):
+        self.summary = summary
+        self.summary_until = summary_until
+        self.turns: Deque[Turn] = deque()
+        self.turns_tokens = 0
+        # Реплики, вытесненные из контекста и ожидающие включения в резюме
+        self.pending: List[Turn] = []
+        self.summarizing = False
+        self.discarded = False
+
+    @property
+    def tokens(self) -> int:
+        """Оценка размера контекста в токенах"""
+        summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+        return summary_tokens + self.turns_tokens
+
+    def append(self, turn: Turn) -> None:
+        self.turns.append(turn)
+        self.turns_tokens += turn.tokens
+
+    def pop_oldest(self) -> Turn:
+        turn = self.turns.popleft()
+        self.turns_tokens -= turn.tokens
+        return turn
+
+
+class ConversationMemory:
+    """Память диалогов с ограничением контекста по токенам и сворачиванием в резюме"""
+
+    def __init__(self, storage: Storage, summarize: Summarizer,
+                 token_budget: int = 2000, max_users: int = 10000):
+        self.storage = storage
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.max_users = max_users
+        self._conversations: "OrderedDict[int, Conversation]" = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def _load(self, tg_id: int) -> Conversation:
+        """Восстановление диалога из таблицы запросов после последнего резюме или сброса"""
+        record = await self.storage.get_conversation(tg_id) or {}
+        since = max(record.get('summary_until') or '', record.get('reset_at') or '')
+        conversation = Conversation(record.get('summary'), record.get('summary_until'))
+
+        rows = await self.storage.get_recent_requests(tg_id, since=since, limit=MAX_LOADED_TURNS)
+        overflowed = False
+        for row in rows:
+            turn = Turn(
+                row['prompt'], row['response'] or '',
+                estimate_tokens(row['prompt']) + estimate_tokens(row['response'] or ''),
+                row['created_at']
+            )
+            # Строки идут от новых к старым. С первой не поместившейся реплики все
+            # более старые уходят в резюме, чтобы в контексте не было разрыва
+            overflowed = overflowed or conversation.tokens + turn.tokens > self.token_budget
+            if overflowed:
+                conversation.pending.insert(0, turn)
+            else:
+                conversation.turns.appendleft(turn)
+                conversation.turns_tokens += turn.tokens
+        return conversation
+
+    async def _get(self, tg_id: int) -> Conversation:
+        """Диалог из памяти или из базы при первом обращении"""
+        conversation = self._conversations.get(tg_id)
+        if conversation is None:
+            loaded = await self._load(tg_id)
+            # Пока шла загрузка, диалог мог появиться в памяти
+            conversation = self._conversations.setdefault(tg_id, loaded)
+            if conversation is loaded and loaded.pending:
+                self._schedule_summary(tg_id, loaded)
+        self._conversations.move_to_end(tg_id)
+        while len(self._conversations) > self.max_users:
+            self._conversations.popitem(last=False)
+        return conversation
+
+    async def get_context(self, tg_id: int) -> List[Dict[str, str]]:
+        """Сообщения контекста для запроса к OpenAI (без системного промпта и нового вопроса)"""
+        conversation = await self._get(tg_id)
+        messages = []
+        if conversation.summary:
+            messages.append({
+                "role": "system",
+                "content": f"Краткое содержание предыдущего диалога: {conversation.summary}"
+            })
+        for turn in conversation.turns:
+            messages.append({"role": "user", "content": turn.prompt})
+            messages.append({"role": "assistant", "content": turn.response})
+        return messages
+
+    async def add_turn(self, tg_id: int, prompt: str, response: str) -> None:
+        """Добавление реплики; не помещающиеся старые реплики сворачиваются в резюме"""
+        conversation = await self._get(tg_id)
+        created_at = utc_timestamp()
+        conversation.append(Turn(
+            prompt, response,
+            estimate_tokens(prompt) + estimate_tokens(response),
+            created_at
+        ))
+
+        if conversation.tokens > self.token_budget:
+            low_watermark = self.token_budget * (1 - SUMMARY_HYSTERESIS)
+            while conversation.turns and conversation.tokens > low_watermark:
+                conversation.pending.append(conversation.pop_oldest())
+
+        if conversation.pending:
+            self._schedule_summary(tg_id, conversation)
+
+    def _schedule_summary(self, tg_id: int, conversation: Conversation) -> None:
+        """Запуск фонового сворачивания, если оно еще не идет"""
+        if conversation.summarizing:
+            return
+        conversation.summarizing = True
+        task = asyncio.create_task(self._summarize(tg_id, conversation))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, tg_id: int, conversation: Conversation) -> None:
+        """Сворачивание вытесненных реплик в резюме и его сохранение"""
+        try:
+            while conversation.pending and not conversation.discarded:
+                batch, conversation.pending = conversation.pending, []
+                try:
+                    summary = await self.summarize(
+                        tg_id, conversation.summary,
+                        [(turn.prompt, turn.response) for turn in batch]
+                    )
+                except Exception as e:
+                    # Без резюме вытесненные реплики просто выпадают из контекста
+                    logging.error(f"Ошибка сворачивания диалога {tg_id}: {e}")
+                    continue
+
+                if conversation.discarded:
+                    return
+                conversation.summary = summary
+                conversation.summary_until = batch[-1].created_at
+                await self.storage.save_conversation_summary(
+                    tg_id, summary, conversation.summary_until
+                )
+        finally:
+            conversation.summarizing = False
+
+    async def reset(self, tg_id: int) -> None:
+        """Очистка памяти диалога пользователя"""
+        conversation = self._conversations.pop(tg_id, None)
+        if conversation is not None:
+            conversation.discarded = True
+        await self.storage.reset_conversation(tg_id)
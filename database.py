@@ -1,21 +1,405 @@
 import sqlite3
 import logging
-from datetime import datetime
-from typing import Optional, List, Tuple, Dict, Any
+import queue
+import random
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, Tuple, Dict, Any, Iterable, Iterator, ContextManager, Callable, Sequence
+from urllib.parse import quote
+
+from compression import TextCompressor, decompress_text
+from migrations import apply_migrations
+
+# Настройки соединений SQLite
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 16384
+STATEMENT_CACHE_SIZE = 256
+# Попытки начать транзакцию записи, если база занята дольше busy_timeout
+BEGIN_ATTEMPTS = 3
+BEGIN_BACKOFF = 0.1
+
+CONNECTION_PRAGMAS = (
+    # Действует только для нового файла базы: до создания первой таблицы
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB}",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+)
+
+def utc_timestamp() -> str:
+    """Текущее время UTC в формате CURRENT_TIMESTAMP с миллисекундами"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+def iter_table_rows(db_path: str, table: str, columns: Sequence[str], date_column: str,
+                    since: str = None, until: str = None,
+                    batch_size: int = 5000) -> Iterator[List[Dict[str, Any]]]:
+    """Строки таблицы файла SQLite пакетами по возрастанию id с фильтром since <= дата < until"""
+    conditions, params = [], []
+    if since:
+        conditions.append(f"{date_column} >= ?")
+        params.append(since)
+    if until:
+        conditions.append(f"{date_column} < ?")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # Отдельное соединение только для чтения: долгая выгрузка не занимает пул
+    conn = sqlite3.connect(
+        f"file:{quote(db_path)}?mode=ro",
+        uri=True,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY id", params
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+def is_busy_error(error: sqlite3.OperationalError) -> bool:
+    """База заблокирована другим писателем"""
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+class Transaction:
+    """Единица работы: операции на одном соединении под одной блокировкой записи"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.rolled_back = False
+        self._after_commit: List[Callable[[], None]] = []
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> sqlite3.Cursor:
+        return self.conn.execute(sql, params)
+
+    def executemany(self, sql: str, rows: Iterable[Sequence[Any]]) -> sqlite3.Cursor:
+        return self.conn.executemany(sql, rows)
+
+    def rollback(self) -> None:
+        """Отмена единицы работы: при выходе из блока ее изменения не зафиксируются.
+
+        Вложенная единица откатывает только свои изменения, внешние сохраняются.
+        """
+        self.rolled_back = True
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Действие после фиксации (например, обновление кэша); при отмене не вызывается"""
+        self._after_commit.append(callback)
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite"""
+
+    def __init__(self, db_name: str, size: int = 8):
+        self.db_name = db_name
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._savepoints = itertools.count()
+        # Вызывается с временем ожидания соединения в секундах (для метрик)
+        self.on_wait: Optional[Callable[[float], None]] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие нового соединения с настроенными PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        """Получение соединения с учетом времени ожидания"""
+        started = time.perf_counter()
+        conn = self._take()
+        if self.on_wait is not None:
+            self.on_wait(time.perf_counter() - started)
+        return conn
+
+    def _take(self) -> sqlite3.Connection:
+        """Получение свободного соединения (ожидание, если пул исчерпан)"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._connections) < self.size:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Соединение из пула; транзакция фиксируется при выходе из внешнего блока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # Вложенный вызов в том же потоке использует то же соединение
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._local.conn = None
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        """Транзакция записи: BEGIN IMMEDIATE, фиксация при выходе, откат при исключении.
+
+        Блокировка записи берется сразу, а не при первом изменении: транзакция,
+        начавшаяся с чтения, не получит SQLITE_BUSY посреди работы. Вложенный
+        вызов в том же потоке выполняется в SAVEPOINT внешней транзакции:
+        фиксирует ее внешний блок, а откат затрагивает только вложенный.
+        """
+        parent = getattr(self._local, 'tx', None)
+        if parent is not None:
+            with self._savepoint(parent.conn, parent) as tx:
+                yield tx
+            return
+
+        with self.connection() as conn:
+            if conn.in_transaction:
+                # Неявную транзакцию внешнего блока connection() фиксирует он сам
+                with self._savepoint(conn, None) as tx:
+                    yield tx
+                return
+
+            self._begin(conn)
+            tx = Transaction(conn)
+            self._local.tx = tx
+            try:
+                yield tx
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self._local.tx = None
+
+            if tx.rolled_back:
+                conn.rollback()
+                return
+            conn.commit()
+        for callback in tx._after_commit:
+            callback()
+
+    @contextmanager
+    def _savepoint(self, conn: sqlite3.Connection,
+                   parent: Optional[Transaction]) -> Iterator[Transaction]:
+        """Вложенная единица работы внутри уже начатой транзакции"""
+        name = f"tx_{next(self._savepoints)}"
+        conn.execute(f"SAVEPOINT {name}")
+        tx = Transaction(conn)
+        self._local.tx = tx
+        try:
+            yield tx
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {name}")
+            conn.execute(f"RELEASE {name}")
+            raise
+        finally:
+            self._local.tx = parent
+
+        if tx.rolled_back:
+            conn.execute(f"ROLLBACK TO {name}")
+            conn.execute(f"RELEASE {name}")
+            return
+        conn.execute(f"RELEASE {name}")
+        if parent is not None:
+            # Действия выполнятся после фиксации внешней транзакции
+            parent._after_commit.extend(tx._after_commit)
+        else:
+            for callback in tx._after_commit:
+                callback()
+
+    def _begin(self, conn: sqlite3.Connection) -> None:
+        """BEGIN IMMEDIATE с повтором, если база занята дольше busy_timeout"""
+        for attempt in range(BEGIN_ATTEMPTS):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == BEGIN_ATTEMPTS - 1:
+                    raise
+                logging.warning(f"База занята, повтор начала транзакции: {e}")
+                time.sleep(BEGIN_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def close(self) -> None:
+        """Закрытие всех соединений пула"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._idle = queue.LifoQueue()
+
+class RequestJournal:
+    """Отложенная пакетная запись журнала запросов к OpenAI"""
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = 100,
+                 flush_interval: float = 2.0, compressor: Optional[TextCompressor] = None):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compressor = compressor or TextCompressor('none')
+        self._pending: List[Tuple[int, str, Optional[str], int, str]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-journal", daemon=True)
+        self._thread.start()
+
+    def append(self, tg_id: int, prompt: str, response: Optional[str],
+               tokens_used: int) -> None:
+        """Постановка записи в очередь; запись в базу произойдет при сбросе"""
+        created_at = utc_timestamp()
+        with self._lock:
+            self._pending.append((tg_id, prompt, response, tokens_used, created_at))
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self) -> int:
+        """Запись накопленных строк одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+
+            try:
+                # Ответ сжимается здесь, в фоновом потоке, а не в обработчике
+                compressed = [
+                    (tg_id, prompt, self.compressor.compress(response), tokens_used, created_at)
+                    for tg_id, prompt, response, tokens_used, created_at in rows
+                ]
+                with self.pool.transaction() as tx:
+                    tx.executemany(
+                        """INSERT INTO requests (tg_id, prompt, response, tokens_used, created_at)
+                        VALUES (?, ?, ?, ?, ?)""",
+                        compressed
+                    )
+            except Exception as e:
+                logging.error(f"Ошибка записи журнала запросов: {e}")
+                # Возвращаем строки в очередь для следующей попытки
+                with self._lock:
+                    self._pending[:0] = rows
+                return 0
+
+            return len(rows)
+
+    def _run(self) -> None:
+        """Фоновый сброс по размеру пакета или по таймеру"""
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self) -> None:
+        """Остановка фонового потока и финальный сброс"""
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+class UserCache:
+    """Ограниченный LRU-кэш записей пользователей по tg_id"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._users: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        """Копия записи пользователя или None при промахе"""
+        with self._lock:
+            user = self._users.get(tg_id)
+            if user is None:
+                self.misses += 1
+                return None
+            self._users.move_to_end(tg_id)
+            self.hits += 1
+            return dict(user)
+
+    def put(self, user: Dict[str, Any]) -> None:
+        """Сохранение актуальной записи пользователя"""
+        with self._lock:
+            self._users[user['tg_id']] = dict(user)
+            self._users.move_to_end(user['tg_id'])
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, tg_id: int) -> None:
+        """Удаление записи пользователя из кэша"""
+        with self._lock:
+            self._users.pop(tg_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._users),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0
+            }
 
 class DatabaseManager:
-    def __init__(self, db_name: str = "bot_database.db"):
+    def __init__(self, db_name: str = "bot_database.db", pool_size: int = 8,
+                 request_log_batch_size: int = 100, request_log_flush_interval: float = 2.0,
+                 user_cache_size: int = 10000, compression: str = 'none'):
         self.db_name = db_name
+        self.pool = ConnectionPool(db_name, size=pool_size)
+        self.user_cache = UserCache(max_size=user_cache_size)
         self.init_database()
+        self.request_journal = RequestJournal(
+            self.pool,
+            batch_size=request_log_batch_size,
+            flush_interval=request_log_flush_interval,
+            compressor=TextCompressor(compression)
+        )
     
-    def get_connection(self) -> sqlite3.Connection:
-        """Получение соединения с базой данных"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def get_connection(self) -> ContextManager[sqlite3.Connection]:
+        """Получение соединения с базой данных из пула"""
+        return self.pool.connection()
+    
+    def transaction(self) -> ContextManager[Transaction]:
+        """Единица работы: все операции блока фиксируются одной транзакцией"""
+        return self.pool.transaction()
+    
+    def close(self) -> None:
+        """Сброс отложенных записей и закрытие соединений с базой данных"""
+        self.request_journal.close()
+        self.pool.close()
     
     def init_database(self) -> None:
-        """Инициализация таблиц базы данных"""
+        """Инициализация таблиц базы данных и применение миграций"""
         tables = [
             # Таблица пользователей
             """
@@ -84,73 +468,114 @@ class DatabaseManager:
         with self.get_connection() as conn:
             for table in tables:
                 conn.execute(table)
+            
+            # Индексы и последующие изменения схемы
+            apply_migrations(conn)
     
     def get_or_create_user(self, tg_id: int, username: str = None, 
                           first_name: str = None, last_name: str = None) -> Dict[str, Any]:
         """Получение или создание пользователя"""
+        user = self.user_cache.get(tg_id)
+        if user:
+            return user
+        
+        # Существующий пользователь читается без блокировки записи
+        user = self.load_user(tg_id)
+        if user:
+            return user
+        
+        from config import Config
         with self.get_connection() as conn:
-            # Пытаемся найти пользователя
-            user = conn.execute(
-                "SELECT * FROM users WHERE tg_id = ?", (tg_id,)
-            ).fetchone()
-            
-            if user:
-                return dict(user)
-            
-            # Создаем нового пользователя
-            from config import Config
+            # Параллельная регистрация того же пользователя не мешает: вставка пропускается
             conn.execute(
                 """INSERT INTO users 
                 (tg_id, username, first_name, last_name, balance) 
-                VALUES (?, ?, ?, ?, ?)""",
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (tg_id) DO NOTHING""",
                 (tg_id, username, first_name, last_name, Config.DEFAULT_FREE_REQUESTS)
             )
-            
-            # Возвращаем созданного пользователя
-            new_user = conn.execute(
+            user = dict(conn.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,)).fetchone())
+        
+        self.user_cache.put(user)
+        return user
+    
+    def get_user(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        """Получение записи пользователя (из кэша, если она там есть)"""
+        user = self.user_cache.get(tg_id)
+        if user:
+            return user
+        return self.load_user(tg_id)
+    
+    def load_user(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        """Чтение записи пользователя из базы с сохранением в кэш"""
+        with self.get_connection() as conn:
+            user = conn.execute(
                 "SELECT * FROM users WHERE tg_id = ?", (tg_id,)
             ).fetchone()
-            
-            return dict(new_user)
+        
+        if not user:
+            return None
+        user = dict(user)
+        self.user_cache.put(user)
+        return user
     
     def update_user_balance(self, tg_id: int, amount: int) -> bool:
         """Обновление баланса пользователя"""
         with self.get_connection() as conn:
             try:
-                conn.execute(
-                    "UPDATE users SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP WHERE tg_id = ?",
+                user = conn.execute(
+                    """UPDATE users SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP 
+                    WHERE tg_id = ? RETURNING *""",
                     (amount, tg_id)
-                )
-                return True
+                ).fetchone()
             except Exception as e:
                 logging.error(f"Ошибка обновления баланса: {e}")
+                self.user_cache.invalidate(tg_id)
                 return False
+        
+        if user:
+            self.user_cache.put(dict(user))
+        return True
     
     def get_user_balance(self, tg_id: int) -> int:
         """Получение баланса пользователя"""
-        with self.get_connection() as conn:
-            user = conn.execute(
-                "SELECT balance FROM users WHERE tg_id = ?", (tg_id,)
-            ).fetchone()
-            return user['balance'] if user else 0
+        user = self.get_user(tg_id)
+        return user['balance'] if user else 0
     
     def add_payment(self, tg_id: int, amount: int, stars_paid: int, 
                    payment_id: str, status: str = "completed") -> bool:
-        """Добавление записи о платеже"""
-        with self.get_connection() as conn:
-            try:
-                conn.execute(
+        """Запись платежа и пополнение баланса одной транзакцией.
+
+        Повторная доставка того же платежа (тот же payment_id) баланс не меняет.
+        """
+        try:
+            with self.transaction() as tx:
+                payment = tx.execute(
                     """INSERT INTO payments 
                     (tg_id, amount, stars_paid, payment_id, status) 
-                    VALUES (?, ?, ?, ?, ?)""",
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (payment_id) DO NOTHING RETURNING id""",
                     (tg_id, amount, stars_paid, payment_id, status)
-                )
-                # Обновляем баланс пользователя
-                self.update_user_balance(tg_id, amount)
-                return True
-            except Exception as e:
-                logging.error(f"Ошибка добавления платежа: {e}")
-                return False
+                ).fetchone()
+                if not payment:
+                    logging.warning(f"Платеж {payment_id} уже учтен")
+                    return True
+                
+                user = tx.execute(
+                    """UPDATE users SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP 
+                    WHERE tg_id = ? RETURNING *""",
+                    (amount, tg_id)
+                ).fetchone()
+                if not user:
+                    tx.rollback()
+                    logging.error(f"Платеж {payment_id}: пользователь {tg_id} не найден")
+                    return False
+                tx.after_commit(lambda: self.user_cache.put(dict(user)))
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка добавления платежа: {e}")
+            self.user_cache.invalidate(tg_id)
+            return False
     
     def create_promo_code(self, code: str, requests: int, max_uses: int = None) -> bool:
         """Создание промокода"""
@@ -169,80 +594,230 @@ class DatabaseManager:
                 logging.error(f"Ошибка создания промокода: {e}")
                 return False
     
-    def use_promo_code(self, code: str, tg_id: int) -> Tuple[bool, int]:
-        """Использование промокода"""
+    def create_promo_codes(self, codes: Sequence[str], requests: int, max_uses: int = None,
+                           campaign: str = None, batch_size: int = 5000) -> int:
+        """Массовое создание промокодов кампании; возвращает число созданных.
+
+        Коды, совпавшие с уже существующими, пропускаются.
+        """
+        created = 0
+        for start in range(0, len(codes), batch_size):
+            # Пакет - отдельная транзакция, чтобы не держать блокировку записи долго
+            with self.transaction() as tx:
+                created += tx.executemany(
+                    """INSERT OR IGNORE INTO promo_codes (code, requests, max_uses, campaign) 
+                    VALUES (?, ?, ?, ?)""",
+                    [(code, requests, max_uses, campaign) for code in codes[start:start + batch_size]]
+                ).rowcount
+        return created
+    
+    def get_campaign_codes(self, campaign: str) -> List[str]:
+        """Коды кампании"""
         with self.get_connection() as conn:
-            try:
-                # Получаем промокод
-                promo = conn.execute(
-                    "SELECT * FROM promo_codes WHERE code = ? AND is_active = TRUE",
+            rows = conn.execute(
+                "SELECT code FROM promo_codes WHERE campaign = ? ORDER BY id", (campaign,)
+            ).fetchall()
+            return [row[0] for row in rows]
+    
+    def get_active_promo_codes(self) -> List[str]:
+        """Коды, которые еще можно активировать"""
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                """SELECT code FROM promo_codes 
+                WHERE is_active = TRUE AND (max_uses IS NULL OR used_count < max_uses)"""
+            ).fetchall()
+            return [row[0] for row in rows]
+    
+    def use_promo_code(self, code: str, tg_id: int) -> Tuple[bool, int]:
+        """Использование промокода одной транзакцией"""
+        try:
+            with self.transaction() as tx:
+                # Условное увеличение счетчика: лимит проверяется и расходуется атомарно
+                promo = tx.execute(
+                    """UPDATE promo_codes SET used_count = used_count + 1 
+                    WHERE code = ? AND is_active = TRUE 
+                    AND (max_uses IS NULL OR used_count < max_uses) 
+                    RETURNING id, requests""",
                     (code,)
                 ).fetchone()
-                
                 if not promo:
-                    return False, 0  # Промокод не найден
-                
-                # Проверяем лимит использования
-                if promo['max_uses'] and promo['used_count'] >= promo['max_uses']:
-                    return False, 0  # Лимит исчерпан
+                    return False, 0  # Промокод не найден или лимит исчерпан
                 
-                # Проверяем, использовал ли пользователь уже этот промокод
-                existing_usage = conn.execute(
-                    "SELECT * FROM promo_usage WHERE promo_id = ? AND tg_id = ?",
+                # Повторная активация тем же пользователем упирается в уникальный индекс
+                if not tx.execute(
+                    "INSERT OR IGNORE INTO promo_usage (promo_id, tg_id) VALUES (?, ?)",
                     (promo['id'], tg_id)
-                ).fetchone()
-                
-                if existing_usage:
+                ).rowcount:
+                    tx.rollback()
                     return False, 0  # Промокод уже использован
                 
-                # Начисляем запросы
-                self.update_user_balance(tg_id, promo['requests'])
-                
-                # Обновляем счетчик использования
-                conn.execute(
-                    "UPDATE promo_codes SET used_count = used_count + 1 WHERE id = ?",
-                    (promo['id'],)
-                )
-                
-                # Записываем использование
-                conn.execute(
-                    "INSERT INTO promo_usage (promo_id, tg_id) VALUES (?, ?)",
-                    (promo['id'], tg_id)
-                )
-                
-                return True, promo['requests']
-                
-            except Exception as e:
-                logging.error(f"Ошибка использования промокода: {e}")
-                return False, 0
+                user = tx.execute(
+                    """UPDATE users SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP 
+                    WHERE tg_id = ? RETURNING *""",
+                    (promo['requests'], tg_id)
+                ).fetchone()
+                if not user:
+                    tx.rollback()
+                    return False, 0  # Пользователь еще не начал работу с ботом
+                tx.after_commit(lambda: self.user_cache.put(dict(user)))
+        except Exception as e:
+            logging.error(f"Ошибка использования промокода: {e}")
+            self.user_cache.invalidate(tg_id)
+            return False, 0
+        
+        return True, promo['requests']
     
     def add_request(self, tg_id: int, prompt: str, response: str = None, 
-                   tokens_used: int = 0) -> int:
-        """Добавление записи о запросе и уменьшение баланса"""
+                   tokens_used: int = 0) -> None:
+        """Уменьшение баланса и постановка записи о запросе в журнал"""
         with self.get_connection() as conn:
-            # Добавляем запрос
-            cursor = conn.execute(
-                """INSERT INTO requests (tg_id, prompt, response, tokens_used) 
-                VALUES (?, ?, ?, ?)""",
-                (tg_id, prompt, response, tokens_used)
+            # Уменьшаем баланс сразу
+            user = conn.execute(
+                """UPDATE users SET balance = balance - 1, total_requests = total_requests + 1 
+                WHERE tg_id = ? RETURNING *""",
+                (tg_id,)
+            ).fetchone()
+        
+        if user:
+            self.user_cache.put(dict(user))
+        
+        # Текст запроса и ответа записывается пакетно в фоне
+        self.request_journal.append(tg_id, prompt, response, tokens_used)
+    
+    def reserve_request(self, tg_id: int, ttl: float = 300) -> Tuple[Optional[int], int]:
+        """Резервирование одного запроса: (id резерва, остаток баланса) или (None, 0)"""
+        with self.transaction() as tx:
+            # Проверка и списание одним условным UPDATE: параллельные запросы не уйдут в минус
+            user = tx.execute(
+                """UPDATE users SET balance = balance - 1, updated_at = CURRENT_TIMESTAMP 
+                WHERE tg_id = ? AND balance > 0 RETURNING *""",
+                (tg_id,)
+            ).fetchone()
+            if not user:
+                return None, 0
+            
+            hold_id = tx.execute(
+                "INSERT INTO balance_holds (tg_id, amount, expires_at) VALUES (?, 1, ?) RETURNING id",
+                (tg_id, time.time() + ttl)
+            ).fetchone()[0]
+        
+        self.user_cache.put(dict(user))
+        return hold_id, user['balance']
+    
+    def commit_request(self, hold_id: int, tg_id: int, prompt: str, response: str = None,
+                       tokens_used: int = 0) -> bool:
+        """Подтверждение резерва после успешного ответа и запись запроса в журнал.
+
+        False, если резерв уже вернули по истечении срока: тогда запрос
+        списывается заново, но только при положительном балансе.
+        """
+        with self.transaction() as tx:
+            held = tx.execute(
+                "DELETE FROM balance_holds WHERE id = ? RETURNING id", (hold_id,)
+            ).fetchone()
+            # Если резерв уже вернули по истечении срока, списываем заново, пока есть баланс
+            user = tx.execute(
+                """UPDATE users SET total_requests = total_requests + 1,
+                balance = balance - (? AND balance > 0) 
+                WHERE tg_id = ? RETURNING *""",
+                (held is None, tg_id)
+            ).fetchone()
+        
+        if user:
+            self.user_cache.put(dict(user))
+        self.request_journal.append(tg_id, prompt, response, tokens_used)
+        return held is not None
+    
+    def release_request(self, hold_id: int) -> bool:
+        """Возврат зарезервированного запроса на баланс при ошибке"""
+        with self.transaction() as tx:
+            held = tx.execute(
+                "DELETE FROM balance_holds WHERE id = ? RETURNING tg_id, amount", (hold_id,)
+            ).fetchone()
+            if not held:
+                return False  # Уже подтвержден или возвращен
+            
+            user = tx.execute(
+                "UPDATE users SET balance = balance + ? WHERE tg_id = ? RETURNING *",
+                (held['amount'], held['tg_id'])
+            ).fetchone()
+        
+        if user:
+            self.user_cache.put(dict(user))
+        return True
+    
+    def reclaim_expired_holds(self) -> int:
+        """Возврат на баланс резервов, срок которых истек (например, после падения процесса)"""
+        with self.transaction() as tx:
+            expired = tx.execute(
+                "DELETE FROM balance_holds WHERE expires_at <= ? RETURNING tg_id, amount",
+                (time.time(),)
+            ).fetchall()
+            tx.executemany(
+                "UPDATE users SET balance = balance + ? WHERE tg_id = ?",
+                [(row['amount'], row['tg_id']) for row in expired]
             )
+        
+        for row in expired:
+            self.user_cache.invalidate(row['tg_id'])
+        return len(expired)
+    
+    def get_recent_requests(self, tg_id: int, since: str = None, 
+                            limit: int = 50) -> List[Dict[str, Any]]:
+        """Последние запросы пользователя после момента since (новые первыми)"""
+        # Свежие записи могут еще лежать в журнале
+        self.request_journal.flush()
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                """SELECT prompt, response, tokens_used, created_at FROM requests 
+                WHERE tg_id = ? AND created_at > ? 
+                ORDER BY created_at DESC, id DESC LIMIT ?""",
+                (tg_id, since or '', limit)
+            ).fetchall()
+        
+        return [
+            {**dict(row), 'response': decompress_text(row['response'])}
+            for row in rows
+        ]
+    
+    def get_conversation(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        """Сохраненное состояние диалога пользователя"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT summary, summary_until, reset_at FROM conversations WHERE tg_id = ?",
+                (tg_id,)
+            ).fetchone()
             
-            # Уменьшаем баланс
+            return dict(row) if row else None
+    
+    def save_conversation_summary(self, tg_id: int, summary: str, summary_until: str) -> None:
+        """Сохранение резюме диалога, покрывающего запросы до summary_until"""
+        with self.get_connection() as conn:
             conn.execute(
-                "UPDATE users SET balance = balance - 1, total_requests = total_requests + 1 WHERE tg_id = ?",
-                (tg_id,)
+                """INSERT INTO conversations (tg_id, summary, summary_until) VALUES (?, ?, ?)
+                ON CONFLICT (tg_id) DO UPDATE SET summary = excluded.summary, 
+                summary_until = excluded.summary_until, updated_at = CURRENT_TIMESTAMP""",
+                (tg_id, summary, summary_until)
+            )
+    
+    def reset_conversation(self, tg_id: int) -> None:
+        """Сброс контекста диалога: старые запросы больше не попадают в контекст"""
+        reset_at = utc_timestamp()
+        with self.get_connection() as conn:
+            conn.execute(
+                """INSERT INTO conversations (tg_id, summary, summary_until, reset_at) 
+                VALUES (?, NULL, NULL, ?)
+                ON CONFLICT (tg_id) DO UPDATE SET summary = NULL, summary_until = NULL, 
+                reset_at = excluded.reset_at, updated_at = CURRENT_TIMESTAMP""",
+                (tg_id, reset_at)
             )
-            
-            return cursor.lastrowid
     
     def get_user_stats(self, tg_id: int) -> Dict[str, Any]:
         """Получение статистики пользователя"""
-        with self.get_connection() as conn:
-            user = conn.execute(
-                "SELECT balance, total_requests FROM users WHERE tg_id = ?", (tg_id,)
-            ).fetchone()
-            
-            return dict(user) if user else {'balance': 0, 'total_requests': 0}
+        user = self.get_user(tg_id)
+        if not user:
+            return {'balance': 0, 'total_requests': 0}
+        return {'balance': user['balance'], 'total_requests': user['total_requests']}
     
     def get_all_users_stats(self) -> List[Dict[str, Any]]:
         """Получение статистики всех пользователей"""
@@ -254,6 +829,126 @@ class DatabaseManager:
             
             return [dict(user) for user in users]
     
+    def get_bot_stats(self) -> Dict[str, Any]:
+        """Агрегированная статистика бота (поддерживается триггерами)"""
+        with self.get_connection() as conn:
+            totals = conn.execute(
+                """SELECT total_users, active_users, total_requests, total_tokens,
+                total_payments, total_stars FROM stats_totals WHERE id = 1"""
+            ).fetchone()
+            
+            return dict(totals)
+    
+    def get_daily_stats(self, days: int = 7) -> List[Dict[str, Any]]:
+        """Статистика по дням за последние days дней (новые дни первыми)"""
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                """SELECT day, new_users, requests, tokens, payments, stars 
+                FROM stats_daily WHERE day > date('now', ?) ORDER BY day DESC""",
+                (f"-{days} days",)
+            ).fetchall()
+            
+            return [dict(row) for row in rows]
+    
+    def get_recent_users(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Последние зарегистрированные пользователи"""
+        with self.get_connection() as conn:
+            users = conn.execute(
+                """SELECT tg_id, username, first_name, last_name, balance, total_requests, created_at 
+                FROM users ORDER BY created_at DESC LIMIT ?""",
+                (limit,)
+            ).fetchall()
+            
+            return [dict(user) for user in users]
+    
+    def set_user_blocked(self, tg_id: int, blocked: bool = True) -> None:
+        """Отметка о том, что пользователь заблокировал бота (или снова доступен)"""
+        with self.get_connection() as conn:
+            user = conn.execute(
+                "UPDATE users SET is_blocked = ? WHERE tg_id = ? RETURNING *",
+                (blocked, tg_id)
+            ).fetchone()
+        
+        if user:
+            self.user_cache.put(dict(user))
+    
+    def count_broadcast_recipients(self) -> int:
+        """Число пользователей, которым можно отправить рассылку"""
+        with self.get_connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM users WHERE is_blocked = FALSE"
+            ).fetchone()[0]
+    
+    def get_broadcast_recipients(self, after_tg_id: int, limit: int = 500) -> List[int]:
+        """Следующая страница получателей рассылки после after_tg_id (keyset-пагинация)"""
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                """SELECT tg_id FROM users WHERE tg_id > ? AND is_blocked = FALSE 
+                ORDER BY tg_id LIMIT ?""",
+                (after_tg_id, limit)
+            ).fetchall()
+            
+            return [row[0] for row in rows]
+    
+    def create_broadcast(self, text: str, created_by: int, total: int) -> int:
+        """Создание задания рассылки"""
+        with self.get_connection() as conn:
+            return conn.execute(
+                "INSERT INTO broadcasts (text, created_by, total) VALUES (?, ?, ?) RETURNING id",
+                (text, created_by, total)
+            ).fetchone()[0]
+    
+    def get_broadcast(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        """Задание рассылки по id"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)
+            ).fetchone()
+            
+            return dict(row) if row else None
+    
+    def get_running_broadcasts(self) -> List[Dict[str, Any]]:
+        """Незавершенные рассылки (для продолжения после перезапуска)"""
+        with self.get_connection() as conn:
+            rows = conn.execute(
+                "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id"
+            ).fetchall()
+            
+            return [dict(row) for row in rows]
+    
+    def claim_broadcast(self, broadcast_id: int, stale_after: int = 300) -> Optional[Dict[str, Any]]:
+        """Захват брошенной рассылки: позиция не сохранялась дольше stale_after секунд"""
+        with self.get_connection() as conn:
+            row = conn.execute(
+                """UPDATE broadcasts SET updated_at = CURRENT_TIMESTAMP 
+                WHERE id = ? AND status = 'running' AND updated_at < datetime('now', ?) 
+                RETURNING *""",
+                (broadcast_id, f"-{stale_after} seconds")
+            ).fetchone()
+            
+            return dict(row) if row else None
+    
+    def save_broadcast_progress(self, broadcast_id: int, last_tg_id: int, sent: int,
+                                blocked: int, failed: int, status: str = 'running') -> bool:
+        """Сохранение позиции и счетчиков рассылки; False, если рассылку уже остановили"""
+        with self.get_connection() as conn:
+            return conn.execute(
+                """UPDATE broadcasts SET last_tg_id = ?, sent = ?, blocked = ?, failed = ?, 
+                status = ?, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+                WHERE id = ? AND status = 'running'""",
+                (last_tg_id, sent, blocked, failed, status, status, broadcast_id)
+            ).rowcount > 0
+    
+    def cancel_broadcast(self, broadcast_id: int) -> bool:
+        """Остановка рассылки; ее обработчик заметит это при следующем сохранении позиции"""
+        with self.get_connection() as conn:
+            return conn.execute(
+                """UPDATE broadcasts SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP,
+                finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'""",
+                (broadcast_id,)
+            ).rowcount > 0
+    
     def get_promo_codes(self) -> List[Dict[str, Any]]:
         """Получение списка всех промокодов"""
         with self.get_connection() as conn:
@@ -263,3 +958,12 @@ class DatabaseManager:
             ).fetchall()
             
             return [dict(promo) for promo in promos]
+    
+    def iter_rows(self, table: str, columns: Sequence[str], date_column: str,
+                  since: str = None, until: str = None,
+                  batch_size: int = 5000) -> Iterator[List[Dict[str, Any]]]:
+        """Строки таблицы пакетами по возрастанию id с фильтром since <= дата < until"""
+        # Свежие записи могут еще лежать в журнале
+        if table == 'requests':
+            self.request_journal.flush()
+        yield from iter_table_rows(self.db_name, table, columns, date_column, since, until, batch_size)
@@ -0,0 +1,265 @@
+"""Потоковая выгрузка таблиц бота в CSV, JSONL или Parquet.
+
+Строки читаются курсором пакетами и сразу пишутся в файл, поэтому память
+не зависит от размера таблицы. CSV и JSONL сжимаются gzip, Parquet - zstd.
+Для таблицы requests к строкам основной базы добавляются помесячные архивы.
+
+Запуск из корня репозитория:
+
+    python export.py requests --format parquet --since 2024-01-01 --until 2024-01-31
+    python export.py users -o users.csv.gz
+"""
+import argparse
+import asyncio
+import csv
+import gzip
+import json
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from compression import decompress_text
+from database import iter_table_rows
+from retention import archive_files, archive_month, month_bounds
+from storage import Storage, format_timestamp
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow нужен только для Parquet
+    pyarrow = None
+
+# Строк в одном пакете чтения и записи (и в одной группе строк Parquet)
+BATCH_SIZE = 5000
+
+
+class ExportTable:
+    """Выгружаемая таблица: колонки с типами и колонка даты для фильтра"""
+
+    def __init__(self, date_column: str, columns: Sequence[Tuple[str, str]]):
+        self.date_column = date_column
+        self.columns = list(columns)
+        self.column_names = [name for name, _ in self.columns]
+
+
+EXPORT_TABLES: Dict[str, ExportTable] = {
+    'users': ExportTable('created_at', [
+        ('id', 'int'), ('tg_id', 'int'), ('username', 'str'), ('first_name', 'str'),
+        ('last_name', 'str'), ('balance', 'int'), ('total_requests', 'int'),
+        ('is_blocked', 'bool'), ('created_at', 'str'), ('updated_at', 'str'),
+    ]),
+    'payments': ExportTable('created_at', [
+        ('id', 'int'), ('tg_id', 'int'), ('amount', 'int'), ('stars_paid', 'int'),
+        ('payment_id', 'str'), ('status', 'str'), ('created_at', 'str'),
+    ]),
+    'requests': ExportTable('created_at', [
+        ('id', 'int'), ('tg_id', 'int'), ('prompt', 'str'), ('response', 'str'),
+        ('tokens_used', 'int'), ('created_at', 'str'),
+    ]),
+    'promo_usage': ExportTable('used_at', [
+        ('id', 'int'), ('promo_id', 'int'), ('tg_id', 'int'), ('used_at', 'str'),
+    ]),
+}
+
+
+def convert_value(value: Any, kind: str) -> Any:
+    """Значение из базы в тип колонки выгрузки"""
+    if value is None:
+        return None
+    if kind == 'int':
+        return int(value)
+    if kind == 'bool':
+        return bool(value)
+    if isinstance(value, datetime):
+        return format_timestamp(value)
+    if isinstance(value, bytes):
+        return decompress_text(value)
+    return str(value)
+
+
+def convert_rows(table: ExportTable, batch: List[Dict[str, Any]]) -> List[List[Any]]:
+    """Пакет строк базы в строки значений в порядке колонок выгрузки"""
+    return [[convert_value(row[name], kind) for name, kind in table.columns] for row in batch]
+
+
+def parse_date_range(since: Optional[str], until: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Даты ГГГГ-ММ-ДД в границы фильтра: since включительно, until - до конца дня"""
+    since_date = date.fromisoformat(since) if since else None
+    until_date = date.fromisoformat(until) if until else None
+    if since_date and until_date and until_date < since_date:
+        raise ValueError("Дата окончания раньше даты начала")
+    return (
+        since_date.isoformat() if since_date else None,
+        (until_date + timedelta(days=1)).isoformat() if until_date else None,
+    )
+
+
+class CsvExportWriter:
+    """CSV с заголовком, сжатый gzip"""
+
+    extension = 'csv.gz'
+
+    def __init__(self, path: str, table: ExportTable):
+        self.table = table
+        self._file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(table.column_names)
+
+    def write(self, batch: List[Dict[str, Any]]) -> None:
+        self._writer.writerows(convert_rows(self.table, batch))
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class JsonlExportWriter:
+    """Объект JSON на строку, сжатый gzip"""
+
+    extension = 'jsonl.gz'
+
+    def __init__(self, path: str, table: ExportTable):
+        self.table = table
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+
+    def write(self, batch: List[Dict[str, Any]]) -> None:
+        names = self.table.column_names
+        self._file.writelines(
+            json.dumps(dict(zip(names, values)), ensure_ascii=False) + '\n'
+            for values in convert_rows(self.table, batch)
+        )
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ParquetExportWriter:
+    """Parquet со сжатием zstd; пишется группами строк по мере чтения"""
+
+    extension = 'parquet'
+
+    def __init__(self, path: str, table: ExportTable):
+        if pyarrow is None:
+            raise RuntimeError("Для выгрузки в Parquet установите пакет pyarrow")
+        types = {'int': pyarrow.int64(), 'bool': pyarrow.bool_(), 'str': pyarrow.string()}
+        self.table = table
+        self._schema = pyarrow.schema([(name, types[kind]) for name, kind in table.columns])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+
+    def write(self, batch: List[Dict[str, Any]]) -> None:
+        # Каждый пакет становится отдельной группой строк
+        columns = list(zip(*convert_rows(self.table, batch)))
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self._schema)],
+            schema=self._schema
+        ))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+EXPORT_WRITERS = {
+    'csv': CsvExportWriter,
+    'jsonl': JsonlExportWriter,
+    'parquet': ParquetExportWriter,
+}
+
+
+def iter_archive_rows(archive_dir: str, table: ExportTable, since: Optional[str],
+                      until: Optional[str], batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Строки запросов из архивных файлов, месяц которых попадает в период"""
+    for path in archive_files(archive_dir):
+        month_start, month_end = month_bounds(archive_month(path) + "-01")
+        if (since and month_end <= since) or (until and month_start >= until):
+            continue
+        yield from iter_table_rows(
+            path, 'requests', table.column_names, table.date_column, since, until, batch_size
+        )
+
+
+async def iterate_in_thread(batches: Iterator[List[Dict[str, Any]]]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Синхронный генератор пакетов, читаемый в пуле потоков"""
+    try:
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                return
+            yield batch
+    finally:
+        batches.close()
+
+
+async def export_table(storage: Storage, table_name: str, export_format: str, path: str,
+                       since: Optional[str] = None, until: Optional[str] = None,
+                       archive_dir: Optional[str] = None, batch_size: int = BATCH_SIZE) -> int:
+    """Выгрузка таблицы в файл; возвращает число строк.
+
+    since и until - границы фильтра по дате (since <= дата < until) в формате базы.
+    """
+    table = EXPORT_TABLES[table_name]
+    writer = EXPORT_WRITERS[export_format](path, table)
+    sources = []
+    if table_name == 'requests' and archive_dir:
+        sources.append(iterate_in_thread(iter_archive_rows(archive_dir, table, since, until, batch_size)))
+    sources.append(storage.iter_rows(table_name, table.column_names, table.date_column, since, until, batch_size))
+
+    exported = 0
+    try:
+        for source in sources:
+            async for batch in source:
+                # Распаковка, преобразование и сжатие - в потоке, бот продолжает отвечать
+                await asyncio.to_thread(writer.write, batch)
+                exported += len(batch)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return exported
+
+
+def export_file_name(table_name: str, export_format: str, since: Optional[str] = None,
+                     until: Optional[str] = None) -> str:
+    """Имя файла выгрузки с периодом"""
+    period = f"_{since or 'start'}_{until or 'now'}" if since or until else ""
+    return f"{table_name}{period}.{EXPORT_WRITERS[export_format].extension}"
+
+
+async def run_cli(args) -> None:
+    from config import Config
+    from database import DatabaseManager
+    from storage import PostgresStorage, SQLiteStorage
+
+    if Config.STORAGE_BACKEND == 'postgres':
+        storage = PostgresStorage(Config.DATABASE_URL, pool_size=2)
+    else:
+        storage = SQLiteStorage(DatabaseManager(Config.DATABASE_NAME, pool_size=2))
+    await storage.connect()
+    try:
+        path = args.output or export_file_name(args.table, args.format, args.since, args.until)
+        exported = await export_table(
+            storage, args.table, args.format, path, args.since_bound, args.until_bound,
+            archive_dir=None if args.no_archive else Config.ARCHIVE_DIR,
+            batch_size=args.batch_size
+        )
+        print(f"Выгружено строк: {exported} -> {path} ({os.path.getsize(path)} байт)")
+    finally:
+        await storage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--format', choices=sorted(EXPORT_WRITERS), default='csv')
+    parser.add_argument('--since', help="с даты ГГГГ-ММ-ДД включительно")
+    parser.add_argument('--until', help="по дату ГГГГ-ММ-ДД включительно")
+    parser.add_argument('-o', '--output', help="файл выгрузки (по умолчанию по имени таблицы)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--no-archive', action='store_true', help="без архивов журнала запросов")
+    args = parser.parse_args()
+
+    try:
+        args.since_bound, args.until_bound = parse_date_range(args.since, args.until)
+    except ValueError as e:
+        parser.error(f"неверный период: {e}")
+    asyncio.run(run_cli(args))
+
+
+if __name__ == "__main__":
+    main()
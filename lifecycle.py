@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import signal
+from typing import Set, Tuple
+
+from telebot.async_telebot import AsyncTeleBot
+
+# Сколько ждать завершения обработчиков, отмененных по истечении срока (сек)
+CANCEL_TIMEOUT = 5.0
+
+
+class Lifecycle:
+    """Запуск и плавная остановка процесса бота.
+
+    По SIGTERM или SIGINT процесс перестает принимать обновления и дожидается
+    начатых обработчиков в пределах срока. Оставшиеся отменяются: обработчик
+    запроса к AI при отмене возвращает резерв баланса. Готовность (для /readyz)
+    выставляется после запуска и снимается в начале остановки.
+    """
+
+    def __init__(self, drain_timeout: float = 25.0):
+        self.drain_timeout = drain_timeout
+        self.stopping = False
+        self._ready = False
+        self._stop = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def ready(self) -> bool:
+        """Процесс запущен и принимает обновления"""
+        return self._ready and not self.stopping
+
+    @property
+    def in_flight(self) -> int:
+        """Пакеты обновлений и запущенные ими задачи, выполняемые прямо сейчас"""
+        return len(self._tasks)
+
+    def set_ready(self) -> None:
+        self._ready = True
+        logging.info("Бот готов принимать обновления")
+
+    def install_signal_handlers(self) -> None:
+        """Остановка по SIGTERM (перезапуск при деплое) и SIGINT (Ctrl+C)"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except NotImplementedError:  # Windows: сигналы обрабатывает только KeyboardInterrupt
+                pass
+
+    def request_stop(self, reason: str = "запрос") -> None:
+        if self.stopping:
+            return
+        logging.warning(f"Остановка ({reason}), в обработке пакетов обновлений: {self.in_flight}")
+        self.stopping = True
+        self._stop.set()
+
+    async def wait_stop(self) -> None:
+        await self._stop.wait()
+
+    def track_updates(self, bot: AsyncTeleBot) -> None:
+        """Учет обработки обновлений бота: и polling, и вебхук вызывают process_new_updates"""
+        process_new_updates = bot.process_new_updates
+
+        async def tracked(updates):
+            # Отдельная задача: ее можно дождаться или отменить, не трогая вызывающего
+            task = asyncio.ensure_future(process_new_updates(updates))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return await task
+
+        bot.process_new_updates = tracked
+
+    def spawn(self, coro) -> asyncio.Task:
+        """Запуск долгой работы обработчика отдельной задачей, которую дождется остановка"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def drain(self, timeout: float) -> Tuple[int, int]:
+        """Ожидание начатых обработчиков; по истечении срока они отменяются.
+
+        Возвращает (дождались, отменили).
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        finished = 0
+        # Пока идет ожидание, вебхук может передать обработчикам обновления из очереди
+        while self._tasks and loop.time() < deadline:
+            pending = set(self._tasks)
+            done, _ = await asyncio.wait(pending, timeout=deadline - loop.time())
+            finished += len(done)
+
+        abandoned = set(self._tasks)
+        for task in abandoned:
+            task.cancel()
+        if abandoned:
+            logging.warning(f"Срок остановки истек, отменено пакетов обновлений: {len(abandoned)}")
+            await asyncio.wait(abandoned, timeout=CANCEL_TIMEOUT)
+        return finished, len(abandoned)
@@ -0,0 +1,378 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Sequence, Set, Union
+
+import openai
+from openai import AsyncOpenAI
+
+from metrics import OPENAI_ATTEMPTS, OPENAI_HEDGES, OPENAI_LATENCY
+from ratelimit import estimate_tokens
+
+# Минимальный запас токенов на ответ при выборе модели по длине промпта
+MIN_ANSWER_TOKENS = 256
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.InternalServerError,
+    openai.APIConnectionError,
+)
+
+
+class LLMTimeoutError(Exception):
+    """Запрос к OpenAI не уложился в отведенное время со всеми повторами"""
+
+
+def error_outcome(error: Exception) -> str:
+    """Метка исхода неудачной попытки для метрик"""
+    if isinstance(error, openai.RateLimitError):
+        return 'rate_limited'
+    if isinstance(error, openai.InternalServerError):
+        return 'server_error'
+    if isinstance(error, openai.APIConnectionError):
+        return 'connection_error'
+    return 'error'
+
+
+class ModelRoute:
+    """Модель для промптов, помещающихся в ее контекст, и лимит длины ответа"""
+
+    def __init__(self, model: str, context_window: int, max_tokens: int):
+        self.model = model
+        self.context_window = context_window
+        self.max_tokens = max_tokens
+
+
+def parse_routes(spec: str) -> List[ModelRoute]:
+    """Маршруты из строки вида "gpt-4o-mini:16000:1000,gpt-4o:128000:2000" """
+    routes = []
+    for item in spec.split(','):
+        model, context_window, max_tokens = item.strip().rsplit(':', 2)
+        routes.append(ModelRoute(model, int(context_window), int(max_tokens)))
+    return sorted(routes, key=lambda route: route.context_window)
+
+
+class Route:
+    """Выбранная для запроса модель, лимит ответа и резервные модели"""
+
+    def __init__(self, model: str, max_tokens: int, fallbacks: Sequence[str], prompt_tokens: int):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.fallbacks = list(fallbacks)
+        self.prompt_tokens = prompt_tokens
+
+
+class RoutingPolicy:
+    """Выбор модели по длине промпта: первая по размеру контекста, в которую он помещается"""
+
+    def __init__(self, routes: Sequence[ModelRoute], fallbacks: Sequence[str] = ()):
+        if not routes:
+            raise ValueError("Нужен хотя бы один маршрут модели")
+        self.routes = sorted(routes, key=lambda route: route.context_window)
+        self.fallbacks = list(fallbacks)
+
+    @property
+    def primary_model(self) -> str:
+        return self.routes[0].model
+
+    def route(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Route:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        # Если промпт не помещается никуда, берем модель с самым большим контекстом
+        chosen = next(
+            (route for route in self.routes if prompt_tokens + MIN_ANSWER_TOKENS <= route.context_window),
+            self.routes[-1]
+        )
+        answer_tokens = min(max_tokens or chosen.max_tokens, chosen.context_window - prompt_tokens)
+        return Route(
+            chosen.model,
+            max(answer_tokens, 1),
+            [model for model in self.fallbacks if model != chosen.model],
+            prompt_tokens
+        )
+
+
+class LatencyTracker:
+    """Скользящее окно времен ответа для выбора момента дублирующего запроса"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[Hashable, Deque[float]] = {}
+
+    def record(self, key: Hashable, seconds: float) -> None:
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def quantile(self, key: Hashable, q: float) -> Optional[float]:
+        """Квантиль времени ответа или None, пока замеров слишком мало"""
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Completion:
+    """Ответ модели целиком"""
+
+    def __init__(self, text: str, tokens_used: int, model: str):
+        self.text = text
+        self.tokens_used = tokens_used
+        self.model = model
+
+
+class CompletionStream:
+    """Потоковый ответ модели; первый фрагмент уже получен при открытии"""
+
+    def __init__(self, stream, model: str, idle_timeout: float):
+        self.model = model
+        self.tokens_used = 0
+        self._stream = stream
+        self._chunks = stream.__aiter__()
+        self._idle_timeout = idle_timeout
+        self._buffer: List[str] = []
+
+    async def _next_text(self) -> Optional[str]:
+        """Следующий непустой фрагмент текста или None в конце потока"""
+        while True:
+            try:
+                # Поток, замолчавший дольше idle_timeout, считается зависшим
+                chunk = await asyncio.wait_for(self._chunks.__anext__(), self._idle_timeout)
+            except StopAsyncIteration:
+                return None
+            # Последний фрагмент потока содержит только статистику токенов
+            if chunk.usage:
+                self.tokens_used = chunk.usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                return chunk.choices[0].delta.content
+
+    async def prefetch(self) -> None:
+        """Ожидание первого фрагмента: до него запрос еще можно повторить"""
+        text = await self._next_text()
+        if text is not None:
+            self._buffer.append(text)
+
+    async def __aiter__(self):
+        while self._buffer:
+            yield self._buffer.pop(0)
+        while True:
+            text = await self._next_text()
+            if text is None:
+                return
+            yield text
+
+    async def close(self) -> None:
+        await self._stream.close()
+
+
+class LLMClient:
+    """Запросы к OpenAI со сроками, повторами, дублированием и резервными моделями.
+
+    Каждая попытка ограничена attempt_timeout, все попытки вместе - deadline.
+    После 429/5xx и сетевых ошибок попытка повторяется с экспоненциальной
+    задержкой со случайным разбросом, после таймаута - сразу на следующей
+    резервной модели. Если включено дублирование, то при отсутствии ответа
+    дольше квантиля hedge_quantile отправляется второй такой же запрос
+    (к резервной модели, если она есть) и берется первый ответ.
+
+    Вместо клиента можно передать фабрику: клиент создается при первом запросе.
+    """
+
+    def __init__(self, client: Union[AsyncOpenAI, Callable[[], AsyncOpenAI]], policy: RoutingPolicy,
+                 deadline: float = 60, attempt_timeout: float = 30, max_attempts: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8, hedge: bool = False,
+                 hedge_quantile: float = 0.95, stream_idle_timeout: float = 30):
+        self._client = client
+        self.policy = policy
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.stream_idle_timeout = stream_idle_timeout
+        self.latency = LatencyTracker()
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if not isinstance(self._client, AsyncOpenAI):
+            self._client = self._client()
+        return self._client
+
+    async def close(self) -> None:
+        """Закрытие соединений клиента, если он был создан"""
+        if isinstance(self._client, AsyncOpenAI):
+            await self._client.close()
+
+    def route(self, messages: List[Dict[str, str]], max_tokens: Optional[int] = None) -> Route:
+        return self.policy.route(messages, max_tokens)
+
+    async def complete(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                       route: Optional[Route] = None) -> Completion:
+        """Ответ модели одним запросом"""
+        route = route or self.route(messages)
+
+        async def call(model: str) -> Completion:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=route.max_tokens,
+                temperature=temperature
+            )
+            return Completion(response.choices[0].message.content, response.usage.total_tokens, model)
+
+        return await self._run(route, 'complete', call)
+
+    async def stream(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                     route: Optional[Route] = None) -> CompletionStream:
+        """Потоковый ответ; сроки, повторы и дублирование действуют до первого фрагмента"""
+        route = route or self.route(messages)
+
+        async def call(model: str) -> CompletionStream:
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=route.max_tokens,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            result = CompletionStream(stream, model, self.stream_idle_timeout)
+            try:
+                await result.prefetch()
+            except BaseException:
+                await result.close()
+                raise
+            return result
+
+        return await self._run(route, 'stream', call, discard=lambda result: result.close())
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        """Задержка перед повтором: полный джиттер, но не меньше Retry-After"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if isinstance(error, openai.APIStatusError):
+            try:
+                delay = max(delay, float(error.response.headers.get('retry-after', 0)))
+            except ValueError:
+                pass
+        return delay
+
+    async def _run(self, route: Route, kind: str, call: Callable[[str], Awaitable[Any]],
+                   discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        """Попытки запроса в пределах общего срока"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        models = [route.model, *route.fallbacks]
+        model_index = 0
+        last_error: Optional[Exception] = None
+
+        for attempt in range(self.max_attempts):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            model = models[model_index]
+            hedge_model = models[model_index + 1] if model_index + 1 < len(models) else model
+            try:
+                return await self._attempt(
+                    kind, call, model, hedge_model, min(self.attempt_timeout, remaining), discard
+                )
+            except asyncio.TimeoutError as e:
+                # Модель не ответила вовремя: следующая попытка - на резервной модели
+                last_error = e
+                delay = 0.0
+                model_index = min(model_index + 1, len(models) - 1)
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                delay = self._backoff(attempt, e)
+
+            if attempt + 1 == self.max_attempts or loop.time() + delay >= deadline:
+                break
+            logging.warning(
+                f"Запрос к OpenAI ({model}) не удался: {last_error!r}; повтор через {delay:.1f} с"
+            )
+            await asyncio.sleep(delay)
+
+        if last_error is None or isinstance(last_error, asyncio.TimeoutError):
+            raise LLMTimeoutError(f"OpenAI не ответил за {self.deadline:.0f} с") from last_error
+        raise last_error
+
+    async def _attempt(self, kind: str, call: Callable[[str], Awaitable[Any]], model: str,
+                       hedge_model: str, timeout: float,
+                       discard: Optional[Callable[[Any], Awaitable[None]]]) -> Any:
+        """Одна попытка, при необходимости с дублирующим запросом"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        primary = asyncio.create_task(self._timed(kind, call, model))
+        tasks: Set[asyncio.Task] = {primary}
+        hedged: Optional[asyncio.Task] = None
+
+        try:
+            hedge_after = self.latency.quantile((kind, model), self.hedge_quantile) if self.hedge else None
+            if hedge_after is not None and hedge_after < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    hedged = asyncio.create_task(self._timed(kind, call, hedge_model))
+                    tasks.add(hedged)
+
+            winner = await self._first_success(tasks, deadline)
+            if hedged is not None:
+                OPENAI_HEDGES.labels('won' if winner is hedged else 'lost').inc()
+            return winner.result()
+        finally:
+            for task in tasks:
+                self._abandon(task, discard)
+
+    async def _first_success(self, tasks: Set[asyncio.Task], deadline: float) -> asyncio.Task:
+        """Первая успешно завершившаяся задача; ошибка, если успешных нет"""
+        loop = asyncio.get_running_loop()
+        pending = set(tasks)
+        last_error: Optional[BaseException] = None
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    tasks.discard(task)
+                    return task
+                last_error = task.exception()
+        raise last_error
+
+    def _abandon(self, task: asyncio.Task, discard: Optional[Callable[[Any], Awaitable[None]]]) -> None:
+        """Отмена проигравшего запроса; поток, успевший открыться, закрывается"""
+        def cleanup(finished: asyncio.Task) -> None:
+            if finished.cancelled() or finished.exception() is not None:
+                return
+            if discard is not None:
+                asyncio.ensure_future(discard(finished.result()))
+
+        task.cancel()
+        task.add_done_callback(cleanup)
+
+    async def _timed(self, kind: str, call: Callable[[str], Awaitable[Any]], model: str) -> Any:
+        """Запрос к модели с учетом времени ответа и исхода"""
+        started = time.perf_counter()
+        try:
+            result = await call(model)
+        except asyncio.CancelledError:
+            OPENAI_ATTEMPTS.labels(model, 'cancelled').inc()
+            raise
+        except Exception as e:
+            OPENAI_ATTEMPTS.labels(model, error_outcome(e)).inc()
+            raise
+
+        elapsed = time.perf_counter() - started
+        self.latency.record((kind, model), elapsed)
+        OPENAI_LATENCY.labels(model).observe(elapsed)
+        OPENAI_ATTEMPTS.labels(model, 'ok').inc()
+        return result
+
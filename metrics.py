@@ -0,0 +1,123 @@
+import functools
+import logging
+from typing import Callable, Optional
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Границы корзин гистограмм (сек): от быстрых запросов к SQLite до долгих ответов OpenAI
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0)
+DB_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+HANDLER_REQUESTS = Counter(
+    'bot_handler_requests_total', "Обновления, переданные обработчику", ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', "Обновления, обработка которых завершилась ошибкой", ['handler']
+)
+HANDLER_IN_FLIGHT = Gauge(
+    'bot_handler_in_flight', "Обновления, обрабатываемые прямо сейчас", ['handler']
+)
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', "Полное время работы обработчика", ['handler'],
+    buckets=LATENCY_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    'bot_stage_duration_seconds', "Время этапов обработки запроса к AI", ['stage'],
+    buckets=LATENCY_BUCKETS
+)
+OPENAI_TOKENS = Counter(
+    'bot_openai_tokens_total', "Токены, израсходованные в запросах к OpenAI", ['purpose']
+)
+OPENAI_IN_FLIGHT = Gauge(
+    'bot_openai_in_flight', "Выполняющиеся запросы к OpenAI"
+)
+OPENAI_QUEUED = Gauge(
+    'bot_openai_queued', "Запросы к OpenAI, ожидающие очереди"
+)
+OPENAI_ATTEMPTS = Counter(
+    'bot_openai_attempts_total', "Попытки запросов к OpenAI по модели и исходу", ['model', 'outcome']
+)
+OPENAI_HEDGES = Counter(
+    'bot_openai_hedged_total', "Дублирующие запросы к OpenAI: выиграл ли дубль гонку", ['outcome']
+)
+OPENAI_LATENCY = Histogram(
+    'bot_openai_response_seconds', "Время ответа OpenAI (для потока - до первого фрагмента)", ['model'],
+    buckets=LATENCY_BUCKETS
+)
+PROMO_ATTEMPTS = Counter(
+    'bot_promo_attempts_total', "Попытки активации промокодов по исходу", ['outcome']
+)
+BALANCE_HOLDS_EXPIRED = Counter(
+    'bot_balance_holds_expired_total', "Ответы, резерв которых истек до подтверждения"
+)
+OUTBOUND_SENDS = Counter(
+    'bot_telegram_sends_total', "Исходящие сообщения и правки по методу и исходу", ['method', 'outcome']
+)
+OUTBOUND_QUEUED = Gauge(
+    'bot_telegram_queued', "Сообщения и правки, ожидающие отправки"
+)
+DB_CONNECTION_WAIT = Histogram(
+    'bot_db_connection_wait_seconds', "Ожидание соединения из пула SQLite",
+    buckets=DB_WAIT_BUCKETS
+)
+
+
+def stage(name: str):
+    """Замер длительности этапа: with stage('balance_check'): ..."""
+    return STAGE_LATENCY.labels(name).time()
+
+
+def instrument_handler(name: str):
+    """Декоратор обработчика: счетчики вызовов и ошибок, время и число выполняющихся"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            HANDLER_REQUESTS.labels(name).inc()
+            with HANDLER_IN_FLIGHT.labels(name).track_inprogress(), HANDLER_LATENCY.labels(name).time():
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    HANDLER_ERRORS.labels(name).inc()
+                    raise
+        return wrapper
+    return decorator
+
+
+def track_scheduler(scheduler) -> None:
+    """Отдача состояния очереди запросов к OpenAI через gauge"""
+    OPENAI_IN_FLIGHT.set_function(lambda: scheduler.active)
+    OPENAI_QUEUED.set_function(lambda: scheduler.queued)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер с маршрутами /metrics и /readyz"""
+
+    def __init__(self, readiness: Optional[Callable[[], bool]] = None):
+        self.readiness = readiness
+        self.app = web.Application()
+        self.app.router.add_get('/metrics', metrics_handler)
+        self.app.router.add_get('/readyz', self.readyz_handler)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def readyz_handler(self, request: web.Request) -> web.Response:
+        """200, пока процесс принимает обновления; 503 при запуске и остановке"""
+        if self.readiness is None or self.readiness():
+            return web.Response(text="ok")
+        return web.Response(status=503, text="not ready")
+
+    async def start(self, host: str, port: int) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,181 @@
+import sqlite3
+import logging
+from typing import Callable, List, Sequence, Tuple, Union
+
+# Шаг миграции: SQL-выражение или функция, получающая соединение
+MigrationStep = Union[str, Callable[[sqlite3.Connection], None]]
+
+# Упорядоченный список миграций: (версия, описание, шаги).
+# Версия применённой миграции хранится в PRAGMA user_version.
+MIGRATIONS: List[Tuple[int, str, Sequence[MigrationStep]]] = [
+    (1, "Индексы для выборок по пользователю и по дате регистрации", [
+        "CREATE INDEX IF NOT EXISTS idx_requests_tg_id ON requests (tg_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+    ]),
+    (2, "Уникальное использование промокода пользователем", [
+        # Оставляем только первое использование, если были дубликаты
+        """DELETE FROM promo_usage WHERE id NOT IN (
+            SELECT MIN(id) FROM promo_usage GROUP BY promo_id, tg_id
+        )""",
+        # Счетчики учитывали и удаленные дубликаты
+        """UPDATE promo_codes SET used_count = (
+            SELECT COUNT(*) FROM promo_usage WHERE promo_usage.promo_id = promo_codes.id
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_usage_promo_tg ON promo_usage (promo_id, tg_id)",
+    ]),
+    (3, "Агрегированная статистика, обновляемая триггерами", [
+        """CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            total_requests INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            total_payments INTEGER NOT NULL DEFAULT 0,
+            total_stars INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            requests INTEGER NOT NULL DEFAULT 0,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            stars INTEGER NOT NULL DEFAULT 0
+        )""",
+        # Заполнение по уже существующим данным
+        """INSERT INTO stats_totals
+        (id, total_users, active_users, total_requests, total_tokens, total_payments, total_stars)
+        SELECT 1,
+            (SELECT COUNT(*) FROM users),
+            (SELECT COUNT(*) FROM users WHERE total_requests > 0),
+            (SELECT COALESCE(SUM(total_requests), 0) FROM users),
+            (SELECT COALESCE(SUM(tokens_used), 0) FROM requests),
+            (SELECT COUNT(*) FROM payments),
+            (SELECT COALESCE(SUM(stars_paid), 0) FROM payments)""",
+        """INSERT INTO stats_daily (day, new_users)
+        SELECT date(created_at), COUNT(*) FROM users WHERE true GROUP BY date(created_at)""",
+        """INSERT INTO stats_daily (day, requests, tokens)
+        SELECT date(created_at), COUNT(*), COALESCE(SUM(tokens_used), 0)
+        FROM requests WHERE true GROUP BY date(created_at)
+        ON CONFLICT (day) DO UPDATE SET requests = excluded.requests, tokens = excluded.tokens""",
+        """INSERT INTO stats_daily (day, payments, stars)
+        SELECT date(created_at), COUNT(*), COALESCE(SUM(stars_paid), 0)
+        FROM payments WHERE true GROUP BY date(created_at)
+        ON CONFLICT (day) DO UPDATE SET payments = excluded.payments, stars = excluded.stars""",
+        # Новый пользователь
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_totals SET total_users = total_users + 1 WHERE id = 1;
+            INSERT INTO stats_daily (day, new_users) VALUES (date(NEW.created_at), 1)
+            ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1;
+        END""",
+        # Списание запроса (счетчик в users растет вместе с балансом)
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_users_requests AFTER UPDATE OF total_requests ON users
+        WHEN NEW.total_requests <> OLD.total_requests
+        BEGIN
+            UPDATE stats_totals SET
+                total_requests = total_requests + NEW.total_requests - OLD.total_requests,
+                active_users = active_users
+                    + (OLD.total_requests = 0 AND NEW.total_requests > 0)
+                    - (OLD.total_requests > 0 AND NEW.total_requests = 0)
+            WHERE id = 1;
+            INSERT INTO stats_daily (day, requests)
+            VALUES (date('now'), NEW.total_requests - OLD.total_requests)
+            ON CONFLICT (day) DO UPDATE SET requests = requests + excluded.requests;
+        END""",
+        # Токены приходят вместе с записью журнала запросов
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_requests_insert AFTER INSERT ON requests
+        BEGIN
+            UPDATE stats_totals SET total_tokens = total_tokens + NEW.tokens_used WHERE id = 1;
+            INSERT INTO stats_daily (day, tokens) VALUES (date(NEW.created_at), NEW.tokens_used)
+            ON CONFLICT (day) DO UPDATE SET tokens = tokens + excluded.tokens;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_payments_insert AFTER INSERT ON payments
+        BEGIN
+            UPDATE stats_totals SET
+                total_payments = total_payments + 1,
+                total_stars = total_stars + NEW.stars_paid
+            WHERE id = 1;
+            INSERT INTO stats_daily (day, payments, stars) VALUES (date(NEW.created_at), 1, NEW.stars_paid)
+            ON CONFLICT (day) DO UPDATE SET payments = payments + 1, stars = stars + excluded.stars;
+        END""",
+    ]),
+    (4, "Состояние диалога: резюме и точка сброса контекста", [
+        """CREATE TABLE IF NOT EXISTS conversations (
+            tg_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            summary_until TIMESTAMP,
+            reset_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ]),
+    (5, "Резервирование баланса на время запроса к OpenAI", [
+        """CREATE TABLE IF NOT EXISTS balance_holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tg_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at REAL NOT NULL,
+            FOREIGN KEY (tg_id) REFERENCES users (tg_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_balance_holds_expires ON balance_holds (expires_at)",
+    ]),
+    (6, "Рассылки и отметка пользователей, заблокировавших бота", [
+        "ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE",
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_tg_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )""",
+    ]),
+    (7, "Индекс по дате запроса для архивирования старых записей", [
+        "CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests (created_at)",
+    ]),
+    (8, "Кампании промокодов для массовой генерации", [
+        "ALTER TABLE promo_codes ADD COLUMN campaign TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_campaign ON promo_codes (campaign)",
+    ]),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы базы данных"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """Применение недостающих миграций; каждая выполняется в своей транзакции"""
+    conn.commit()
+    for version, description, steps in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+
+        # BEGIN IMMEDIATE не дает двум процессам применить миграцию одновременно
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+
+            logging.info(f"Применение миграции {version}: {description}")
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logging.error(f"Ошибка применения миграции {version}")
+            raise
+
+    return get_schema_version(conn)
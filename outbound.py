@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+
+from telebot.async_telebot import AsyncTeleBot
+import aiohttp
+from telebot.asyncio_helper import ApiHTTPException, ApiTelegramException
+
+from metrics import OUTBOUND_QUEUED, OUTBOUND_SENDS
+from ratelimit import TokenBucket
+
+# Сколько раз повторять отправку после 429 и сетевых ошибок
+MAX_SEND_ATTEMPTS = 5
+# Повторная правка не создает дублей, поэтому правки повторяются и после таймаутов
+IDEMPOTENT_METHODS = {'edit_message_text'}
+# Правка, не изменившая текст, - не ошибка: нужный текст уже показан
+NOT_MODIFIED = "message is not modified"
+
+
+def retry_after(error: ApiTelegramException) -> Optional[float]:
+    """Пауза из ответа 429, если Telegram ее указал"""
+    parameters = (error.result_json or {}).get('parameters') or {}
+    return parameters.get('retry_after')
+
+
+def is_retryable(method: str, error: Exception) -> bool:
+    """Можно ли повторить запрос после ошибки, не рискуя отправить сообщение дважды.
+
+    Ответ 5xx и ошибка соединения означают, что сообщение не было принято.
+    Таймаут или обрыв после отправки запроса неоднозначны: Telegram мог уже
+    доставить сообщение, и повтор send_message создал бы дубль.
+    """
+    if isinstance(error, ApiTelegramException):
+        return error.error_code >= 500
+    if isinstance(error, ApiHTTPException):
+        return error.result.status >= 500
+    return method in IDEMPOTENT_METHODS or isinstance(error, aiohttp.ClientConnectorError)
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """Части текста не длиннее limit, по возможности по границам строк"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+class OutboundMessage:
+    """Отправка или правка, ожидающая своей очереди в чате"""
+
+    def __init__(self, method: str, kwargs: Dict[str, Any]):
+        self.method = method
+        self.kwargs = kwargs
+        # Запрос уже ушел в Telegram: заменять текст поздно
+        self.sending = False
+        # Все, кто ждет этой отправки, в том числе авторы замененных правок
+        self.futures: List[asyncio.Future] = []
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        for future in self.futures:
+            if future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class ChatQueue:
+    """Очередь одного чата: сообщения уходят строго по порядку"""
+
+    def __init__(self, rate: float, burst: float):
+        self.pending: Deque[OutboundMessage] = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.paused_until = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def idle(self) -> bool:
+        return not self.pending and self.task is None
+
+
+class OutboundDispatcher:
+    """Исходящие сообщения и правки бота в пределах лимитов Telegram.
+
+    У каждого чата своя очередь: сообщения одного чата уходят по порядку
+    и не чаще chat_rate, все чаты вместе - не чаще global_rate. После 429
+    отправка повторяется через retry_after, а не превращается в ошибку
+    обработчика. Еще не отправленная правка сообщения заменяется более
+    новой правкой того же сообщения: промежуточный текст потокового ответа
+    не отправляется, если его уже обогнал следующий.
+
+    Массовые отправки (рассылки) берут места в том же общем темпе через
+    acquire_bulk, но только те, что не нужны ответам пользователям.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, concurrency: int = 20, request_timeout: float = 15,
+                 max_chats: int = 10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.request_timeout = request_timeout
+        self.max_chats = max_chats
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._paused_until = 0.0
+        # Сколько чатов сейчас ждет общего темпа: пока они есть, рассылки ждут
+        self._waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Очереди хранятся и после опустошения, чтобы темп чата не сбрасывался
+        self._chats: "OrderedDict[int, ChatQueue]" = OrderedDict()
+        OUTBOUND_QUEUED.set_function(lambda: self.queued)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(chat.pending) for chat in self._chats.values())
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        """Отправка сообщения после уже поставленных в очередь этого чата"""
+        return await self._enqueue(chat_id, 'send_message', dict(chat_id=chat_id, text=text, **kwargs))
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs):
+        """Правка сообщения; ожидающая правка того же сообщения заменяется этой"""
+        return await self._enqueue(
+            chat_id, 'edit_message_text',
+            dict(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+
+    def edit_message_text_nowait(self, text: str, chat_id: int, message_id: int, **kwargs) -> None:
+        """Промежуточная правка без ожидания: ошибки только пишутся в лог"""
+        future = self._enqueue(
+            chat_id, 'edit_message_text',
+            dict(text=text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+        future.add_done_callback(self._log_failure)
+
+    async def acquire_bulk(self) -> None:
+        """Место в общем темпе для массовой отправки с наименьшим приоритетом"""
+        while True:
+            delay = max(self._paused_until - time.monotonic(), self._bucket.wait_time())
+            if delay <= 0 and not self._waiting:
+                self._bucket.try_consume()
+                return
+            await asyncio.sleep(max(delay, 1 / self._bucket.rate))
+
+    def pause(self, seconds: float) -> None:
+        """Пауза всех отправок после 429, полученного в обход очередей"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Досылка очередей при остановке; то, что не успело уйти, отменяется"""
+        tasks = [chat.task for chat in self._chats.values() if chat.task]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning(f"Не отправлены сообщения в {len(pending)} чатах при остановке")
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def _enqueue(self, chat_id: int, method: str, kwargs: Dict[str, Any]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chat(chat_id)
+
+        if method == 'edit_message_text':
+            for item in chat.pending:
+                if (item.method == method and not item.sending
+                        and item.kwargs['message_id'] == kwargs['message_id']):
+                    # Прежний текст уже неактуален: отправится только новый
+                    item.kwargs = kwargs
+                    item.futures.append(future)
+                    OUTBOUND_SENDS.labels(method, 'coalesced').inc()
+                    return future
+
+        item = OutboundMessage(method, kwargs)
+        item.futures.append(future)
+        chat.pending.append(item)
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._drain(chat))
+        return future
+
+    def _chat(self, chat_id: int) -> ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = ChatQueue(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = chat
+            self._evict()
+        self._chats.move_to_end(chat_id)
+        return chat
+
+    def _evict(self) -> None:
+        # Забываем давно молчавшие чаты; чаты с очередью не трогаем
+        excess = len(self._chats) - self.max_chats
+        for chat_id in list(self._chats):
+            if excess <= 0:
+                break
+            if self._chats[chat_id].idle:
+                del self._chats[chat_id]
+                excess -= 1
+
+    async def _drain(self, chat: ChatQueue) -> None:
+        """Отправка очереди чата по одному сообщению"""
+        try:
+            while chat.pending:
+                item = chat.pending[0]
+                try:
+                    result = await self._deliver(chat, item)
+                except asyncio.CancelledError:
+                    item.resolve(error=asyncio.CancelledError())
+                    raise
+                except Exception as e:
+                    item.resolve(error=e)
+                else:
+                    item.resolve(result)
+                finally:
+                    chat.pending.popleft()
+        finally:
+            # При отмене ждущие оставшихся сообщений не должны висеть вечно
+            for item in chat.pending:
+                item.resolve(error=asyncio.CancelledError())
+            chat.pending.clear()
+            chat.task = None
+
+    async def _pace(self, chat: ChatQueue) -> None:
+        """Ожидание темпа чата, общего темпа и пауз после 429"""
+        while True:
+            now = time.monotonic()
+            global_delay = max(self._paused_until - now, self._bucket.wait_time())
+            delay = max(chat.paused_until - now, chat.bucket.wait_time(), global_delay)
+            if delay <= 0:
+                chat.bucket.try_consume()
+                self._bucket.try_consume()
+                return
+            # Рассылки уступают место только тем, кого держит общий темп
+            waiting = global_delay > 0
+            self._waiting += waiting
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._waiting -= waiting
+
+    async def _deliver(self, chat: ChatQueue, item: OutboundMessage):
+        method = getattr(self.bot, item.method)
+        error: Optional[Exception] = None
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            await self._pace(chat)
+            # Текст берется в последний момент: правка могла обновиться, пока ждала темпа
+            kwargs = item.kwargs
+            item.sending = True
+            try:
+                async with self._semaphore:
+                    result = await asyncio.wait_for(method(**kwargs), self.request_timeout)
+                OUTBOUND_SENDS.labels(item.method, 'sent').inc()
+                return result
+            except ApiTelegramException as e:
+                error = e
+                if e.error_code == 429:
+                    pause = retry_after(e) or 1
+                    chat.paused_until = time.monotonic() + pause
+                    # Долгая пауза обычно означает ограничение бота целиком, а не одного чата
+                    if pause > 1:
+                        self._paused_until = max(self._paused_until, chat.paused_until)
+                    OUTBOUND_SENDS.labels(item.method, 'throttled').inc()
+                    logging.warning(f"Telegram 429 для чата {kwargs['chat_id']}, пауза {pause} с")
+                    continue
+                if NOT_MODIFIED in (e.description or ''):
+                    OUTBOUND_SENDS.labels(item.method, 'sent').inc()
+                    return None
+                if not is_retryable(item.method, e):
+                    OUTBOUND_SENDS.labels(item.method, 'failed').inc()
+                    raise
+                logging.warning(f"Ошибка Telegram для чата {kwargs['chat_id']}: {e}")
+            except Exception as e:
+                error = e
+                logging.warning(f"Ошибка отправки в чат {kwargs['chat_id']}: {e!r}")
+                if not is_retryable(item.method, e):
+                    # Сообщение могло уже дойти: решение о повторе остается за вызывающим
+                    OUTBOUND_SENDS.labels(item.method, 'failed').inc()
+                    raise
+            finally:
+                item.sending = False
+            if attempt < MAX_SEND_ATTEMPTS - 1:
+                await asyncio.sleep(2 ** attempt)
+
+        OUTBOUND_SENDS.labels(item.method, 'failed').inc()
+        raise error
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logging.warning(f"Не удалось обновить сообщение: {error}")
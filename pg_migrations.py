@@ -0,0 +1,191 @@
+import logging
+from typing import List, Sequence, Tuple
+
+# Ключ advisory-блокировки, под которой применяются миграции
+MIGRATION_LOCK_ID = 727001
+
+# Упорядоченный список миграций PostgreSQL: (версия, описание, SQL-выражения).
+# Схема соответствует SQLite-схеме с миграциями из migrations.py.
+PG_MIGRATIONS: List[Tuple[int, str, Sequence[str]]] = [
+    (1, "Начальная схема: таблицы, индексы, статистика на триггерах, диалоги", [
+        """CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            tg_id BIGINT UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            balance INTEGER DEFAULT 0,
+            total_requests INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+            updated_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )""",
+        """CREATE TABLE IF NOT EXISTS payments (
+            id BIGSERIAL PRIMARY KEY,
+            tg_id BIGINT NOT NULL REFERENCES users (tg_id),
+            amount INTEGER NOT NULL,
+            stars_paid INTEGER NOT NULL,
+            payment_id TEXT UNIQUE,
+            status TEXT DEFAULT 'completed',
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )""",
+        """CREATE TABLE IF NOT EXISTS promo_codes (
+            id BIGSERIAL PRIMARY KEY,
+            code TEXT UNIQUE NOT NULL,
+            requests INTEGER NOT NULL,
+            max_uses INTEGER,
+            used_count INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )""",
+        """CREATE TABLE IF NOT EXISTS promo_usage (
+            id BIGSERIAL PRIMARY KEY,
+            promo_id BIGINT NOT NULL REFERENCES promo_codes (id),
+            tg_id BIGINT NOT NULL REFERENCES users (tg_id),
+            used_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+            UNIQUE (promo_id, tg_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS requests (
+            id BIGSERIAL PRIMARY KEY,
+            tg_id BIGINT NOT NULL REFERENCES users (tg_id),
+            prompt TEXT NOT NULL,
+            response TEXT,
+            tokens_used INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_requests_tg_id ON requests (tg_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+        """CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users BIGINT NOT NULL DEFAULT 0,
+            active_users BIGINT NOT NULL DEFAULT 0,
+            total_requests BIGINT NOT NULL DEFAULT 0,
+            total_tokens BIGINT NOT NULL DEFAULT 0,
+            total_payments BIGINT NOT NULL DEFAULT 0,
+            total_stars BIGINT NOT NULL DEFAULT 0
+        )""",
+        "INSERT INTO stats_totals (id) VALUES (1) ON CONFLICT (id) DO NOTHING",
+        """CREATE TABLE IF NOT EXISTS stats_daily (
+            day DATE PRIMARY KEY,
+            new_users BIGINT NOT NULL DEFAULT 0,
+            requests BIGINT NOT NULL DEFAULT 0,
+            tokens BIGINT NOT NULL DEFAULT 0,
+            payments BIGINT NOT NULL DEFAULT 0,
+            stars BIGINT NOT NULL DEFAULT 0
+        )""",
+        # Новый пользователь
+        """CREATE OR REPLACE FUNCTION stats_users_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_totals SET total_users = total_users + 1 WHERE id = 1;
+            INSERT INTO stats_daily (day, new_users) VALUES (NEW.created_at::date, 1)
+            ON CONFLICT (day) DO UPDATE SET new_users = stats_daily.new_users + 1;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE TRIGGER trg_stats_users_insert AFTER INSERT ON users
+        FOR EACH ROW EXECUTE FUNCTION stats_users_insert()""",
+        # Списание запроса (счетчик в users растет вместе с балансом)
+        """CREATE OR REPLACE FUNCTION stats_users_requests() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_totals SET
+                total_requests = total_requests + NEW.total_requests - OLD.total_requests,
+                active_users = active_users
+                    + (OLD.total_requests = 0 AND NEW.total_requests > 0)::int
+                    - (OLD.total_requests > 0 AND NEW.total_requests = 0)::int
+            WHERE id = 1;
+            INSERT INTO stats_daily (day, requests)
+            VALUES ((now() AT TIME ZONE 'utc')::date, NEW.total_requests - OLD.total_requests)
+            ON CONFLICT (day) DO UPDATE SET requests = stats_daily.requests + excluded.requests;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE TRIGGER trg_stats_users_requests AFTER UPDATE OF total_requests ON users
+        FOR EACH ROW WHEN (NEW.total_requests <> OLD.total_requests)
+        EXECUTE FUNCTION stats_users_requests()""",
+        # Токены приходят вместе с записью запроса
+        """CREATE OR REPLACE FUNCTION stats_requests_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_totals SET total_tokens = total_tokens + NEW.tokens_used WHERE id = 1;
+            INSERT INTO stats_daily (day, tokens) VALUES (NEW.created_at::date, NEW.tokens_used)
+            ON CONFLICT (day) DO UPDATE SET tokens = stats_daily.tokens + excluded.tokens;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE TRIGGER trg_stats_requests_insert AFTER INSERT ON requests
+        FOR EACH ROW EXECUTE FUNCTION stats_requests_insert()""",
+        """CREATE OR REPLACE FUNCTION stats_payments_insert() RETURNS trigger AS $$
+        BEGIN
+            UPDATE stats_totals SET
+                total_payments = total_payments + 1,
+                total_stars = total_stars + NEW.stars_paid
+            WHERE id = 1;
+            INSERT INTO stats_daily (day, payments, stars) VALUES (NEW.created_at::date, 1, NEW.stars_paid)
+            ON CONFLICT (day) DO UPDATE SET
+                payments = stats_daily.payments + 1, stars = stats_daily.stars + excluded.stars;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE TRIGGER trg_stats_payments_insert AFTER INSERT ON payments
+        FOR EACH ROW EXECUTE FUNCTION stats_payments_insert()""",
+        """CREATE TABLE IF NOT EXISTS conversations (
+            tg_id BIGINT PRIMARY KEY,
+            summary TEXT,
+            summary_until TIMESTAMP,
+            reset_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+        )""",
+    ]),
+    (2, "Резервирование баланса на время запроса к OpenAI", [
+        """CREATE TABLE IF NOT EXISTS balance_holds (
+            id BIGSERIAL PRIMARY KEY,
+            tg_id BIGINT NOT NULL REFERENCES users (tg_id),
+            amount INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+            expires_at TIMESTAMP NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_balance_holds_expires ON balance_holds (expires_at)",
+    ]),
+    (3, "Рассылки и отметка пользователей, заблокировавших бота", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE",
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_tg_id BIGINT NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+            updated_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+            finished_at TIMESTAMP
+        )""",
+    ]),
+    (4, "Индекс по дате запроса для архивирования старых записей", [
+        "CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests (created_at)",
+    ]),
+    (5, "Кампании промокодов для массовой генерации", [
+        "ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS campaign TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_promo_codes_campaign ON promo_codes (campaign)",
+    ]),
+]
+
+
+async def get_schema_version(conn) -> int:
+    """Текущая версия схемы PostgreSQL"""
+    await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version = await conn.fetchval("SELECT max(version) FROM schema_version")
+    return version or 0
+
+
+async def apply_pg_migrations(conn) -> int:
+    """Применение недостающих миграций; каждая выполняется в своей транзакции"""
+    for version, description, steps in PG_MIGRATIONS:
+        async with conn.transaction():
+            # Блокировка не дает двум процессам применить миграцию одновременно
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+            if version <= await get_schema_version(conn):
+                continue
+
+            logging.info(f"Применение миграции PostgreSQL {version}: {description}")
+            for step in steps:
+                await conn.execute(step)
+            await conn.execute("INSERT INTO schema_version (version) VALUES ($1)", version)
+
+    return await get_schema_version(conn)
@@ -0,0 +1,210 @@
+import asyncio
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+# Режимы /profile: выборка стеков всех потоков или cProfile потока цикла событий
+PROFILE_MODES = ('sample', 'cprofile')
+# Сколько функций показывать в отчете
+TOP_FUNCTIONS = 15
+# Код бота: отчет по умолчанию показывает только его функции, файл - все
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Функции, на которых поток ждет работы: такие стеки - простой, а не нагрузка
+IDLE_FUNCTIONS = {
+    'threading:Condition.wait',
+    'threading:Event.wait',
+    'queue:Queue.get',
+    'thread:_worker',
+    'selectors:EpollSelector.select',
+    'selectors:KqueueSelector.select',
+    'selectors:PollSelector.select',
+    'selectors:SelectSelector.select',
+}
+
+
+def frame_label(code) -> str:
+    """Имя функции в стеке: модуль:функция"""
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def is_project_code(filename: str) -> bool:
+    return filename.startswith(PROJECT_DIR) and 'site-packages' not in filename
+
+
+class SamplingProfiler:
+    """Профилировщик по выборке стеков всех потоков процесса.
+
+    Отдельный поток раз в interval секунд снимает стеки через
+    sys._current_frames(): видны и обработчики в цикле событий, и запросы
+    к базе в потоках пула. Выключенный профилировщик ничего не стоит -
+    потока просто нет.
+    """
+
+    def __init__(self, interval: float = 0.005, loop_thread: Optional[str] = None):
+        self.interval = interval
+        # Поток цикла событий: для него отчет показывает долю занятого времени
+        self.loop_thread = loop_thread
+        # (поток, функция от корня до листа, ...) -> число выборок
+        self.stacks: Counter = Counter()
+        # Функции, встреченные в выборке: имя -> признак кода бота
+        self.project: dict = {}
+        self.samples = 0
+        self.ticks = 0
+        self.duration = 0.0
+        # Время, потраченное самим профилировщиком
+        self.overhead = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.duration = time.perf_counter() - self._started
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            started = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = frame_label(code)
+                    if label not in self.project:
+                        self.project[label] = is_project_code(code.co_filename)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+                self.samples += 1
+            self.ticks += 1
+            self.overhead += time.perf_counter() - started
+
+    @property
+    def step(self) -> float:
+        """Время потока, которое представляет одна выборка (с учетом затрат на обход)"""
+        return self.duration / self.ticks if self.ticks else 0.0
+
+    def loop_busy(self) -> Optional[float]:
+        """Доля выборок, в которых цикл событий выполнял код, а не ждал событий"""
+        total = busy = 0
+        for stack, count in self.stacks.items():
+            if stack[0] == self.loop_thread:
+                total += count
+                busy += count if stack[-1] not in IDLE_FUNCTIONS else 0
+        return busy / total if total else None
+
+    def top_functions(self, limit: int = TOP_FUNCTIONS,
+                      project_only: bool = True) -> List[Tuple[str, int, int]]:
+        """(функция, выборок в стеке, выборок на вершине стека) по убыванию первого"""
+        cumulative: Counter = Counter()
+        own: Counter = Counter()
+        for stack, count in self.stacks.items():
+            # Ожидающие потоки в файле остаются, а в отчете заслонили бы нагрузку
+            if stack[-1] in IDLE_FUNCTIONS:
+                continue
+            # Рекурсия не должна засчитывать функцию дважды
+            for label in set(stack[1:]):
+                cumulative[label] += count
+            own[stack[-1]] += count
+        top = (
+            (label, count, own[label]) for label, count in cumulative.most_common()
+            if not project_only or self.project.get(label)
+        )
+        return [item for _, item in zip(range(limit), top)]
+
+    def write_collapsed(self, path: str) -> None:
+        """Файл свернутых стеков для flamegraph.pl, speedscope и аналогов"""
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(";".join(stack) + f" {count}\n")
+
+
+def format_sampling_report(profiler: SamplingProfiler) -> str:
+    """Текст отчета по выборке стеков для администратора"""
+    lines = [
+        f"🔬 Профиль по выборке: {profiler.duration:.1f} с, {profiler.samples} выборок стеков, "
+        f"затраты профилировщика {profiler.overhead:.2f} с",
+    ]
+    busy = profiler.loop_busy()
+    if busy is not None:
+        lines.append(f"Цикл событий занят {busy:.0%} времени")
+    lines += [
+        "",
+        "Код бота по совокупному времени без ожидания (в стеке / на вершине):",
+    ]
+    step = profiler.step
+    top = profiler.top_functions()
+    for label, cumulative, own in top:
+        lines.append(f"{cumulative * step:8.3f} с {own * step:8.3f} с  {label}")
+    if not top:
+        lines.append("нагрузки не было")
+    return "\n".join(lines)
+
+
+def format_cprofile_report(stats: pstats.Stats, duration: float) -> str:
+    """Текст отчета cProfile для администратора"""
+    lines = [
+        f"🔬 cProfile потока цикла событий: {duration:.1f} с "
+        "(запросы к базе в потоках пула сюда не попадают)",
+        "",
+        "Код бота по совокупному времени (всего / собственное, вызовов):",
+    ]
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    shown = 0
+    for (filename, line, name), (_, calls, own, cumulative, _) in rows:
+        if shown == TOP_FUNCTIONS:
+            break
+        if not is_project_code(filename):
+            continue
+        module = os.path.splitext(os.path.basename(filename))[0]
+        lines.append(f"{cumulative:8.3f} с {own:8.3f} с {calls:>7}  {module}:{name}")
+        shown += 1
+    return "\n".join(lines)
+
+
+async def run_profile(mode: str, seconds: float, directory: str,
+                      interval: float = 0.005) -> Tuple[str, str]:
+    """Профилирование живого процесса в течение seconds; возвращает (файл, текст отчета)"""
+    if mode == 'cprofile':
+        # cProfile видит только поток, в котором включен, - здесь это поток цикла событий
+        profile = cProfile.Profile()
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        duration = time.perf_counter() - started
+        path = os.path.join(directory, "profile.pstats")
+        profile.dump_stats(path)
+        return path, format_cprofile_report(pstats.Stats(profile), duration)
+
+    profiler = SamplingProfiler(interval, loop_thread=threading.current_thread().name)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(profiler.stop)
+    path = os.path.join(directory, "profile.collapsed.txt")
+    await asyncio.to_thread(profiler.write_collapsed, path)
+    return path, format_sampling_report(profiler)
@@ -0,0 +1,188 @@
+import asyncio
+import csv
+import hashlib
+import logging
+import math
+import re
+import secrets
+import time
+from typing import Iterable, List, Optional
+
+from ratelimit import UserRateLimiter
+
+# Алфавит кодов без похожих символов (0/O, 1/I/L), чтобы коды было легко вводить
+CODE_ALPHABET = "23456789ABCDEFGHJKMNPQRSTUVWXYZ"
+CODE_LENGTH = 10
+# Доля ложных срабатываний фильтра: такие коды проверяются в базе
+BLOOM_ERROR_RATE = 0.001
+# Запас емкости фильтра под коды, созданные между перестроениями
+BLOOM_HEADROOM = 2
+# Сколько раз досоздавать коды, совпавшие с уже существующими
+GENERATION_ROUNDS = 5
+# Имя кампании попадает в имя файла с кодами: только безопасные символы
+CAMPAIGN_NAME_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def normalize_code(code: str) -> str:
+    """Код в том виде, в котором он хранится в базе"""
+    return code.strip().upper()
+
+
+def is_valid_campaign_name(campaign: str) -> bool:
+    """Имя кампании без разделителей пути и прочих спецсимволов"""
+    return CAMPAIGN_NAME_RE.fullmatch(campaign) is not None
+
+
+def generate_codes(count: int, length: int = CODE_LENGTH, prefix: str = "") -> List[str]:
+    """Случайные неповторяющиеся коды; prefix помогает отличать кампании"""
+    codes = set()
+    while len(codes) < count:
+        codes.add(prefix + "".join(secrets.choice(CODE_ALPHABET) for _ in range(length)))
+    return list(codes)
+
+
+class BloomFilter:
+    """Фильтр Блума: «точно нет» или «возможно есть» без хранения самих строк"""
+
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Двойное хеширование: k позиций из двух половин одного дайджеста
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class PromoCodeIndex:
+    """Индекс активных промокодов в памяти.
+
+    Неизвестные коды (опечатки и перебор) отсекаются без обращения к базе.
+    Из фильтра Блума нельзя удалять, поэтому исчерпанные и отключенные коды
+    уходят из него только при перестроении; до этого их отклоняет база.
+    Коды, созданные другим процессом бота, появляются после перестроения.
+    """
+
+    def __init__(self):
+        self._filter: Optional[BloomFilter] = None
+        # Момент чтения кодов для последнего перестроения (time.monotonic())
+        self.refreshed_at = 0.0
+        self._capacity = 0
+        self._count = 0
+        # Коды, добавленные во время перестроения: их может не быть в выборке из базы
+        self._added_during_refresh: Optional[List[str]] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def rebuild(self, codes: List[str]) -> None:
+        """Новый фильтр по полному списку активных кодов"""
+        capacity = max(len(codes) * BLOOM_HEADROOM, 1000)
+        bloom = BloomFilter(capacity)
+        for code in codes:
+            bloom.add(code)
+        self._filter, self._capacity, self._count = bloom, capacity, len(codes)
+        logging.info(f"Индекс промокодов перестроен: {len(codes)} активных кодов")
+
+    async def refresh(self, storage) -> None:
+        """Перестроение по активным кодам из хранилища"""
+        self._added_during_refresh = []
+        try:
+            started = time.monotonic()
+            codes = await storage.get_active_promo_codes()
+            self.refreshed_at = started
+            self.rebuild(codes + self._added_during_refresh)
+        finally:
+            self._added_during_refresh = None
+
+    def add(self, codes: Iterable[str]) -> None:
+        """Добавление только что созданных кодов до следующего перестроения"""
+        codes = list(codes)
+        if self._added_during_refresh is not None:
+            self._added_during_refresh.extend(codes)
+        if self._filter is None:
+            return
+        for code in codes:
+            self._filter.add(code)
+            self._count += 1
+        if self._count > self._capacity:
+            # Доля ложных срабатываний растет; новые коды не потеряются, но база
+            # будет получать больше лишних запросов до перестроения
+            logging.warning("Индекс промокодов переполнен, нужно перестроение")
+
+    def might_exist(self, code: str) -> bool:
+        """False - кода точно нет среди активных; пока индекс не построен - True"""
+        return self._filter is None or code in self._filter
+
+
+class PromoGuard:
+    """Проверки перед активацией промокода: лимит попыток и индекс кодов.
+
+    Промах индекса может означать код, созданный другим процессом после
+    перестроения. Поэтому промах перестраивает индекс, если тот старше
+    miss_refresh_interval секунд, и код проверяется заново. Перебор кодов
+    вызывает не больше одного чтения активных кодов за этот интервал.
+    """
+
+    def __init__(self, index: PromoCodeIndex, storage, attempts_per_minute: float,
+                 attempts_burst: int, miss_refresh_interval: float = 10):
+        self.index = index
+        self.storage = storage
+        self.miss_refresh_interval = miss_refresh_interval
+        self.limiter = UserRateLimiter(per_minute=attempts_per_minute, burst=attempts_burst)
+        self._refresh_lock = asyncio.Lock()
+
+    async def check(self, user_id: int, code: str) -> str:
+        """'allowed', 'throttled' (слишком много попыток) или 'unknown' (кода нет)"""
+        # Лимит расходуется любой попыткой, иначе перебор по фильтру был бы бесплатным
+        if not self.limiter.allow(user_id):
+            return 'throttled'
+        if self.index.might_exist(code):
+            return 'allowed'
+        try:
+            await self._refresh_on_miss()
+        except Exception as e:
+            # Без свежего индекса решает база
+            logging.error(f"Ошибка перестроения индекса промокодов: {e}")
+            return 'allowed'
+        return 'allowed' if self.index.might_exist(code) else 'unknown'
+
+    async def _refresh_on_miss(self) -> None:
+        # Одновременные промахи ждут одного перестроения, а не запускают свои
+        async with self._refresh_lock:
+            if time.monotonic() - self.index.refreshed_at >= self.miss_refresh_interval:
+                await self.index.refresh(self.storage)
+
+
+async def create_campaign(storage, count: int, requests: int, max_uses: Optional[int],
+                          campaign: str, length: int = CODE_LENGTH) -> List[str]:
+    """Генерация и запись кодов кампании; возвращает все ее коды"""
+    created = 0
+    # Коды, совпавшие с существующими, пропускаются базой - досоздаем недостающие
+    for _ in range(GENERATION_ROUNDS):
+        created += await storage.create_promo_codes(
+            generate_codes(count - created, length), requests, max_uses, campaign
+        )
+        if created >= count:
+            break
+    return await storage.get_campaign_codes(campaign)
+
+
+def write_codes_file(path: str, codes: List[str], requests: int, max_uses: Optional[int]) -> None:
+    """CSV с кодами кампании для передачи партнерам"""
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['code', 'requests', 'max_uses'])
+        writer.writerows((code, requests, max_uses or '') for code in codes)
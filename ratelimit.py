@@ -0,0 +1,179 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Optional, Tuple
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов текста (около 3 символов на токен)"""
+    return len(text) // 3 + 1
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не более capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Через сколько секунд станет доступно amount токенов"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def try_consume(self, amount: float = 1.0) -> bool:
+        """Списание токенов, если их достаточно"""
+        if self.wait_time(amount) > 0:
+            return False
+        self.tokens -= min(amount, self.capacity)
+        return True
+
+    def adjust(self, amount: float) -> None:
+        """Возврат (amount > 0) или доплата (amount < 0) после уточнения расхода"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class UserRateLimiter:
+    """Отдельный token bucket для каждого пользователя"""
+
+    def __init__(self, per_minute: float, burst: int, max_users: int = 100000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        """Можно ли пользователю выполнить запрос прямо сейчас"""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[user_id] = bucket
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(user_id)
+        return bucket.try_consume()
+
+
+class SchedulerTimeout(Exception):
+    """Очередь к OpenAI не подошла за отведенное время"""
+
+
+class SchedulerSlot:
+    """Разрешение на один запрос к OpenAI; tokens_used уточняет расход TPM"""
+
+    def __init__(self, estimated_tokens: int):
+        self.estimated_tokens = estimated_tokens
+        self.tokens_used: Optional[int] = None
+
+
+class FairScheduler:
+    """Справедливая очередь запросов к OpenAI.
+
+    Пользователи обслуживаются по кругу (round-robin), так что один активный
+    пользователь не занимает всю пропускную способность. Общее число
+    одновременных запросов и бюджеты RPM/TPM ограничены.
+    """
+
+    def __init__(self, max_concurrency: int, rpm: int, tpm: int):
+        self.max_concurrency = max_concurrency
+        self._requests = TokenBucket(rpm / 60, rpm)
+        self._tokens = TokenBucket(tpm / 60, tpm)
+        self._waiting: "OrderedDict[int, Deque[Tuple[asyncio.Future, int]]]" = OrderedDict()
+        self._active = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        """Число запросов, ожидающих очереди"""
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    @property
+    def active(self) -> int:
+        """Число выполняющихся запросов"""
+        return self._active
+
+    def is_saturated(self) -> bool:
+        """Придется ли новому запросу ждать"""
+        return (
+            self._active >= self.max_concurrency
+            or bool(self._waiting)
+            or self._requests.wait_time(1) > 0
+        )
+
+    def _dispatch(self) -> None:
+        """Выдача разрешений ожидающим, пока позволяют лимиты"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._waiting and self._active < self.max_concurrency:
+            user_id, waiters = next(iter(self._waiting.items()))
+            future, tokens = waiters[0]
+            if future.done():
+                # Ожидание отменено
+                waiters.popleft()
+                if not waiters:
+                    del self._waiting[user_id]
+                continue
+
+            delay = max(self._requests.wait_time(1), self._tokens.wait_time(tokens))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            self._requests.try_consume(1)
+            self._tokens.try_consume(tokens)
+            waiters.popleft()
+            # Следующий запрос этого пользователя встает в конец круга
+            del self._waiting[user_id]
+            if waiters:
+                self._waiting[user_id] = waiters
+            self._active += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, estimated_tokens: int,
+                   timeout: Optional[float] = None) -> AsyncIterator[SchedulerSlot]:
+        """Ожидание своей очереди (не дольше timeout) и выполнение запроса внутри блока"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, deque()).append((future, estimated_tokens))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if future.cancelled():
+                # Убираем отмененное ожидание из очереди пользователя
+                waiters = self._waiting.get(user_id)
+                if waiters is not None and (future, estimated_tokens) in waiters:
+                    waiters.remove((future, estimated_tokens))
+                    if not waiters:
+                        del self._waiting[user_id]
+            else:
+                # Разрешение уже выдано, но запрос не начался
+                self._active -= 1
+            self._dispatch()
+            if isinstance(e, asyncio.TimeoutError):
+                raise SchedulerTimeout(f"Очередь к OpenAI не подошла за {timeout:.0f} с") from None
+            raise
+
+        slot = SchedulerSlot(estimated_tokens)
+        try:
+            yield slot
+        finally:
+            self._active -= 1
+            if slot.tokens_used is not None:
+                self._tokens.adjust(estimated_tokens - slot.tokens_used)
+            self._dispatch()
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from database import ConnectionPool
+
+# Через сколько новых записей проверять размер таблицы кэша
+EVICTION_CHECK_EVERY = 100
+# Через сколько попаданий записывать накопленные отметки об использовании
+TOUCH_FLUSH_EVERY = 100
+
+
+def normalize_prompt(text: str) -> str:
+    """Приведение запроса к каноническому виду для ключа кэша"""
+    text = re.sub(r"\s+", " ", text.casefold()).strip()
+    return text.strip(" .,!?;:…")
+
+
+def make_cache_key(prompt: str, model: str, system_prompt: str, temperature: float) -> str:
+    """Ключ кэша по нормализованному запросу и параметрам модели"""
+    payload = json.dumps(
+        [normalize_prompt(prompt), model, system_prompt, temperature],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Кэш ответов OpenAI: LRU в памяти поверх таблицы SQLite"""
+
+    def __init__(self, pool: ConnectionPool, ttl: float = 86400,
+                 max_entries: int = 10000, memory_size: int = 1000):
+        self.pool = pool
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_size = memory_size
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Попадания, еще не записанные в таблицу: ключ -> (число, время последнего)
+        self._touched: Dict[str, Tuple[int, float]] = {}
+        self._touched_hits = 0
+        self._stored_since_eviction = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.init_table()
+
+    def init_table(self) -> None:
+        """Создание таблицы кэша"""
+        with self.pool.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    tokens_used INTEGER DEFAULT 0,
+                    hits INTEGER DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used_at)"
+            )
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        """Ответ из памяти, если он есть и не устарел"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            response, expires_at = entry
+            if expires_at < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return response
+
+    def _memory_put(self, key: str, response: str, expires_at: float) -> None:
+        """Сохранение ответа в памяти"""
+        with self._lock:
+            self._memory[key] = (response, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _touch(self, key: str) -> int:
+        """Отметка о попадании; возвращает число незаписанных попаданий"""
+        with self._lock:
+            count, _ = self._touched.get(key, (0, 0.0))
+            self._touched[key] = (count + 1, time.time())
+            self._touched_hits += 1
+            return self._touched_hits
+
+    def flush(self) -> None:
+        """Запись накопленных отметок об использовании одной транзакцией"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._touched_hits = 0
+        if not touched:
+            return
+        with self.pool.connection() as conn:
+            conn.executemany(
+                """UPDATE response_cache
+                SET hits = hits + ?, last_used_at = max(last_used_at, ?)
+                WHERE key = ?""",
+                [(count, used_at, key) for key, (count, used_at) in touched.items()]
+            )
+
+    def _load(self, key: str) -> Optional[str]:
+        """Чтение ответа из таблицы; промах ничего не записывает"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+
+        if not row:
+            return None
+        self._memory_put(key, row['response'], row['created_at'] + self.ttl)
+        return row['response']
+
+    def _store(self, key: str, response: str, tokens_used: int) -> None:
+        """Запись ответа в таблицу и периодическое вытеснение старых записей"""
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute(
+                """INSERT OR REPLACE INTO response_cache
+                (key, response, tokens_used, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?)""",
+                (key, response, tokens_used, now, now)
+            )
+
+        self._memory_put(key, response, now + self.ttl)
+
+        self._stored_since_eviction += 1
+        if self._stored_since_eviction >= EVICTION_CHECK_EVERY:
+            self._stored_since_eviction = 0
+            self.evict()
+
+    def evict(self) -> int:
+        """Удаление устаревших записей и самых давно использованных сверх лимита"""
+        # Порядок вытеснения учитывает и еще не записанные попадания
+        self.flush()
+        with self.pool.connection() as conn:
+            expired = conn.execute(
+                "DELETE FROM response_cache WHERE created_at <= ?",
+                (time.time() - self.ttl,)
+            ).rowcount
+            overflow = conn.execute(
+                """DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_used_at
+                    LIMIT max((SELECT count(*) FROM response_cache) - ?, 0)
+                )""",
+                (self.max_entries,)
+            ).rowcount
+        return expired + overflow
+
+    async def get_or_compute(
+        self,
+        prompt: str,
+        model: str,
+        system_prompt: str,
+        temperature: float,
+        compute: Callable[[], Awaitable[Tuple[str, int]]]
+    ) -> Tuple[str, int, bool]:
+        """Ответ из кэша или от compute(); одинаковые параллельные запросы объединяются.
+
+        Возвращает (ответ, потраченные токены, признак попадания в кэш).
+        """
+        key = make_cache_key(prompt, model, system_prompt, temperature)
+
+        response = self._memory_get(key)
+        if response is None and key not in self._inflight:
+            response = await asyncio.to_thread(self._load, key)
+        if response is not None:
+            self.hits += 1
+            if self._touch(key) >= TOUCH_FLUSH_EVERY:
+                try:
+                    await asyncio.to_thread(self.flush)
+                except Exception as e:
+                    logging.error(f"Ошибка записи статистики кэша ответов: {e}")
+            return response, 0, True
+
+        # Такой же запрос уже выполняется: ждем его результат
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight), 0, True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response, tokens_used = await compute()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError("Запрос, ожидаемый из кэша, был отменен")
+            future.set_exception(e)
+            future.exception()  # Ожидающих может не быть
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        future.set_result(response)
+        if response:
+            try:
+                await asyncio.to_thread(self._store, key, response, tokens_used)
+            except Exception as e:
+                logging.error(f"Ошибка записи в кэш ответов: {e}")
+        return response, tokens_used, False
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий, промахов и объединенных запросов"""
+        total = self.hits + self.coalesced + self.misses
+        return {
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.coalesced) / total if total else 0.0,
+            'memory_size': len(self._memory)
+        }
@@ -0,0 +1,265 @@
+import glob
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Tuple
+
+from compression import TextCompressor
+from database import DatabaseManager
+
+# Размер пакета при сжатии и переносе строк: короткие транзакции не мешают боту
+BATCH_SIZE = 2000
+# Сколько свободных страниц освобождать за один шаг incremental_vacuum
+VACUUM_STEP_PAGES = 2000
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive.requests (
+    id INTEGER PRIMARY KEY,
+    tg_id INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    response,
+    tokens_used INTEGER DEFAULT 0,
+    created_at TIMESTAMP
+)
+"""
+
+
+def month_bounds(created_at: str) -> Tuple[str, str]:
+    """Начало месяца записи и начало следующего месяца в формате created_at"""
+    year, month = int(created_at[:4]), int(created_at[5:7])
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+
+def format_size(size: int) -> str:
+    """Размер в байтах в удобном для чтения виде"""
+    for unit in ("Б", "КБ", "МБ"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+def archive_files(archive_dir: str) -> List[str]:
+    """Файлы архива журнала запросов по возрастанию месяца"""
+    return sorted(glob.glob(os.path.join(archive_dir, "requests-*.db")))
+
+
+def archive_month(path: str) -> str:
+    """Месяц файла архива вида 2024-05"""
+    return os.path.basename(path)[len("requests-"):-len(".db")]
+
+
+class RetentionManager:
+    """Хранение журнала запросов: сжатие ответов, архивирование и VACUUM.
+
+    Строки старше retain_days переносятся в помесячные файлы SQLite в
+    archive_dir, освободившиеся страницы возвращаются системе через
+    incremental_vacuum, так что основная база остается небольшой.
+    """
+
+    def __init__(self, db: DatabaseManager, archive_dir: str = "archive",
+                 retain_days: int = 90, compression: str = 'zlib',
+                 convert_auto_vacuum: bool = False):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.retain_days = retain_days
+        self.compressor = TextCompressor(compression)
+        self.convert_auto_vacuum = convert_auto_vacuum
+        # Строки до этого id уже проверены на сжатие в этом процессе
+        self._compressed_upto = 0
+
+    def archive_path(self, month: str) -> str:
+        """Файл архива за месяц вида 2024-05"""
+        return os.path.join(self.archive_dir, f"requests-{month}.db")
+
+    def archive_files(self) -> List[str]:
+        """Все файлы архива по возрастанию месяца"""
+        return archive_files(self.archive_dir)
+
+    def database_size(self) -> Tuple[int, int]:
+        """Размер базы и объем свободных страниц в байтах"""
+        with self.db.get_connection() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return page_count * page_size, freelist * page_size
+
+    def compress_backlog(self) -> Tuple[int, int]:
+        """Сжатие ответов, записанных без сжатия: (строк, сэкономлено байт)"""
+        if self.compressor.algorithm == 'none':
+            return 0, 0
+
+        compressed = saved = 0
+        while True:
+            # Чтение и запись пакета под одной блокировкой: перезаписываем то, что прочитали
+            with self.db.transaction() as tx:
+                rows = tx.execute(
+                    """SELECT id, response FROM requests
+                    WHERE id > ? AND typeof(response) = 'text'
+                    AND length(CAST(response AS BLOB)) >= ?
+                    ORDER BY id LIMIT ?""",
+                    (self._compressed_upto, self.compressor.min_size, BATCH_SIZE)
+                ).fetchall()
+                if not rows:
+                    return compressed, saved
+
+                updates = []
+                for row in rows:
+                    packed = self.compressor.compress(row['response'])
+                    if isinstance(packed, bytes):
+                        updates.append((packed, row['id']))
+                        saved += len(row['response'].encode('utf-8')) - len(packed)
+                tx.executemany("UPDATE requests SET response = ? WHERE id = ?", updates)
+
+            compressed += len(updates)
+            self._compressed_upto = rows[-1]['id']
+
+    def archive(self) -> Tuple[int, List[str]]:
+        """Перенос строк старше retain_days в архив: (строк, файлы архива)"""
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retain_days)).strftime('%Y-%m-%d %H:%M:%S')
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        archived = 0
+        files: List[str] = []
+        while True:
+            with self.db.get_connection() as conn:
+                oldest = conn.execute("SELECT MIN(created_at) FROM requests").fetchone()[0]
+            if oldest is None or oldest >= cutoff:
+                return archived, files
+
+            month_start, month_end = month_bounds(oldest)
+            path = self.archive_path(month_start[:7])
+            archived += self._archive_month(path, month_start, min(month_end, cutoff))
+            files.append(path)
+
+    def _archive_month(self, path: str, start: str, end: str) -> int:
+        """Перенос строк одного месяца в его файл архива"""
+        moved = 0
+        with self.db.get_connection() as conn:
+            conn.execute("ATTACH DATABASE ? AS archive", (path,))
+            try:
+                conn.execute(ARCHIVE_SCHEMA)
+                while True:
+                    # Граница пакета по времени: одинаковое условие для копирования и удаления
+                    last = conn.execute(
+                        """SELECT created_at FROM requests
+                        WHERE created_at >= ? AND created_at < ?
+                        ORDER BY created_at LIMIT 1 OFFSET ?""",
+                        (start, end, BATCH_SIZE - 1)
+                    ).fetchone()
+                    if last is None:
+                        condition, params = "created_at >= ? AND created_at < ?", (start, end)
+                    else:
+                        condition, params = "created_at >= ? AND created_at <= ?", (start, last[0])
+
+                    # Основная база в режиме WAL не фиксирует транзакцию по двум файлам
+                    # атомарно, поэтому сначала копия, потом удаление: при сбое между
+                    # ними повторный запуск пропустит уже скопированные строки
+                    conn.execute(
+                        f"""INSERT OR IGNORE INTO archive.requests
+                        (id, tg_id, prompt, response, tokens_used, created_at)
+                        SELECT id, tg_id, prompt, response, tokens_used, created_at
+                        FROM main.requests WHERE {condition}""",
+                        params
+                    )
+                    conn.commit()
+                    moved += conn.execute(
+                        f"DELETE FROM main.requests WHERE {condition}", params
+                    ).rowcount
+                    conn.commit()
+
+                    if last is None:
+                        return moved
+            finally:
+                conn.rollback()
+                conn.execute("DETACH DATABASE archive")
+
+    def vacuum(self) -> int:
+        """Возврат свободных страниц системе; возвращает освобожденные байты"""
+        with self.db.get_connection() as conn:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+        if mode != 2:
+            if not self.convert_auto_vacuum:
+                logging.warning(
+                    "База создана без auto_vacuum = INCREMENTAL: место не возвращается. "
+                    "Включите RETENTION_CONVERT_AUTO_VACUUM для однократного VACUUM"
+                )
+                return 0
+            return self._convert_auto_vacuum()
+
+        size_before, _ = self.database_size()
+        with self.db.get_connection() as conn:
+            # Небольшими шагами, чтобы не держать блокировку записи долго
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free_pages:
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+                remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        size_after, _ = self.database_size()
+        return size_before - size_after
+
+    def _convert_auto_vacuum(self) -> int:
+        """Однократный полный VACUUM с включением auto_vacuum = INCREMENTAL"""
+        logging.warning("Полный VACUUM базы для включения auto_vacuum = INCREMENTAL")
+        size_before, _ = self.database_size()
+        with self.db.get_connection() as conn:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        size_after, _ = self.database_size()
+        return size_before - size_after
+
+    def run(self) -> Dict[str, Any]:
+        """Полный проход: сжатие, архивирование, VACUUM и отчет"""
+        started = time.perf_counter()
+        # Свежие строки журнала тоже должны попасть под сжатие и архивирование
+        self.db.request_journal.flush()
+        size_before, _ = self.database_size()
+
+        compressed, compressed_saved = self.compress_backlog()
+        archived, files = self.archive()
+        freed = self.vacuum()
+        size_after, free_after = self.database_size()
+
+        report = {
+            'compressed_rows': compressed,
+            'compressed_saved': compressed_saved,
+            'archived_rows': archived,
+            'archive_files': sorted(set(files)),
+            'vacuum_freed': freed,
+            'size_before': size_before,
+            'size_after': size_after,
+            'free_after': free_after,
+            'reclaimed': size_before - size_after,
+            'duration': time.perf_counter() - started,
+        }
+        logging.info(
+            f"Обслуживание журнала запросов: сжато {compressed}, в архив {archived}, "
+            f"освобождено {format_size(report['reclaimed'])}, "
+            f"база {format_size(size_after)}"
+        )
+        return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Текст отчета об обслуживании для администратора"""
+    text = (
+        "🧹 Обслуживание журнала запросов\n\n"
+        f"🗜 Сжато ответов: {report['compressed_rows']} "
+        f"(−{format_size(report['compressed_saved'])})\n"
+        f"📦 Перенесено в архив: {report['archived_rows']}\n"
+        f"💾 База: {format_size(report['size_before'])} → {format_size(report['size_after'])} "
+        f"(освобождено {format_size(report['reclaimed'])})\n"
+        f"⏱ {report['duration']:.1f} с"
+    )
+    if report['archive_files']:
+        text += "\n\nФайлы архива:\n" + "\n".join(
+            os.path.basename(path) for path in report['archive_files']
+        )
+    return text
@@ -0,0 +1,222 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from telebot.asyncio_storage import StateContext, StateStorageBase
+
+from database import ConnectionPool
+
+# Через сколько записей удалять истекшие состояния из таблицы
+PURGE_CHECK_EVERY = 100
+
+StateKey = Tuple[int, int]
+
+
+def state_name(state: Any) -> Optional[str]:
+    """Имя состояния: telebot передает State или строку"""
+    return getattr(state, 'name', state)
+
+
+class StateEntry:
+    """Состояние диалога одного пользователя в чате"""
+
+    __slots__ = ('state', 'data', 'expires_at')
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+
+
+class LRUStateStorage(StateStorageBase):
+    """Состояния диалогов в памяти с вытеснением по LRU и истечением по TTL"""
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 10000):
+        super().__init__()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[StateKey, StateEntry]" = OrderedDict()
+
+    def _get(self, chat_id: int, user_id: int) -> Optional[StateEntry]:
+        """Живая запись или None; истекшая запись удаляется"""
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _touch(self, chat_id: int, user_id: int, entry: StateEntry) -> None:
+        """Продление срока жизни записи и вытеснение лишних"""
+        key = (chat_id, user_id)
+        entry.expires_at = time.monotonic() + self.ttl
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def set_state(self, chat_id, user_id, state):
+        entry = self._get(chat_id, user_id) or StateEntry(None, {}, 0.0)
+        entry.state = state_name(state)
+        self._touch(chat_id, user_id, entry)
+        return True
+
+    async def get_state(self, chat_id, user_id):
+        entry = self._get(chat_id, user_id)
+        return entry.state if entry else None
+
+    async def delete_state(self, chat_id, user_id):
+        return self._entries.pop((chat_id, user_id), None) is not None
+
+    async def get_data(self, chat_id, user_id):
+        entry = self._get(chat_id, user_id)
+        return entry.data if entry else None
+
+    async def set_data(self, chat_id, user_id, key, value):
+        entry = self._get(chat_id, user_id)
+        if entry is None:
+            raise RuntimeError(f"chat_id {chat_id} and user_id {user_id} does not exist")
+        entry.data[key] = value
+        self._touch(chat_id, user_id, entry)
+        return True
+
+    async def reset_data(self, chat_id, user_id):
+        entry = self._get(chat_id, user_id)
+        if entry is None:
+            return False
+        entry.data = {}
+        self._touch(chat_id, user_id, entry)
+        return True
+
+    def get_interactive_data(self, chat_id, user_id):
+        return StateContext(self, chat_id, user_id)
+
+    async def save(self, chat_id, user_id, data):
+        entry = self._get(chat_id, user_id)
+        if entry is not None:
+            entry.data = data or {}
+            self._touch(chat_id, user_id, entry)
+
+
+class SQLiteStateStorage(StateStorageBase):
+    """Состояния диалогов в таблице SQLite, общие для нескольких процессов бота"""
+
+    def __init__(self, pool: ConnectionPool, ttl: float = 3600):
+        super().__init__()
+        self.pool = pool
+        self.ttl = ttl
+        self._written_since_purge = 0
+        self.init_table()
+
+    def init_table(self) -> None:
+        """Создание таблицы состояний"""
+        with self.pool.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS dialog_states (
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    state TEXT,
+                    data TEXT NOT NULL DEFAULT '{}',
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, user_id)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_dialog_states_expires ON dialog_states (expires_at)"
+            )
+
+    def _load(self, chat_id: int, user_id: int) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+        """Состояние и данные по первичному ключу, если запись не истекла"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                """SELECT state, data FROM dialog_states
+                WHERE chat_id = ? AND user_id = ? AND expires_at > ?""",
+                (chat_id, user_id, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        return row['state'], json.loads(row['data'])
+
+    def _write(self, sql: str, params: tuple) -> int:
+        """Изменение записи с продлением срока жизни; периодически чистит истекшие"""
+        with self.pool.connection() as conn:
+            changed = conn.execute(sql, params).rowcount
+
+        self._written_since_purge += 1
+        if self._written_since_purge >= PURGE_CHECK_EVERY:
+            self._written_since_purge = 0
+            self.purge()
+        return changed
+
+    def _set_state(self, chat_id: int, user_id: int, state: Optional[str]) -> None:
+        now = time.time()
+        # Истекшая запись начинается заново с пустыми данными
+        self._write(
+            """INSERT INTO dialog_states (chat_id, user_id, state, data, expires_at)
+            VALUES (?, ?, ?, '{}', ?)
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                state = excluded.state,
+                data = CASE WHEN dialog_states.expires_at > ? THEN dialog_states.data ELSE '{}' END,
+                expires_at = excluded.expires_at""",
+            (chat_id, user_id, state, now + self.ttl, now)
+        )
+
+    def _save_data(self, chat_id: int, user_id: int, data: Dict[str, Any]) -> bool:
+        now = time.time()
+        return self._write(
+            """UPDATE dialog_states SET data = ?, expires_at = ?
+            WHERE chat_id = ? AND user_id = ? AND expires_at > ?""",
+            (json.dumps(data, ensure_ascii=False), now + self.ttl, chat_id, user_id, now)
+        ) > 0
+
+    def _delete(self, chat_id: int, user_id: int) -> bool:
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "DELETE FROM dialog_states WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            ).rowcount > 0
+
+    def purge(self) -> int:
+        """Удаление истекших состояний"""
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "DELETE FROM dialog_states WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
+    async def set_state(self, chat_id, user_id, state):
+        await asyncio.to_thread(self._set_state, chat_id, user_id, state_name(state))
+        return True
+
+    async def get_state(self, chat_id, user_id):
+        record = await asyncio.to_thread(self._load, chat_id, user_id)
+        return record[0] if record else None
+
+    async def delete_state(self, chat_id, user_id):
+        return await asyncio.to_thread(self._delete, chat_id, user_id)
+
+    async def get_data(self, chat_id, user_id):
+        record = await asyncio.to_thread(self._load, chat_id, user_id)
+        return record[1] if record else None
+
+    async def set_data(self, chat_id, user_id, key, value):
+        data = await self.get_data(chat_id, user_id)
+        if data is None:
+            raise RuntimeError(f"chat_id {chat_id} and user_id {user_id} does not exist")
+        data[key] = value
+        return await asyncio.to_thread(self._save_data, chat_id, user_id, data)
+
+    async def reset_data(self, chat_id, user_id):
+        return await asyncio.to_thread(self._save_data, chat_id, user_id, {})
+
+    def get_interactive_data(self, chat_id, user_id):
+        return StateContext(self, chat_id, user_id)
+
+    async def save(self, chat_id, user_id, data):
+        await asyncio.to_thread(self._save_data, chat_id, user_id, data or {})
@@ -0,0 +1,763 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from database import DatabaseManager, utc_timestamp
+from pg_migrations import apply_pg_migrations
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg нужен только для PostgreSQL
+    asyncpg = None
+
+# Попытки get_or_create_user при гонке с параллельной регистрацией (PostgreSQL)
+GET_OR_CREATE_ATTEMPTS = 2
+
+
+class Storage(ABC):
+    """Асинхронный интерфейс хранилища данных бота"""
+
+    # Вызывается с временем ожидания соединения в секундах (для метрик)
+    on_wait: Optional[Callable[[float], None]] = None
+
+    async def connect(self) -> None:
+        """Подготовка соединений и схемы"""
+
+    async def close(self) -> None:
+        """Сброс отложенных записей и закрытие соединений"""
+
+    @abstractmethod
+    async def get_or_create_user(self, tg_id: int, username: str = None,
+                                 first_name: str = None, last_name: str = None) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_user(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_user_balance(self, tg_id: int, amount: int) -> bool:
+        raise NotImplementedError
+
+    async def get_user_balance(self, tg_id: int) -> int:
+        user = await self.get_user(tg_id)
+        return user['balance'] if user else 0
+
+    @abstractmethod
+    async def add_payment(self, tg_id: int, amount: int, stars_paid: int,
+                          payment_id: str, status: str = "completed") -> bool:
+        """Платеж и пополнение баланса; повтор с тем же payment_id ничего не меняет"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_promo_code(self, code: str, requests: int, max_uses: int = None) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_promo_codes(self, codes: Sequence[str], requests: int, max_uses: int = None,
+                                 campaign: str = None) -> int:
+        """Массовое создание кодов кампании; совпавшие с существующими пропускаются"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_campaign_codes(self, campaign: str) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_active_promo_codes(self) -> List[str]:
+        """Коды, которые еще можно активировать (для индекса в памяти)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def use_promo_code(self, code: str, tg_id: int) -> Tuple[bool, int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_request(self, tg_id: int, prompt: str, response: str = None,
+                          tokens_used: int = 0) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def reserve_request(self, tg_id: int, ttl: float = 300) -> Tuple[Optional[int], int]:
+        """Резервирование одного запроса: (id резерва, остаток баланса) или (None, 0)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def commit_request(self, hold_id: int, tg_id: int, prompt: str, response: str = None,
+                             tokens_used: int = 0) -> bool:
+        """Подтверждение резерва после успешного ответа и запись запроса.
+
+        False, если резерв истек раньше: запрос списан заново, только если хватило баланса.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_request(self, hold_id: int) -> bool:
+        """Возврат зарезервированного запроса на баланс"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def reclaim_expired_holds(self) -> int:
+        """Возврат на баланс резервов с истекшим сроком"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_recent_requests(self, tg_id: int, since: str = None,
+                                  limit: int = 50) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_conversation(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_conversation_summary(self, tg_id: int, summary: str, summary_until: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def reset_conversation(self, tg_id: int) -> None:
+        raise NotImplementedError
+
+    async def get_user_stats(self, tg_id: int) -> Dict[str, Any]:
+        user = await self.get_user(tg_id)
+        if not user:
+            return {'balance': 0, 'total_requests': 0}
+        return {'balance': user['balance'], 'total_requests': user['total_requests']}
+
+    @abstractmethod
+    async def get_all_users_stats(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_bot_stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_daily_stats(self, days: int = 7) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_recent_users(self, limit: int = 10) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_promo_codes(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set_user_blocked(self, tg_id: int, blocked: bool = True) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count_broadcast_recipients(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_broadcast_recipients(self, after_tg_id: int, limit: int = 500) -> List[int]:
+        """Следующая страница получателей после after_tg_id (keyset-пагинация)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def create_broadcast(self, text: str, created_by: int, total: int) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_running_broadcasts(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def claim_broadcast(self, broadcast_id: int, stale_after: int = 300) -> Optional[Dict[str, Any]]:
+        """Захват рассылки, позиция которой не сохранялась дольше stale_after секунд"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_broadcast_progress(self, broadcast_id: int, last_tg_id: int, sent: int,
+                                      blocked: int, failed: int, status: str = 'running') -> bool:
+        """Сохранение позиции рассылки; False, если ее уже остановили"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_rows(self, table: str, columns: Sequence[str], date_column: str,
+                  since: str = None, until: str = None,
+                  batch_size: int = 5000) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Строки таблицы пакетами по возрастанию id, без загрузки всей таблицы в память"""
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """Хранилище на SQLite: синхронный DatabaseManager в пуле потоков"""
+
+    def __init__(self, db: DatabaseManager):
+        self.db = db
+
+    @property
+    def on_wait(self) -> Optional[Callable[[float], None]]:
+        return self.db.pool.on_wait
+
+    @on_wait.setter
+    def on_wait(self, callback: Optional[Callable[[float], None]]) -> None:
+        self.db.pool.on_wait = callback
+
+    async def _run(self, func, *args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def close(self) -> None:
+        await self._run(self.db.close)
+
+    async def get_or_create_user(self, tg_id, username=None, first_name=None, last_name=None):
+        return await self._run(self.db.get_or_create_user, tg_id, username, first_name, last_name)
+
+    async def get_user(self, tg_id):
+        # Запись пользователя почти всегда берется из кэша: поток не нужен
+        user = self.db.user_cache.get(tg_id)
+        return user if user else await self._run(self.db.load_user, tg_id)
+
+    async def update_user_balance(self, tg_id, amount):
+        return await self._run(self.db.update_user_balance, tg_id, amount)
+
+    async def add_payment(self, tg_id, amount, stars_paid, payment_id, status="completed"):
+        return await self._run(self.db.add_payment, tg_id, amount, stars_paid, payment_id, status)
+
+    async def create_promo_code(self, code, requests, max_uses=None):
+        return await self._run(self.db.create_promo_code, code, requests, max_uses)
+
+    async def create_promo_codes(self, codes, requests, max_uses=None, campaign=None):
+        return await self._run(self.db.create_promo_codes, codes, requests, max_uses, campaign)
+
+    async def get_campaign_codes(self, campaign):
+        return await self._run(self.db.get_campaign_codes, campaign)
+
+    async def get_active_promo_codes(self):
+        return await self._run(self.db.get_active_promo_codes)
+
+    async def use_promo_code(self, code, tg_id):
+        return await self._run(self.db.use_promo_code, code, tg_id)
+
+    async def add_request(self, tg_id, prompt, response=None, tokens_used=0):
+        return await self._run(self.db.add_request, tg_id, prompt, response, tokens_used)
+
+    async def reserve_request(self, tg_id, ttl=300):
+        return await self._run(self.db.reserve_request, tg_id, ttl)
+
+    async def commit_request(self, hold_id, tg_id, prompt, response=None, tokens_used=0):
+        return await self._run(self.db.commit_request, hold_id, tg_id, prompt, response, tokens_used)
+
+    async def release_request(self, hold_id):
+        return await self._run(self.db.release_request, hold_id)
+
+    async def reclaim_expired_holds(self):
+        return await self._run(self.db.reclaim_expired_holds)
+
+    async def get_recent_requests(self, tg_id, since=None, limit=50):
+        return await self._run(self.db.get_recent_requests, tg_id, since, limit)
+
+    async def get_conversation(self, tg_id):
+        return await self._run(self.db.get_conversation, tg_id)
+
+    async def save_conversation_summary(self, tg_id, summary, summary_until):
+        return await self._run(self.db.save_conversation_summary, tg_id, summary, summary_until)
+
+    async def reset_conversation(self, tg_id):
+        return await self._run(self.db.reset_conversation, tg_id)
+
+    async def get_all_users_stats(self):
+        return await self._run(self.db.get_all_users_stats)
+
+    async def get_bot_stats(self):
+        return await self._run(self.db.get_bot_stats)
+
+    async def get_daily_stats(self, days=7):
+        return await self._run(self.db.get_daily_stats, days)
+
+    async def get_recent_users(self, limit=10):
+        return await self._run(self.db.get_recent_users, limit)
+
+    async def get_promo_codes(self):
+        return await self._run(self.db.get_promo_codes)
+
+    async def set_user_blocked(self, tg_id, blocked=True):
+        return await self._run(self.db.set_user_blocked, tg_id, blocked)
+
+    async def count_broadcast_recipients(self):
+        return await self._run(self.db.count_broadcast_recipients)
+
+    async def get_broadcast_recipients(self, after_tg_id, limit=500):
+        return await self._run(self.db.get_broadcast_recipients, after_tg_id, limit)
+
+    async def create_broadcast(self, text, created_by, total):
+        return await self._run(self.db.create_broadcast, text, created_by, total)
+
+    async def get_broadcast(self, broadcast_id):
+        return await self._run(self.db.get_broadcast, broadcast_id)
+
+    async def get_running_broadcasts(self):
+        return await self._run(self.db.get_running_broadcasts)
+
+    async def claim_broadcast(self, broadcast_id, stale_after=300):
+        return await self._run(self.db.claim_broadcast, broadcast_id, stale_after)
+
+    async def save_broadcast_progress(self, broadcast_id, last_tg_id, sent, blocked, failed,
+                                      status='running'):
+        return await self._run(
+            self.db.save_broadcast_progress, broadcast_id, last_tg_id, sent, blocked, failed, status
+        )
+
+    async def cancel_broadcast(self, broadcast_id):
+        return await self._run(self.db.cancel_broadcast, broadcast_id)
+
+    async def iter_rows(self, table, columns, date_column, since=None, until=None, batch_size=5000):
+        batches = self.db.iter_rows(table, columns, date_column, since, until, batch_size)
+        try:
+            while True:
+                # Каждый пакет читается в пуле потоков, цикл событий не блокируется
+                batch = await self._run(next, batches, None)
+                if batch is None:
+                    return
+                yield batch
+        finally:
+            batches.close()
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Строка формата utc_timestamp() в datetime (пустая строка — None)"""
+    return datetime.fromisoformat(value) if value else None
+
+
+def format_timestamp(value: Optional[datetime]) -> Optional[str]:
+    """datetime в строку формата utc_timestamp(), как в SQLite"""
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] if value else None
+
+
+class PostgresStorage(Storage):
+    """Хранилище на PostgreSQL с пулом соединений asyncpg.
+
+    Кэша пользователей нет: при нескольких процессах бота он бы расходился с базой.
+    """
+
+    def __init__(self, dsn: str, pool_size: int = 8, default_free_requests: int = 3):
+        if asyncpg is None:
+            raise RuntimeError("Для PostgreSQL нужен пакет asyncpg: pip install -r requirements-postgres.txt")
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.default_free_requests = default_free_requests
+        self.pool: Optional["asyncpg.Pool"] = None
+
+    async def connect(self) -> None:
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        async with self.pool.acquire() as conn:
+            await apply_pg_migrations(conn)
+
+    async def close(self) -> None:
+        if self.pool:
+            await self.pool.close()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator["asyncpg.Connection"]:
+        """Соединение из пула с учетом времени ожидания"""
+        started = time.perf_counter()
+        conn = await self.pool.acquire()
+        if self.on_wait is not None:
+            self.on_wait(time.perf_counter() - started)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    async def _execute(self, sql: str, *args) -> None:
+        async with self.connection() as conn:
+            await conn.execute(sql, *args)
+
+    async def _fetchrow(self, sql: str, *args) -> Optional[Dict[str, Any]]:
+        async with self.connection() as conn:
+            row = await conn.fetchrow(sql, *args)
+        return dict(row) if row else None
+
+    async def _fetch(self, sql: str, *args) -> List[Dict[str, Any]]:
+        async with self.connection() as conn:
+            rows = await conn.fetch(sql, *args)
+        return [dict(row) for row in rows]
+
+    async def get_or_create_user(self, tg_id, username=None, first_name=None, last_name=None):
+        # Существующий пользователь не обновляется, чтобы не плодить версии строки
+        for _ in range(GET_OR_CREATE_ATTEMPTS):
+            user = await self._fetchrow(
+                """WITH inserted AS (
+                    INSERT INTO users (tg_id, username, first_name, last_name, balance)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT (tg_id) DO NOTHING
+                    RETURNING *
+                )
+                SELECT * FROM inserted
+                UNION ALL
+                SELECT * FROM users WHERE tg_id = $1
+                LIMIT 1""",
+                tg_id, username, first_name, last_name, self.default_free_requests
+            )
+            # Пусто, если параллельная вставка зафиксирована после начала запроса;
+            # следующий запрос уже видит ее строку
+            if user:
+                return user
+        raise RuntimeError(f"Не удалось получить или создать пользователя {tg_id}")
+
+    async def get_user(self, tg_id):
+        return await self._fetchrow("SELECT * FROM users WHERE tg_id = $1", tg_id)
+
+    async def update_user_balance(self, tg_id, amount):
+        try:
+            await self._execute(
+                """UPDATE users SET balance = balance + $1, updated_at = now() AT TIME ZONE 'utc'
+                WHERE tg_id = $2""",
+                amount, tg_id
+            )
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка обновления баланса: {e}")
+            return False
+
+    async def add_payment(self, tg_id, amount, stars_paid, payment_id, status="completed"):
+        try:
+            async with self.connection() as conn:
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    # Повторная доставка того же платежа баланс не меняет
+                    payment = await conn.fetchval(
+                        """INSERT INTO payments (tg_id, amount, stars_paid, payment_id, status)
+                        VALUES ($1, $2, $3, $4, $5)
+                        ON CONFLICT (payment_id) DO NOTHING RETURNING id""",
+                        tg_id, amount, stars_paid, payment_id, status
+                    )
+                    updated = payment is not None and await conn.fetchval(
+                        """UPDATE users SET balance = balance + $1, updated_at = now() AT TIME ZONE 'utc'
+                        WHERE tg_id = $2 RETURNING tg_id""",
+                        amount, tg_id
+                    )
+                except BaseException:
+                    await transaction.rollback()
+                    raise
+                if payment is None:
+                    await transaction.rollback()
+                    logging.warning(f"Платеж {payment_id} уже учтен")
+                    return True
+                if not updated:
+                    # Платеж без пользователя не записываем: повтор после регистрации пройдет
+                    await transaction.rollback()
+                    logging.error(f"Платеж {payment_id}: пользователь {tg_id} не найден")
+                    return False
+                await transaction.commit()
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка добавления платежа: {e}")
+            return False
+
+    async def create_promo_code(self, code, requests, max_uses=None):
+        try:
+            await self._execute(
+                "INSERT INTO promo_codes (code, requests, max_uses) VALUES ($1, $2, $3)",
+                code, requests, max_uses
+            )
+            return True
+        except asyncpg.UniqueViolationError:
+            logging.error(f"Промокод {code} уже существует")
+            return False
+        except Exception as e:
+            logging.error(f"Ошибка создания промокода: {e}")
+            return False
+
+    async def create_promo_codes(self, codes, requests, max_uses=None, campaign=None):
+        # Один запрос на весь список вместо построчных вставок
+        status = await self._fetchrow(
+            """WITH inserted AS (
+                INSERT INTO promo_codes (code, requests, max_uses, campaign)
+                SELECT unnest($1::text[]), $2, $3, $4
+                ON CONFLICT (code) DO NOTHING
+                RETURNING 1
+            )
+            SELECT count(*) AS created FROM inserted""",
+            list(codes), requests, max_uses, campaign
+        )
+        return status['created']
+
+    async def get_campaign_codes(self, campaign):
+        rows = await self._fetch("SELECT code FROM promo_codes WHERE campaign = $1 ORDER BY id", campaign)
+        return [row['code'] for row in rows]
+
+    async def get_active_promo_codes(self):
+        rows = await self._fetch(
+            """SELECT code FROM promo_codes
+            WHERE is_active = TRUE AND (max_uses IS NULL OR used_count < max_uses)"""
+        )
+        return [row['code'] for row in rows]
+
+    async def use_promo_code(self, code, tg_id):
+        try:
+            async with self.connection() as conn:
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    # Условное увеличение счетчика: лимит проверяется и расходуется атомарно
+                    promo = await conn.fetchrow(
+                        """UPDATE promo_codes SET used_count = used_count + 1
+                        WHERE code = $1 AND is_active = TRUE
+                        AND (max_uses IS NULL OR used_count < max_uses)
+                        RETURNING id, requests""",
+                        code
+                    )
+                    usage_id = promo and await conn.fetchval(
+                        """INSERT INTO promo_usage (promo_id, tg_id) VALUES ($1, $2)
+                        ON CONFLICT (promo_id, tg_id) DO NOTHING RETURNING id""",
+                        promo['id'], tg_id
+                    )
+                    updated = usage_id and await conn.fetchval(
+                        """UPDATE users SET balance = balance + $1, updated_at = now() AT TIME ZONE 'utc'
+                        WHERE tg_id = $2 RETURNING tg_id""",
+                        promo['requests'], tg_id
+                    )
+                except BaseException:
+                    await transaction.rollback()
+                    raise
+                if not updated:
+                    # Кода нет, лимит исчерпан, код уже использован или нет пользователя
+                    await transaction.rollback()
+                    return False, 0
+                await transaction.commit()
+                return True, promo['requests']
+        except Exception as e:
+            logging.error(f"Ошибка использования промокода: {e}")
+            return False, 0
+
+    async def add_request(self, tg_id, prompt, response=None, tokens_used=0):
+        async with self.connection() as conn, conn.transaction():
+            await conn.execute(
+                """UPDATE users SET balance = balance - 1, total_requests = total_requests + 1
+                WHERE tg_id = $1""",
+                tg_id
+            )
+            await conn.execute(
+                """INSERT INTO requests (tg_id, prompt, response, tokens_used, created_at)
+                VALUES ($1, $2, $3, $4, $5)""",
+                tg_id, prompt, response, tokens_used, parse_timestamp(utc_timestamp())
+            )
+
+    async def reserve_request(self, tg_id, ttl=300):
+        # Проверка, списание и запись резерва одним выражением
+        row = await self._fetchrow(
+            """WITH charged AS (
+                UPDATE users SET balance = balance - 1, updated_at = now() AT TIME ZONE 'utc'
+                WHERE tg_id = $1 AND balance > 0
+                RETURNING tg_id, balance
+            ), hold AS (
+                INSERT INTO balance_holds (tg_id, amount, expires_at)
+                SELECT tg_id, 1, now() AT TIME ZONE 'utc' + $2 * interval '1 second' FROM charged
+                RETURNING id
+            )
+            SELECT hold.id, charged.balance FROM hold, charged""",
+            tg_id, float(ttl)
+        )
+        return (row['id'], row['balance']) if row else (None, 0)
+
+    async def commit_request(self, hold_id, tg_id, prompt, response=None, tokens_used=0):
+        async with self.connection() as conn, conn.transaction():
+            # Если резерв уже вернули по истечении срока, списываем заново, пока есть баланс
+            held = await conn.fetchval(
+                """WITH hold AS (DELETE FROM balance_holds WHERE id = $1 RETURNING id)
+                UPDATE users SET total_requests = total_requests + 1,
+                balance = balance - CASE
+                    WHEN NOT EXISTS (SELECT 1 FROM hold) AND balance > 0 THEN 1 ELSE 0
+                END
+                WHERE tg_id = $2 RETURNING EXISTS (SELECT 1 FROM hold)""",
+                hold_id, tg_id
+            )
+            await conn.execute(
+                """INSERT INTO requests (tg_id, prompt, response, tokens_used, created_at)
+                VALUES ($1, $2, $3, $4, $5)""",
+                tg_id, prompt, response, tokens_used, parse_timestamp(utc_timestamp())
+            )
+        return bool(held)
+
+    async def release_request(self, hold_id):
+        row = await self._fetchrow(
+            """WITH hold AS (DELETE FROM balance_holds WHERE id = $1 RETURNING tg_id, amount)
+            UPDATE users SET balance = balance + hold.amount FROM hold
+            WHERE users.tg_id = hold.tg_id RETURNING users.tg_id""",
+            hold_id
+        )
+        return row is not None
+
+    async def reclaim_expired_holds(self):
+        async with self.connection() as conn:
+            return await conn.fetchval(
+                """WITH expired AS (
+                    DELETE FROM balance_holds WHERE expires_at <= now() AT TIME ZONE 'utc'
+                    RETURNING tg_id, amount
+                ), refunds AS (
+                    SELECT tg_id, sum(amount) AS amount FROM expired GROUP BY tg_id
+                ), refunded AS (
+                    UPDATE users SET balance = balance + refunds.amount FROM refunds
+                    WHERE users.tg_id = refunds.tg_id
+                )
+                SELECT count(*) FROM expired"""
+            )
+
+    async def get_recent_requests(self, tg_id, since=None, limit=50):
+        rows = await self._fetch(
+            """SELECT prompt, response, tokens_used, created_at FROM requests
+            WHERE tg_id = $1 AND created_at > COALESCE($2, '-infinity'::timestamp)
+            ORDER BY created_at DESC, id DESC LIMIT $3""",
+            tg_id, parse_timestamp(since), limit
+        )
+        for row in rows:
+            row['created_at'] = format_timestamp(row['created_at'])
+        return rows
+
+    async def get_conversation(self, tg_id):
+        row = await self._fetchrow(
+            "SELECT summary, summary_until, reset_at FROM conversations WHERE tg_id = $1",
+            tg_id
+        )
+        if row:
+            row['summary_until'] = format_timestamp(row['summary_until'])
+            row['reset_at'] = format_timestamp(row['reset_at'])
+        return row
+
+    async def save_conversation_summary(self, tg_id, summary, summary_until):
+        await self._execute(
+            """INSERT INTO conversations (tg_id, summary, summary_until) VALUES ($1, $2, $3)
+            ON CONFLICT (tg_id) DO UPDATE SET summary = excluded.summary,
+            summary_until = excluded.summary_until, updated_at = now() AT TIME ZONE 'utc'""",
+            tg_id, summary, parse_timestamp(summary_until)
+        )
+
+    async def reset_conversation(self, tg_id):
+        await self._execute(
+            """INSERT INTO conversations (tg_id, summary, summary_until, reset_at)
+            VALUES ($1, NULL, NULL, $2)
+            ON CONFLICT (tg_id) DO UPDATE SET summary = NULL, summary_until = NULL,
+            reset_at = excluded.reset_at, updated_at = now() AT TIME ZONE 'utc'""",
+            tg_id, parse_timestamp(utc_timestamp())
+        )
+
+    async def get_all_users_stats(self):
+        return await self._fetch(
+            """SELECT tg_id, username, first_name, balance, total_requests, created_at
+            FROM users ORDER BY created_at DESC"""
+        )
+
+    async def get_bot_stats(self):
+        return await self._fetchrow(
+            """SELECT total_users, active_users, total_requests, total_tokens,
+            total_payments, total_stars FROM stats_totals WHERE id = 1"""
+        )
+
+    async def get_daily_stats(self, days=7):
+        rows = await self._fetch(
+            """SELECT day, new_users, requests, tokens, payments, stars FROM stats_daily
+            WHERE day > (now() AT TIME ZONE 'utc')::date - $1::int ORDER BY day DESC""",
+            days
+        )
+        for row in rows:
+            row['day'] = row['day'].isoformat()
+        return rows
+
+    async def get_recent_users(self, limit=10):
+        return await self._fetch(
+            """SELECT tg_id, username, first_name, last_name, balance, total_requests, created_at
+            FROM users ORDER BY created_at DESC LIMIT $1""",
+            limit
+        )
+
+    async def get_promo_codes(self):
+        return await self._fetch(
+            """SELECT code, requests, max_uses, used_count, is_active, created_at
+            FROM promo_codes ORDER BY created_at DESC"""
+        )
+
+    async def set_user_blocked(self, tg_id, blocked=True):
+        await self._execute("UPDATE users SET is_blocked = $1 WHERE tg_id = $2", blocked, tg_id)
+
+    async def count_broadcast_recipients(self):
+        async with self.connection() as conn:
+            return await conn.fetchval("SELECT count(*) FROM users WHERE is_blocked = FALSE")
+
+    async def get_broadcast_recipients(self, after_tg_id, limit=500):
+        rows = await self._fetch(
+            """SELECT tg_id FROM users WHERE tg_id > $1 AND is_blocked = FALSE
+            ORDER BY tg_id LIMIT $2""",
+            after_tg_id, limit
+        )
+        return [row['tg_id'] for row in rows]
+
+    async def create_broadcast(self, text, created_by, total):
+        row = await self._fetchrow(
+            "INSERT INTO broadcasts (text, created_by, total) VALUES ($1, $2, $3) RETURNING id",
+            text, created_by, total
+        )
+        return row['id']
+
+    async def get_broadcast(self, broadcast_id):
+        return await self._fetchrow("SELECT * FROM broadcasts WHERE id = $1", broadcast_id)
+
+    async def get_running_broadcasts(self):
+        return await self._fetch("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+
+    async def claim_broadcast(self, broadcast_id, stale_after=300):
+        return await self._fetchrow(
+            """UPDATE broadcasts SET updated_at = now() AT TIME ZONE 'utc'
+            WHERE id = $1 AND status = 'running'
+            AND updated_at < now() AT TIME ZONE 'utc' - $2 * interval '1 second'
+            RETURNING *""",
+            broadcast_id, float(stale_after)
+        )
+
+    async def save_broadcast_progress(self, broadcast_id, last_tg_id, sent, blocked, failed,
+                                      status='running'):
+        row = await self._fetchrow(
+            """UPDATE broadcasts SET last_tg_id = $1, sent = $2, blocked = $3, failed = $4,
+            status = $5, updated_at = now() AT TIME ZONE 'utc',
+            finished_at = CASE WHEN $5 = 'running' THEN NULL ELSE now() AT TIME ZONE 'utc' END
+            WHERE id = $6 AND status = 'running' RETURNING id""",
+            last_tg_id, sent, blocked, failed, status, broadcast_id
+        )
+        return row is not None
+
+    async def cancel_broadcast(self, broadcast_id):
+        row = await self._fetchrow(
+            """UPDATE broadcasts SET status = 'cancelled', updated_at = now() AT TIME ZONE 'utc',
+            finished_at = now() AT TIME ZONE 'utc' WHERE id = $1 AND status = 'running' RETURNING id""",
+            broadcast_id
+        )
+        return row is not None
+
+    async def iter_rows(self, table, columns, date_column, since=None, until=None, batch_size=5000):
+        conditions, params = [], []
+        if since:
+            params.append(parse_timestamp(since))
+            conditions.append(f"{date_column} >= ${len(params)}")
+        if until:
+            params.append(parse_timestamp(until))
+            conditions.append(f"{date_column} < ${len(params)}")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        async with self.connection() as conn:
+            # Серверный курсор существует только внутри транзакции
+            async with conn.transaction(readonly=True):
+                cursor = await conn.cursor(
+                    f"SELECT {', '.join(columns)} FROM {table} {where} ORDER BY id", *params
+                )
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        return
+                    yield [dict(row) for row in rows]
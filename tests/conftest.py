@@ -0,0 +1,52 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+from database import DatabaseManager  # noqa: E402
+from storage import PostgresStorage, SQLiteStorage, asyncpg  # noqa: E402
+
+# База для тестов PostgreSQL; все ее таблицы очищаются перед каждым тестом
+TEST_POSTGRES_DSN = os.getenv('TEST_POSTGRES_DSN')
+
+PG_TABLES = (
+    "users, payments, promo_codes, promo_usage, requests, balance_holds, "
+    "broadcasts, conversations, stats_daily"
+)
+
+
+async def clear_postgres(storage: PostgresStorage) -> None:
+    async with storage.connection() as conn:
+        await conn.execute(f"TRUNCATE {PG_TABLES} RESTART IDENTITY CASCADE")
+        await conn.execute("DELETE FROM stats_totals")
+        await conn.execute("INSERT INTO stats_totals (id) VALUES (1)")
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def run(request, tmp_path):
+    """Запуск сценария с чистым хранилищем; каждый тест проходит на обоих бэкендах"""
+    backend = request.param
+    if backend == 'postgres':
+        if not TEST_POSTGRES_DSN:
+            pytest.skip("TEST_POSTGRES_DSN не задан")
+        if asyncpg is None:
+            pytest.skip("asyncpg не установлен")
+
+    async def scenario(test):
+        if backend == 'sqlite':
+            storage = SQLiteStorage(DatabaseManager(str(tmp_path / "bot.db")))
+        else:
+            storage = PostgresStorage(TEST_POSTGRES_DSN, default_free_requests=Config.DEFAULT_FREE_REQUESTS)
+        await storage.connect()
+        try:
+            if backend == 'postgres':
+                await clear_postgres(storage)
+            await test(storage)
+        finally:
+            await storage.close()
+
+    return lambda test: asyncio.run(scenario(test))
@@ -0,0 +1,163 @@
+"""Одинаковое поведение SQLiteStorage и PostgresStorage.
+
+PostgreSQL проверяется, если задан TEST_POSTGRES_DSN:
+
+    TEST_POSTGRES_DSN=postgresql://postgres@127.0.0.1/bot_test python -m pytest tests
+"""
+import csv
+import gzip
+
+from config import Config
+from export import export_table
+
+
+def test_new_user_gets_free_requests(run):
+    async def test(storage):
+        user = await storage.get_or_create_user(1, "alice")
+        assert user['balance'] == Config.DEFAULT_FREE_REQUESTS
+        # Повторный вызов не создает второго пользователя и не меняет баланс
+        again = await storage.get_or_create_user(1, "alice")
+        assert again['id'] == user['id']
+        assert await storage.get_user_balance(1) == Config.DEFAULT_FREE_REQUESTS
+    run(test)
+
+
+def test_reserve_commit_release(run):
+    async def test(storage):
+        await storage.get_or_create_user(1)
+        await storage.update_user_balance(1, 2 - Config.DEFAULT_FREE_REQUESTS)
+
+        first, balance = await storage.reserve_request(1)
+        assert first is not None and balance == 1
+        second, balance = await storage.reserve_request(1)
+        assert second is not None and balance == 0
+        # Баланс исчерпан резервами
+        assert await storage.reserve_request(1) == (None, 0)
+
+        assert await storage.commit_request(first, 1, "вопрос", "ответ", 10)
+        assert await storage.release_request(second)
+        # Повторный возврат того же резерва баланс не меняет
+        assert not await storage.release_request(second)
+
+        user = await storage.get_user(1)
+        assert user['balance'] == 1
+        assert user['total_requests'] == 1
+    run(test)
+
+
+def test_expired_holds_are_reclaimed(run):
+    async def test(storage):
+        await storage.get_or_create_user(1)
+        hold_id, balance = await storage.reserve_request(1, ttl=0)
+        assert hold_id is not None
+        assert await storage.reclaim_expired_holds() == 1
+        assert await storage.get_user_balance(1) == balance + 1
+        assert not await storage.release_request(hold_id)
+        # Ответ после истечения резерва: подтверждение сообщает об этом и списывает заново
+        assert not await storage.commit_request(hold_id, 1, "вопрос", "ответ", 10)
+        assert await storage.get_user_balance(1) == balance
+    run(test)
+
+
+def test_add_payment_is_idempotent(run):
+    async def test(storage):
+        await storage.get_or_create_user(1)
+        start = await storage.get_user_balance(1)
+        assert await storage.add_payment(1, 10, 50, "charge-1")
+        # Повторная доставка того же платежа
+        assert await storage.add_payment(1, 10, 50, "charge-1")
+        assert await storage.get_user_balance(1) == start + 10
+        assert (await storage.get_bot_stats())['total_payments'] == 1
+    run(test)
+
+
+def test_add_payment_for_unknown_user(run):
+    async def test(storage):
+        assert not await storage.add_payment(404, 10, 50, "charge-2")
+        # Неудачная попытка не занимает payment_id: после регистрации платеж проходит
+        await storage.get_or_create_user(404)
+        start = await storage.get_user_balance(404)
+        assert await storage.add_payment(404, 10, 50, "charge-2")
+        assert await storage.get_user_balance(404) == start + 10
+    run(test)
+
+
+def test_promo_redemption(run):
+    async def test(storage):
+        for tg_id in (1, 2, 3):
+            await storage.get_or_create_user(tg_id)
+        start = await storage.get_user_balance(1)
+        assert await storage.create_promo_code("GIFT", 5, max_uses=2)
+        assert not await storage.create_promo_code("GIFT", 5)
+
+        assert await storage.use_promo_code("GIFT", 1) == (True, 5)
+        # Один пользователь - одна активация
+        assert await storage.use_promo_code("GIFT", 1) == (False, 0)
+        assert await storage.use_promo_code("GIFT", 2) == (True, 5)
+        # Лимит активаций исчерпан
+        assert await storage.use_promo_code("GIFT", 3) == (False, 0)
+        assert await storage.use_promo_code("NOPE", 3) == (False, 0)
+
+        assert await storage.get_user_balance(1) == start + 5
+        assert await storage.get_user_balance(3) == start
+        assert "GIFT" not in await storage.get_active_promo_codes()
+    run(test)
+
+
+def test_promo_campaign(run):
+    async def test(storage):
+        await storage.create_promo_code("A1", 1)
+        created = await storage.create_promo_codes(["A1", "A2", "A3"], 1, max_uses=1, campaign="spring")
+        # Совпавший с существующим код пропускается
+        assert created == 2
+        assert await storage.get_campaign_codes("spring") == ["A2", "A3"]
+        assert set(await storage.get_active_promo_codes()) == {"A1", "A2", "A3"}
+    run(test)
+
+
+def test_broadcast_paging(run):
+    async def test(storage):
+        for tg_id in range(1, 8):
+            await storage.get_or_create_user(tg_id)
+        await storage.set_user_blocked(4)
+        assert await storage.count_broadcast_recipients() == 6
+
+        pages, after = [], 0
+        while True:
+            page = await storage.get_broadcast_recipients(after, limit=4)
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        assert pages == [[1, 2, 3, 5], [6, 7]]
+
+        broadcast_id = await storage.create_broadcast("новости", 1, 6)
+        assert await storage.save_broadcast_progress(broadcast_id, 5, 4, 0, 0)
+        record = await storage.get_broadcast(broadcast_id)
+        assert (record['last_tg_id'], record['sent'], record['status']) == (5, 4, 'running')
+        # Свежую рассылку другой процесс не подхватывает
+        assert await storage.claim_broadcast(broadcast_id, stale_after=300) is None
+
+        assert await storage.cancel_broadcast(broadcast_id)
+        # Отмененная рассылка не продолжается
+        assert not await storage.save_broadcast_progress(broadcast_id, 7, 6, 0, 0)
+        assert await storage.get_running_broadcasts() == []
+    run(test)
+
+
+def test_export(run, tmp_path):
+    async def test(storage):
+        for tg_id in range(1, 4):
+            await storage.get_or_create_user(tg_id, f"user{tg_id}")
+            await storage.add_payment(tg_id, 10, 50, f"charge-{tg_id}")
+
+        path = str(tmp_path / "payments.csv.gz")
+        assert await export_table(storage, 'payments', 'csv', path, batch_size=2) == 3
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            rows = list(csv.DictReader(file))
+        assert [row['payment_id'] for row in rows] == ["charge-1", "charge-2", "charge-3"]
+
+        # Фильтр по дате: since в будущем - пустая выгрузка
+        path = str(tmp_path / "users.jsonl.gz")
+        assert await export_table(storage, 'users', 'jsonl', path, since="2999-01-01") == 0
+    run(test)
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Optional
+
+from aiohttp import ClientSession, web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+# Заголовок с секретом, который Telegram передает при вызове вебхука
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class RecentUpdateIds:
+    """Ограниченное множество недавно принятых update_id"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+
+    def add(self, update_id: int) -> bool:
+        """Добавление идентификатора; False, если он уже встречался"""
+        if update_id in self._ids:
+            return False
+        self._ids[update_id] = None
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return True
+
+    def discard(self, update_id: int) -> None:
+        """Удаление идентификатора, чтобы повторная доставка была принята"""
+        self._ids.pop(update_id, None)
+
+
+def get_update_sender(data: Dict[str, Any]) -> Optional[int]:
+    """ID отправителя обновления (message, callback_query, pre_checkout_query и т.д.)"""
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+
+class WebhookServer:
+    """HTTP-сервер приема обновлений Telegram с ограниченным числом обработчиков.
+
+    У каждого пользователя своя цепочка: его обновления разбираются строго
+    по порядку, а медленное обновление одного пользователя не задерживает
+    других. Долгие запросы к AI обработчик запускает отдельной задачей, поэтому
+    цепочка и место обработчика заняты только на время разбора обновления.
+    pre_checkout_query обрабатывается вне цепочки: на него нужно ответить за 10
+    секунд. Одновременно выполняется не больше workers обработчиков, принятых
+    и еще не обработанных обновлений - не больше queue_size.
+    """
+
+    def __init__(self, bot: AsyncTeleBot, path: str, secret_token: Optional[str] = None,
+                 workers: int = 64, queue_size: int = 1000, dedup_size: int = 10000,
+                 enqueue_timeout: float = 1.0):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.enqueue_timeout = enqueue_timeout
+        self._recent = RecentUpdateIds(dedup_size)
+        self._workers = asyncio.Semaphore(workers)
+        self._capacity = asyncio.Semaphore(queue_size)
+        # Ожидающие обновления и задача-цепочка каждого пользователя
+        self._pending: Dict[Hashable, Deque[Dict[str, Any]]] = {}
+        self._chains: Dict[Hashable, asyncio.Task] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    def create_app(self) -> web.Application:
+        """aiohttp-приложение с маршрутом вебхука"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Прием одного обновления от Telegram"""
+        if self.secret_token and request.headers.get(SECRET_TOKEN_HEADER) != self.secret_token:
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update_id = int(data['update_id'])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        # Повторная доставка того же обновления
+        if not self._recent.add(update_id):
+            return web.Response()
+
+        try:
+            await asyncio.wait_for(self._capacity.acquire(), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            # Очередь переполнена: Telegram повторит доставку позже
+            self._recent.discard(update_id)
+            logging.warning(f"Очередь обновлений переполнена, update_id={update_id} отклонен")
+            return web.Response(status=503)
+
+        sender = get_update_sender(data)
+        if sender is None or 'pre_checkout_query' in data:
+            # Отдельная цепочка из одного обновления: не ждет других обновлений отправителя
+            key = ('update', update_id)
+        else:
+            key = sender
+        self._pending.setdefault(key, deque()).append(data)
+        if key not in self._chains:
+            self._chains[key] = asyncio.create_task(self._chain(key))
+        return web.Response()
+
+    async def _chain(self, key: Hashable) -> None:
+        """Обработка обновлений одного пользователя по порядку"""
+        pending = self._pending[key]
+        try:
+            while pending:
+                data = pending[0]
+                try:
+                    async with self._workers:
+                        await self.bot.process_new_updates([types.Update.de_json(data)])
+                except Exception as e:
+                    logging.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}")
+                finally:
+                    pending.popleft()
+                    self._capacity.release()
+        finally:
+            # При отмене необработанные обновления тоже освобождают место
+            for _ in pending:
+                self._capacity.release()
+            del self._pending[key]
+            del self._chains[key]
+
+    async def start(self, host: str, port: int) -> None:
+        """Запуск HTTP-сервера"""
+        self._runner = web.AppRunner(self.create_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Вебхук слушает http://{host}:{port}{self.path}")
+
+    async def stop_accepting(self) -> None:
+        """Остановка HTTP-сервера: недоставленные обновления Telegram повторит позже"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """Остановка приема и завершение обработчиков после опустошения очередей"""
+        await self.stop_accepting()
+        chains = list(self._chains.values())
+        if not chains:
+            return
+        _, unfinished = await asyncio.wait(chains, timeout=timeout)
+        if unfinished:
+            # Эти обновления уже подтверждены Telegram, повторной доставки не будет
+            logging.warning(f"Срок остановки истек, не обработано обновлений из очереди: {self.queued}")
+            for chain in unfinished:
+                chain.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+
+async def replay_updates(url: str, path: str, secret_token: Optional[str] = None) -> None:
+    """Отправка записанных обновлений (JSON по одному на строку) на локальный вебхук"""
+    headers = {SECRET_TOKEN_HEADER: secret_token} if secret_token else {}
+    async with ClientSession(headers=headers) as session:
+        with open(path, encoding='utf-8') as updates:
+            for line in updates:
+                if not line.strip():
+                    continue
+                async with session.post(url, json=json.loads(line)) as response:
+                    print(f"{response.status} {line.strip()[:80]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка записанных обновлений на вебхук")
+    parser.add_argument('updates', help="Файл с обновлениями Telegram в формате JSONL")
+    parser.add_argument('--url', default="http://127.0.0.1:8080/telegram/webhook")
+    parser.add_argument('--secret', default=None)
+    args = parser.parse_args()
+    asyncio.run(replay_updates(args.url, args.updates, args.secret))